@@ -0,0 +1,409 @@
+import os
+import re
+import json
+import base64
+import asyncio
+import binascii
+import queue
+import threading
+from urllib.parse import parse_qs
+import export
+import pipeline
+import scratch
+import query_pool
+import state_backend
+import storage
+from auth import check_credentials
+from utils import load_env
+
+# Headless HTTP API over the query pipeline, as a plain ASGI app:
+#
+#   uvicorn api:app --workers 1
+#
+# One process serves many clients at once: requests are handled on the event
+# loop and the questions themselves run on the shared query pool.
+
+load_env()
+
+API_MAX_UPLOAD_MB = int(os.getenv("API_MAX_UPLOAD_MB", "200"))
+# How often a waiting stream reports its queue position
+PROGRESS_INTERVAL = 0.5
+# Export chunks buffered between the writer thread and a slow client
+EXPORT_QUEUE_CHUNKS = 4
+
+DATABASE_NAME = re.compile(r'^[A-Za-z0-9_.-]+\.db$')
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+async def read_body(receive, limit):
+    """The request body, or HTTPError 413 past `limit` bytes."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise HTTPError(400, "Client disconnected")
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise HTTPError(413, "Request body too large")
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_json(send, status, payload):
+    body = pipeline.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+def authenticate(scope):
+    """
+    Username from a session token (`Authorization: Bearer`), shared with every
+    worker through the state backend, or from HTTP Basic credentials.
+    """
+    headers = dict(scope.get('headers') or [])
+    authorization = headers.get(b'authorization', b'').decode('latin-1')
+    if authorization.lower().startswith('bearer '):
+        username = state_backend.get_session_user(authorization[7:].strip())
+        if not username:
+            raise HTTPError(401, "Session expired or unknown")
+        return username
+    if not authorization.lower().startswith('basic '):
+        raise HTTPError(401, "Authentication required")
+    try:
+        username, _, password = base64.b64decode(authorization[6:]).decode().partition(':')
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPError(401, "Malformed credentials")
+    if not check_credentials(username, password):
+        raise HTTPError(401, "Invalid username or password")
+    return username
+
+def check_database_name(name):
+    if not DATABASE_NAME.match(name or ''):
+        raise HTTPError(400, "Database names end in .db and use letters, digits, '.', '_' and '-'")
+    return name
+
+def existing_database(username, name):
+    """Path of one of the user's databases; each user has their own names."""
+    db_path = storage.resolve(username, check_database_name(name))
+    if not db_path:
+        raise HTTPError(404, f"No database named {name}")
+    return db_path
+
+async def wait_job(job, on_progress=None):
+    """Await a query pool job from the event loop, reporting its queue position meanwhile."""
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(
+        lambda: finished.done() or finished.set_result(None)))
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(finished), PROGRESS_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                if on_progress:
+                    await on_progress(job.position())
+        return job.result(0)
+    finally:
+        # The client went away or the request was cancelled
+        if not job.done():
+            job.cancel()
+
+async def claim(question, schema, db_path, on_wait=None):
+    """Wait on identical in-flight questions: ('cached', response) or ('claimed', token)."""
+    while True:
+        outcome, value = await asyncio.to_thread(pipeline.claim_question, question, schema, 0, db_path)
+        if outcome != 'waiting':
+            return outcome, value
+        if on_wait:
+            await on_wait()
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+async def until_disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def cancel_on_disconnect(receive, work):
+    """Run `work` (a coroutine), cancelling it if the client disconnects first."""
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(until_disconnected(receive))
+    try:
+        await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        print("Client disconnected; question cancelled")
+        return
+    task.result()
+
+async def handle_upload(scope, receive, send, username, name):
+    check_database_name(name)
+    body = await read_body(receive, API_MAX_UPLOAD_MB * 1024 * 1024)
+    if not body.startswith(b'SQLite format 3\x00'):
+        raise HTTPError(400, "Body is not a SQLite database")
+
+    def save():
+        try:
+            db_path = storage.store_upload(username, name, body)
+        except storage.QuotaExceeded as e:
+            raise HTTPError(507, str(e))
+        schema = pipeline.load_schema(db_path)
+        pipeline.prepare_database(db_path, schema, username)
+        # The Streamlit app opens the same database for this user
+        state_backend.set_active_database(username, db_path, schema)
+        return schema
+
+    schema = await asyncio.to_thread(save)
+    await send_json(send, 201, {'database': name, 'schema': schema})
+
+async def handle_schema(send, username, name):
+    db_path = await asyncio.to_thread(existing_database, username, name)
+    schema = await asyncio.to_thread(pipeline.load_schema, db_path)
+    await send_json(send, 200, {'database': name, 'schema': schema})
+
+async def parse_question(receive):
+    try:
+        request = json.loads(await read_body(receive, 1024 * 1024) or b'{}')
+    except json.JSONDecodeError:
+        raise HTTPError(400, "Body must be JSON")
+    if not isinstance(request, dict) or not request.get('question') or not request.get('database'):
+        raise HTTPError(400, "Body needs 'question' and 'database'")
+    return request
+
+async def handle_ask(send, username, request, stream):
+    """
+    Answer a question. As JSON, the whole response comes back at once; as a
+    stream, newline-delimited JSON events report progress as it happens:
+    waiting, queued, running, sql, results, answer and, for approximate
+    answers, exact.
+    """
+    question = request['question']
+    db_path = await asyncio.to_thread(existing_database, username, request['database'])
+    approximate = bool(request.get('approximate'))
+    schema = await asyncio.to_thread(pipeline.load_schema, db_path)
+    conversation = scratch.conversation_id(username, db_path)
+
+    if not stream:
+        outcome, value = await claim(question, schema, db_path)
+        if outcome == 'cached':
+            await send_json(send, 200, dict(pipeline.response_to_json(value), cached=True))
+            return
+        job = pipeline.submit_question(username, question, db_path, schema, value,
+                                       conversation=conversation, approximate=approximate)
+        response = await wait_job(job)
+        await send_json(send, 200, dict(pipeline.response_to_json(response) or {}, cached=False))
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/x-ndjson'), (b'cache-control', b'no-cache')]
+    })
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    async def emit(event, **data):
+        await send({'type': 'http.response.body', 'body': (pipeline.dumps(dict(event=event, **data)) + "\n").encode(),
+                    'more_body': True})
+
+    def progress(event, data):
+        # Called on the pool worker; hand the event over to the event loop
+        if event == 'results':
+            data = {'columns': list(data['columns']),
+                    'rows': pipeline.result_rows(data['results']),
+                    'row_count': pipeline.result_count(data['results'])}
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def drain():
+        while not events.empty():
+            event, data = events.get_nowait()
+            await emit(event, **data)
+
+    # Only state changes are reported, not every poll
+    last = {'status': None}
+    async def on_position(position):
+        await drain()
+        status = ('queued', position) if position else ('running', None)
+        if status != last['status']:
+            last['status'] = status
+            if position:
+                await emit('queued', position=position)
+            else:
+                await emit('running')
+
+    async def on_wait():
+        if last['status'] != ('waiting', None):
+            last['status'] = ('waiting', None)
+            await emit('waiting')
+
+    try:
+        outcome, value = await claim(question, schema, db_path, on_wait)
+        if outcome == 'cached':
+            await emit('answer', cached=True, response=pipeline.response_to_json(value))
+        else:
+            job = pipeline.submit_question(username, question, db_path, schema, value, conversation=conversation,
+                                           approximate=approximate, progress=progress)
+            response = await wait_job(job, on_position)
+            await drain()
+            await emit('answer', cached=False, response=pipeline.response_to_json(response))
+            if response and response.get('approximate'):
+                exact = await wait_job(pipeline.submit_exact(username, question, db_path, schema,
+                                                             response, conversation))
+                await emit('exact', response=pipeline.response_to_json(exact))
+    except Exception as e:
+        # Headers are already sent, so errors are reported in the stream
+        print(f"Error answering '{question}': {e}")
+        await emit('error', error=str(e))
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+class ChunkSink:
+    """
+    Binary file-like object an export writes into from a worker thread. The
+    event loop reads the chunks from `queue`; a full queue blocks the writer,
+    so a slow client slows the export down instead of buffering it.
+    """
+
+    def __init__(self, cancelled):
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+        self.cancelled = cancelled
+        self.closed = False
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=PROGRESS_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise export.ExportCancelled("Export cancelled")
+
+    def get(self):
+        """Next chunk, None at the end, or the error the export ended with."""
+        while True:
+            try:
+                return self.queue.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                if self.cancelled.is_set():
+                    return None
+
+    def write(self, data):
+        self.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+async def handle_export(send, username, request, fmt):
+    """
+    Stream the full result of an answered question, without its LIMIT, as
+    CSV or Parquet. The question must have been asked (and its answer
+    cached) first; its SQL is re-run, never SQL from the request.
+    """
+    if fmt not in export.FORMATS:
+        raise HTTPError(400, f"Format must be one of {', '.join(export.FORMATS)}")
+    db_path = await asyncio.to_thread(existing_database, username, request['database'])
+    schema = await asyncio.to_thread(pipeline.load_schema, db_path)
+    cached = await asyncio.to_thread(pipeline.get_cached_response, request['question'], schema,
+                                     storage.data_version(db_path))
+    if not cached or not (cached.get('sql_query') or '').upper().startswith('SELECT'):
+        raise HTTPError(404, "No answer to export; ask the question first")
+
+    cancelled = threading.Event()
+    sink = ChunkSink(cancelled)
+
+    def write():
+        try:
+            export.WRITERS[fmt](cached['sql_query'], db_path, sink, scratch.conversation_id(username, db_path),
+                                cancelled=cancelled)
+            sink.put(None)
+        except export.ExportCancelled:
+            pass
+        except Exception as e:
+            sink.put(e)
+
+    # Long-running, so it takes a background slot on the pool
+    job = query_pool.submit(username, write, priority=query_pool.BACKGROUND)
+    try:
+        chunk = await asyncio.to_thread(sink.get)
+        if isinstance(chunk, Exception):
+            raise HTTPError(400, f"Export failed: {chunk}")
+        content_type = export.FORMATS[fmt][0]
+        filename = export.download_name(request['question'], fmt)
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', content_type.encode()),
+                        (b'content-disposition', f'attachment; filename="{filename}"'.encode())]
+        })
+        while chunk is not None:
+            if isinstance(chunk, Exception):
+                # Too late for an error status; the client sees a cut-off body
+                print(f"Error exporting '{request['question']}': {chunk}")
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await asyncio.to_thread(sink.get)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        cancelled.set()
+        job.cancel()
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                storage.start_janitor()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path'].rstrip('/')
+    query = parse_qs(scope.get('query_string', b'').decode())
+    try:
+        if method == 'GET' and path == '/health':
+            await send_json(send, 200, {'status': 'ok', 'pool': query_pool.pool_stats()})
+            return
+        username = await asyncio.to_thread(authenticate, scope)
+        parts = path.strip('/').split('/')
+        if path == '/sessions' and method == 'POST':
+            token = await asyncio.to_thread(state_backend.create_session, username)
+            await send_json(send, 201, {'token': token, 'username': username})
+        elif path == '/sessions' and method == 'DELETE':
+            authorization = dict(scope.get('headers') or []).get(b'authorization', b'').decode('latin-1')
+            if authorization.lower().startswith('bearer '):
+                await asyncio.to_thread(state_backend.end_session, authorization[7:].strip())
+            await send_json(send, 200, {'username': username})
+        elif parts[0] == 'databases' and len(parts) == 2 and method == 'PUT':
+            await handle_upload(scope, receive, send, username, parts[1])
+        elif parts[0] == 'databases' and len(parts) == 3 and parts[2] == 'schema' and method == 'GET':
+            await handle_schema(send, username, parts[1])
+        elif path == '/export' and method == 'POST':
+            request = await parse_question(receive)
+            fmt = query.get('format', ['csv'])[0]
+            await cancel_on_disconnect(receive, handle_export(send, username, request, fmt))
+        elif path == '/ask' and method == 'POST':
+            headers = dict(scope.get('headers') or [])
+            stream = (b'application/x-ndjson' in headers.get(b'accept', b'')
+                      or query.get('stream', ['0'])[0] in ('1', 'true'))
+            request = await parse_question(receive)
+            await cancel_on_disconnect(receive, handle_ask(send, username, request, stream))
+        else:
+            raise HTTPError(404, "Not found")
+    except HTTPError as e:
+        await send_json(send, e.status, {'error': e.message})
+    except Exception as e:
+        print(f"Error handling {method} {path}: {e}")
+        await send_json(send, 500, {'error': str(e)})
@@ -1,8 +1,7 @@
-import streamlit as st
 import sqlite3
 import bcrypt
 import os
-from utils import get_db_path
+from utils import get_db_path, connect_initialized
 
 DATABASE_FILE = get_db_path("users.db")
 
@@ -19,7 +18,8 @@ def create_users_table():
     conn.commit()
     conn.close()
 
-create_users_table()
+def _connect():
+    return connect_initialized(DATABASE_FILE, create_users_table)
 
 def hash_password(password):
     salt = bcrypt.gensalt()
@@ -30,7 +30,7 @@ def verify_password(password, hashed_password):
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def register_user(username, password):
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     try:
         hashed_password = hash_password(password)
@@ -42,32 +42,43 @@ def register_user(username, password):
         conn.close()
         return False
 
-def authenticate_user(username, password):
-    conn = sqlite3.connect(DATABASE_FILE)
+def check_credentials(username, password):
+    """Whether the username and password match, without touching any session."""
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
     result = cursor.fetchone()
     conn.close()
-    if result:
-        hashed_password = result[0]
-        if verify_password(password, hashed_password):
-            login_user(username)  # Set the login state
-            return True
+    return bool(result) and verify_password(password, result[0])
+
+def authenticate_user(username, password):
+    if check_credentials(username, password):
+        login_user(username)  # Set the login state
+        return True
     return False
 
+def _session_state():
+    # Only the Streamlit app keeps logins in a session; the API and scripts
+    # use check_credentials and never import Streamlit
+    import streamlit as st
+    return st.session_state
+
 def is_user_logged_in():
-    return 'logged_in' in st.session_state and st.session_state['logged_in']
+    session = _session_state()
+    return 'logged_in' in session and session['logged_in']
 
 def login_user(username):
-    st.session_state['logged_in'] = True
-    st.session_state['username'] = username
+    session = _session_state()
+    session['logged_in'] = True
+    session['username'] = username
 
 def logout_user():
     """Clear user-specific session data on logout"""
-    if 'current_user' in st.session_state:
-        del st.session_state['current_user']
-    if 'user_chat_histories' in st.session_state:
-        del st.session_state['user_chat_histories']
-    st.session_state['logged_in'] = False
-    if 'username' in st.session_state:
-        del st.session_state['username']
+    session = _session_state()
+    if 'current_user' in session:
+        del session['current_user']
+    if 'history_limit' in session:
+        del session['history_limit']
+    session['logged_in'] = False
+    if 'username' in session:
+        del session['username']
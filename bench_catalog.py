@@ -0,0 +1,63 @@
+import os
+import time
+import sqlite3
+import tempfile
+import statistics
+
+TABLE_COUNTS = [100, 1000, 5000]
+COLUMNS_PER_TABLE = 8
+REPEAT = 5
+
+def make_database(path, tables):
+    """A warehouse-style export: many tables, each with a key, an index and a foreign key."""
+    conn = sqlite3.connect(path)
+    for i in range(tables):
+        columns = ", ".join(f"c{j} {'TEXT' if j % 2 else 'REAL'}" for j in range(COLUMNS_PER_TABLE - 2))
+        parent = f", parent_id INTEGER REFERENCES t{i - 1}(id)" if i else ", parent_id INTEGER"
+        conn.execute(f"CREATE TABLE t{i} (id INTEGER PRIMARY KEY{parent}, {columns})")
+        conn.execute(f"CREATE INDEX t{i}_parent ON t{i} (parent_id)")
+    conn.commit()
+    conn.close()
+
+def per_table_pragmas(db_path):
+    """The previous path: one PRAGMA table_info per table, text built by concatenation."""
+    conn = sqlite3.connect(db_path)
+    try:
+        schema = ""
+        for (table_name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+            schema += f"Table: {table_name}\n"
+            for column in conn.execute(f"PRAGMA table_info({table_name})").fetchall():
+                schema += f"  - {column[1]} ({column[2]})\n"
+        return schema
+    finally:
+        conn.close()
+
+def one_query(db_path):
+    import catalog
+    # Bypass the cache so the catalog is read every time
+    catalog._cache.clear()
+    return catalog.get_catalog(db_path)['schema']
+
+def cached(db_path):
+    import catalog
+    return catalog.get_catalog(db_path)['schema']
+
+def time_ms(fn, *args):
+    samples = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def run_benchmark(table_counts=TABLE_COUNTS):
+    print(f"{'tables':>7} {'per-table ms':>13} {'one query ms':>13} {'cached ms':>10}")
+    for tables in table_counts:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        make_database(db_path, tables)
+        assert per_table_pragmas(db_path) == one_query(db_path)
+        print(f"{tables:>7} {time_ms(per_table_pragmas, db_path):>13.1f} {time_ms(one_query, db_path):>13.1f} "
+              f"{time_ms(cached, db_path):>10.2f}")
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,66 @@
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+# streamlit_app pulls in nl2sql, which expects an API key; no requests are made here
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import streamlit as st
+import chat_history
+import streamlit_app
+
+HISTORY_LENGTHS = [10, 50, 100, 200]
+RERUNS = 5
+ROWS_PER_CHART = 200
+
+memoized_chart_spec = streamlit_app.get_chart_spec
+
+def make_history(length, seed=0):
+    """Alternating user/assistant history where every answer carries a bar chart."""
+    rng = np.random.default_rng(seed)
+    chat_history.CHAT_DB = os.path.join(tempfile.mkdtemp(), 'chat_history.db')
+    chat_history.init_chat_db()
+    chat_history._load_chart_spec.cache_clear()
+    st.session_state['current_user'] = 'benchmark'
+    st.session_state['history_limit'] = length
+    for i in range(length // 2):
+        df = pd.DataFrame({
+            'product': [f"Product {j}" for j in range(ROWS_PER_CHART)],
+            'units_sold': rng.integers(0, 1000, ROWS_PER_CHART),
+        })
+        visualization = {
+            'data': df.to_dict('records'),
+            'default_settings': {'chart_type': 'bar', 'x_col': 'product', 'y_col': 'units_sold'}
+        }
+        streamlit_app.add_message_to_history('user', f"Question {i}")
+        streamlit_app.add_message_to_history('assistant', f"Answer {i}", visualization)
+
+def rebuild_chart_spec(message_id):
+    """What every rerun did before memoization: rebuild the chart from stored records."""
+    return streamlit_app.build_chart_spec(chat_history.get_visualization(message_id))
+
+def time_reruns(memoized):
+    """Average time of display_chat_history, with or without memoized specs."""
+    streamlit_app.get_chart_spec = memoized_chart_spec if memoized else rebuild_chart_spec
+    timings = []
+    for _ in range(RERUNS):
+        start = time.perf_counter()
+        streamlit_app.display_chat_history()
+        timings.append(time.perf_counter() - start)
+    streamlit_app.get_chart_spec = memoized_chart_spec
+    return sum(timings) / len(timings)
+
+def run_benchmark(lengths=HISTORY_LENGTHS):
+    print(f"{'messages':>8} {'rebuild_ms':>11} {'memoized_ms':>12} {'speedup':>8}")
+    for length in lengths:
+        make_history(length)
+        rebuild = time_reruns(memoized=False)
+        make_history(length)
+        memoized = time_reruns(memoized=True)
+        print(f"{length:>8} {rebuild * 1000:>11.1f} {memoized * 1000:>12.1f} {rebuild / memoized:>7.1f}x")
+
+if __name__ == "__main__":
+    # Bare-mode Streamlit warns on stderr for every call; run with 2>/dev/null
+    run_benchmark()
@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import resource
+import tempfile
+import subprocess
+import warnings
+
+ROW_COUNTS = [100_000, 500_000, 1_000_000]
+
+def make_database(path, rows, seed=0):
+    """Sales table with integer, real and text columns."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('''
+    CREATE TABLE sales (
+        id INTEGER PRIMARY KEY, Product TEXT, Store_Location TEXT,
+        Units_Sold INTEGER, Price REAL, Sale_Date TEXT
+    )''')
+    conn.executemany(
+        'INSERT INTO sales (Product, Store_Location, Units_Sold, Price, Sale_Date) VALUES (?, ?, ?, ?, ?)',
+        ((f"Product {rnd.randint(1, 500)}", rnd.choice(['North', 'South', 'East', 'West']),
+          rnd.randint(1, 50), round(rnd.uniform(1, 100), 2),
+          f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}") for _ in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+def row_pipeline(db_path, sql):
+    """The previous path: tuples -> DataFrame -> to_numeric -> records -> JSON -> DataFrame."""
+    import pandas as pd
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    results = cursor.fetchall()
+    columns = [d[0] for d in cursor.description]
+    conn.close()
+    df = pd.DataFrame(results, columns=columns)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        for col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='ignore')
+    numeric = df.select_dtypes(include=['int64', 'float64']).columns.tolist()
+    records = df.to_dict('records')
+    cached = json.dumps(results)
+    pd.DataFrame(records).select_dtypes(['int64', 'float64'])
+    return len(records), numeric, len(cached)
+
+def columnar_pipeline(db_path, sql):
+    """The Arrow path: typed columns from the cursor -> chart columns -> IPC for the cache."""
+    from columnar import execute_to_arrow, numeric_columns, categorical_columns, table_to_ipc
+    table = execute_to_arrow(sql, db_path)
+    numeric = numeric_columns(table)
+    x_col = (categorical_columns(table) or table.column_names)[0]
+    table.select([x_col, numeric[0]]).to_pandas()
+    cached = table_to_ipc(table)
+    return table.num_rows, numeric, len(cached)
+
+def run_one(mode, db_path):
+    """Run one pipeline in this process and print its time and peak RSS as JSON."""
+    sql = "SELECT * FROM sales"
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    rows, numeric, cache_bytes = (row_pipeline if mode == 'rows' else columnar_pipeline)(db_path, sql)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'rows': rows, 'numeric': numeric, 'seconds': elapsed,
+        'peak_mb': (peak_kb - baseline_kb) / 1024, 'cache_mb': cache_bytes / 1024 / 1024
+    }))
+
+def run_benchmark(row_counts=ROW_COUNTS):
+    print(f"{'rows':>9} {'mode':<9} {'seconds':>8} {'peak_mb':>8} {'cache_mb':>9}")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for rows in row_counts:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        make_database(db_path, rows)
+        for mode in ('rows', 'columnar'):
+            # Each run gets a fresh interpreter so peak RSS is not shared
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', mode, db_path],
+                capture_output=True, text=True, check=True, cwd=here
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{rows:>9} {mode:<9} {result['seconds']:>8.2f} {result['peak_mb']:>8.1f} {result['cache_mb']:>9.1f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        run_one(sys.argv[2], sys.argv[3])
+    else:
+        run_benchmark()
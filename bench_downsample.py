@@ -0,0 +1,61 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import altair as alt
+
+# streamlit_app pulls in nl2sql, which expects an API key; no requests are made here
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import streamlit_app
+from downsample import reduce_for_chart
+
+# Let the unreduced baseline serialize past Altair's 5000 row guard
+alt.data_transformers.disable_max_rows()
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+CHARTS = [
+    ("line", "day", "units_sold"),
+    ("bar", "product", "units_sold"),
+    ("scatter", "price", "units_sold"),
+    ("heatmap", "product", "price"),
+]
+
+def make_results(n, seed=0):
+    """Synthetic sales-like result set with n rows."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "day": np.arange(n),
+        "product": rng.choice([f"Product {i}" for i in range(2000)], n),
+        "price": rng.gamma(2.0, 20.0, n).round(2),
+        "units_sold": (np.sin(np.arange(n) / 500) * 50 + rng.normal(100, 10, n)).round(),
+    })
+
+def render(df, chart_type, x_col, y_col):
+    """Build the chart and serialize it the way Streamlit ships it to the browser."""
+    start = time.perf_counter()
+    chart = streamlit_app.create_visualization(df, chart_type, x_col, y_col)
+    payload = json.dumps(chart.to_dict())
+    return time.perf_counter() - start, len(payload)
+
+def run_benchmark(sizes=SIZES):
+    print(f"{'chart':<8} {'rows':>9} {'mode':<8} {'points':>7} {'render_ms':>10} {'payload_kb':>11}")
+    for n in sizes:
+        df = make_results(n)
+        for chart_type, x_col, y_col in CHARTS:
+            for mode in ("reduced", "full"):
+                if mode == "full" and n > 100_000:
+                    # Full payloads at this size take minutes and gigabytes
+                    continue
+                if mode == "full":
+                    streamlit_app.reduce_for_chart = lambda data, *args: data
+                else:
+                    streamlit_app.reduce_for_chart = reduce_for_chart
+                points = len(streamlit_app.reduce_for_chart(df, chart_type, x_col, y_col))
+                elapsed, size = render(df, chart_type, x_col, y_col)
+                print(f"{chart_type:<8} {n:>9} {mode:<8} {points:>7} {elapsed * 1000:>10.1f} {size / 1024:>11.1f}")
+    streamlit_app.reduce_for_chart = reduce_for_chart
+
+if __name__ == "__main__":
+    run_benchmark()
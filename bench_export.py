@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+from bench_columnar import make_database
+
+ROW_COUNTS = [100_000, 500_000, 2_000_000]
+MODES = ('in_memory', 'csv', 'parquet')
+
+def in_memory_export(db_path, out_path):
+    """The alternative: the whole result as an Arrow table, then written out."""
+    import pyarrow.parquet as pq
+    from columnar import execute_to_arrow
+    table = execute_to_arrow("SELECT * FROM sales", db_path)
+    pq.write_table(table, out_path)
+    return table.num_rows
+
+def run_one(mode, db_path):
+    """Run one export in this process and print its time, peak RSS and file size as JSON."""
+    import export
+    out_path = os.path.join(tempfile.mkdtemp(), f"export.{mode}")
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == 'in_memory':
+        rows = in_memory_export(db_path, out_path)
+    else:
+        with open(out_path, "wb") as out:
+            rows = export.WRITERS[mode]("SELECT * FROM sales LIMIT 10", db_path, out)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'rows': rows, 'seconds': elapsed, 'peak_mb': (peak_kb - baseline_kb) / 1024,
+        'file_mb': os.path.getsize(out_path) / 1024 / 1024
+    }))
+
+def run_benchmark(row_counts=ROW_COUNTS):
+    print(f"{'rows':>9} {'mode':<10} {'seconds':>8} {'peak_mb':>8} {'file_mb':>8}")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for rows in row_counts:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        make_database(db_path, rows)
+        for mode in MODES:
+            # Each run gets a fresh interpreter so peak RSS is not shared
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', mode, db_path],
+                capture_output=True, text=True, check=True, cwd=here
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{result['rows']:>9} {mode:<10} {result['seconds']:>8.2f} {result['peak_mb']:>8.1f} "
+                  f"{result['file_mb']:>8.1f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        run_one(sys.argv[2], sys.argv[3])
+    else:
+        run_benchmark()
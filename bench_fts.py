@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import tempfile
+
+from bench_columnar import make_database
+
+ROW_COUNTS = [200_000, 1_000_000]
+
+# The shape generate_sql produces for product and category names
+QUERIES = [
+    "SELECT COUNT(*), SUM(Units_Sold) FROM sales WHERE Product LIKE '%uct 377%'",
+    "SELECT Product, SUM(Units_Sold) AS units FROM sales WHERE Product LIKE '%ct 12%' GROUP BY Product ORDER BY units DESC",
+    "SELECT id, Price FROM sales WHERE Product LIKE '%uct 42%' AND Store_Location LIKE '%orth%' ORDER BY id",
+    "SELECT COUNT(*) FROM sales WHERE Product LIKE '%Product%'",
+]
+
+def timed(conn, sql, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+def run_benchmark(row_counts=ROW_COUNTS):
+    import derived
+    from fts_index import ensure_fts_indexes, rewrite_like
+    for rows in row_counts:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        make_database(db_path, rows)
+        start = time.perf_counter()
+        ensure_fts_indexes(db_path)
+        print(f"{rows:,} rows: text indexes built in {time.perf_counter() - start:.2f}s")
+
+        conn = derived.connect(db_path)
+        for sql in QUERIES:
+            base_rows, base_time = timed(conn, sql)
+            rewritten = rewrite_like(sql, conn, db_path)
+            if rewritten == sql:
+                print(f"  {base_time * 1000:8.1f} ms  (not rewritten)  {sql[:70]}")
+                continue
+            fts_rows, fts_time = timed(conn, rewritten)
+            check = "ok" if sorted(map(repr, base_rows)) == sorted(map(repr, fts_rows)) else "MISMATCH"
+            print(f"  {base_time * 1000:8.1f} ms -> {fts_time * 1000:6.1f} ms  {check:<8} {sql[:70]}")
+        conn.close()
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    run_benchmark()
@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Modules a worker, test or script imports without the Streamlit UI, and the
+# cold import time each may take (ms). Override all of them with IMPORT_BUDGET_MS.
+BUDGETS_MS = {
+    'nl2sql': 150,
+    'pipeline': 200,
+    'api': 300,
+    'cache': 100,
+    'database': 100,
+    'follow_up': 100,
+    'auth': 100,
+    'chat_history': 100,
+    'metrics': 100,
+    'query_pool': 100,
+}
+# Libraries that are imported on first use rather than at import
+HEAVY_MODULES = ('streamlit', 'openai', 'pandas', 'pyarrow', 'altair', 'numpy')
+
+def budget_ms(module):
+    return float(os.getenv("IMPORT_BUDGET_MS", BUDGETS_MS[module]))
+
+def _run(code, cwd, extra_args=()):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop("OPENAI_API_KEY", None)
+    return subprocess.run([sys.executable, *extra_args, "-c", code], cwd=cwd, env=env,
+                          capture_output=True, text=True, check=True)
+
+def parse_importtime(stderr):
+    """{module: (self us, cumulative us)} from `python -X importtime` output."""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        times[fields[2].strip()] = (self_us, cumulative_us)
+    return times
+
+def measure_import(module, cwd, repeat=5):
+    """
+    Median cold import time of a module in ms, each in a fresh interpreter
+    started in the empty directory `cwd`, and the last run's breakdown.
+    """
+    samples, times = [], {}
+    for _ in range(repeat):
+        times = parse_importtime(_run(f"import {module}", cwd, ("-X", "importtime")).stderr)
+        samples.append(times[module][1] / 1000)
+    return statistics.median(samples), times
+
+def loaded_heavy_modules(module, cwd):
+    """Heavy libraries that importing `module` loads."""
+    out = _run(f"import sys, {module}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))", cwd)
+    return out.stdout.split()
+
+def files_created_by_import(module, cwd):
+    """Files that importing `module` creates in the empty directory `cwd`."""
+    _run(f"import {module}", cwd)
+    return sorted(os.listdir(cwd))
+
+def run_benchmark():
+    print(f"{'module':<14} {'median ms':>10} {'budget':>8}  slowest imports (self ms)")
+    for module in BUDGETS_MS:
+        with tempfile.TemporaryDirectory() as cwd:
+            median, times = measure_import(module, cwd)
+            heavy = loaded_heavy_modules(module, cwd)
+        slowest = sorted(((self_us, name) for name, (self_us, _) in times.items()), reverse=True)[:3]
+        detail = ", ".join(f"{name} {self_us / 1000:.1f}" for self_us, name in slowest)
+        status = "ok" if median <= budget_ms(module) else "OVER"
+        print(f"{module:<14} {median:10.1f} {budget_ms(module):8.0f}  {status:<4} {detail}")
+        if heavy:
+            print(f"{'':<14} loads {', '.join(heavy)} at import")
+
+if __name__ == "__main__":
+    run_benchmark()
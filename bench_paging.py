@@ -0,0 +1,57 @@
+import os
+import time
+import sqlite3
+import tempfile
+import statistics
+from bench_columnar import make_database
+
+ROWS = 1_000_000
+PAGE_SIZE = 50
+SQL = "SELECT id, Product, Store_Location, Units_Sold, Price FROM sales"
+
+def offset_page(db_path, page, sort):
+    """The alternative: re-run the query and skip to the page with OFFSET."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(f"SELECT * FROM ({SQL}) ORDER BY {sort} LIMIT ? OFFSET ?",
+                            (PAGE_SIZE, page * PAGE_SIZE)).fetchall()
+    finally:
+        conn.close()
+
+def keyset_page(db_path, conversation, page, sort):
+    import paging
+    # Bypass the page cache so every call reads from disk
+    paging._cache.clear()
+    return paging.get_page(db_path, conversation, SQL, page, sort=sort, page_size=PAGE_SIZE)
+
+def time_ms(fn, *args, repeat=5):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def run_benchmark(rows=ROWS):
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+    import paging
+    import scratch
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    make_database(db_path, rows)
+    conversation = scratch.conversation_id("bench", db_path)
+
+    start = time.perf_counter()
+    paging.open_result(db_path, conversation, SQL)
+    print(f"Storing the result for paging: {time.perf_counter() - start:.2f} s (once per answer)")
+    start = time.perf_counter()
+    keyset_page(db_path, conversation, 0, "Price")
+    print(f"Building the Price sort order: {time.perf_counter() - start:.2f} s (once per sort column)")
+
+    last = paging.page_count(rows, PAGE_SIZE) - 1
+    print(f"{'page':>8} {'offset ms':>10} {'keyset ms':>10}")
+    for page in (0, last // 100, last // 2, last):
+        print(f"{page:>8} {time_ms(offset_page, db_path, page, 'Price'):>10.1f} "
+              f"{time_ms(keyset_page, db_path, conversation, page, 'Price'):>10.1f}")
+
+if __name__ == "__main__":
+    run_benchmark()
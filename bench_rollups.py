@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import math
+import sqlite3
+import tempfile
+
+from bench_columnar import make_database
+
+ROW_COUNTS = [200_000, 1_000_000]
+
+# Shapes of the aggregate queries refine_query asks for
+QUERIES = [
+    "SELECT Product, SUM(Units_Sold) AS total_units FROM sales GROUP BY Product ORDER BY total_units DESC LIMIT 10",
+    "SELECT Product, Store_Location, SUM(Units_Sold) FROM sales GROUP BY Product, Store_Location",
+    "SELECT Store_Location, AVG(Price) AS avg_price, COUNT(*) AS sales FROM sales GROUP BY Store_Location",
+    "SELECT Sale_Date, MAX(Price), MIN(Units_Sold) FROM sales WHERE Store_Location = 'North' GROUP BY Sale_Date",
+    "SELECT COUNT(*) FROM sales WHERE Product LIKE '%12%'",
+]
+
+def same_rows(a, b):
+    if len(a) != len(b):
+        return False
+    for row_a, row_b in zip(sorted(a, key=repr), sorted(b, key=repr)):
+        for x, y in zip(row_a, row_b):
+            if isinstance(x, float) or isinstance(y, float):
+                if not math.isclose(x, y, rel_tol=1e-9):
+                    return False
+            elif x != y:
+                return False
+    return True
+
+def timed(conn, sql, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+def run_benchmark(row_counts=ROW_COUNTS):
+    import derived
+    from rollups import ensure_rollups, rewrite_query
+    for rows in row_counts:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        make_database(db_path, rows)
+        start = time.perf_counter()
+        ensure_rollups(db_path)
+        build = time.perf_counter() - start
+
+        # Append 1% more rows and time the incremental merge
+        extra = os.path.join(os.path.dirname(db_path), 'extra.db')
+        make_database(extra, rows // 100, seed=1)
+        conn = sqlite3.connect(db_path)
+        conn.execute("ATTACH DATABASE ? AS extra", (extra,))
+        conn.execute("INSERT INTO sales (Product, Store_Location, Units_Sold, Price, Sale_Date) "
+                     "SELECT Product, Store_Location, Units_Sold, Price, Sale_Date FROM extra.sales")
+        conn.commit()
+        conn.close()
+        start = time.perf_counter()
+        outcome = ensure_rollups(db_path)
+        merge = time.perf_counter() - start
+        print(f"{rows:,} rows: rollups built in {build:.2f}s, 1% append {outcome['sales']} in {merge:.2f}s")
+
+        conn = derived.connect(db_path)
+        for sql in QUERIES:
+            rewritten = rewrite_query(sql, conn)
+            base_rows, base_time = timed(conn, sql)
+            if rewritten == sql:
+                print(f"  {base_time * 1000:8.1f} ms  (no rollup)  {sql[:70]}")
+                continue
+            rollup_rows, rollup_time = timed(conn, rewritten)
+            check = "ok" if same_rows(base_rows, rollup_rows) else "MISMATCH"
+            print(f"  {base_time * 1000:8.1f} ms -> {rollup_time * 1000:6.1f} ms  {check:<8} {sql[:70]}")
+        conn.close()
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    run_benchmark()
@@ -1,31 +1,35 @@
 import hashlib
-import streamlit as st
 import json
-from database_cache import store_in_db_cache, get_from_db_cache, init_cache_db
+from database_cache import store_in_db_cache, get_from_db_cache, record_cache_hit
+from metrics import span
 
-# Initialize cache database
-init_cache_db()
-
-def get_cache_key(query, schema):
-    """Generate a unique cache key based on the query and schema."""
-    combined = f"{query}|{schema}"
+def get_cache_key(query, schema, data_version=None):
+    """
+    Generate a unique cache key based on the query and schema. With a data
+    version, the key is for the answer on that data; without one, it
+    identifies the question across versions.
+    """
+    combined = f"{query}|{schema}" if data_version is None else f"{query}|{schema}|{data_version}"
     return hashlib.md5(combined.encode()).hexdigest()
 
-def cache_response(query, schema, sql_query, summary, visualization, follow_up, results, columns):
-    """Cache the query response in database only."""
+def cache_response(query, schema, sql_query, summary, visualization, follow_up, results, columns,
+                   data_version=None):
+    """Cache the query response in database only, one entry per data version it was computed on."""
     try:
-        cache_key = get_cache_key(query, schema)
+        cache_key = get_cache_key(query, schema, data_version)
         schema_hash = hashlib.sha256(schema.encode()).hexdigest()
         
         cached_data = {
             'query': query,
+            'question_key': get_cache_key(query, schema),
             'schema_hash': schema_hash,
             'sql_query': sql_query,
             'summary': summary,
             'visualization': visualization,
             'follow_up_questions': follow_up,
             'results': results,
-            'columns': columns
+            'columns': columns,
+            'data_version': data_version
         }
         
         # Store in database only
@@ -35,15 +39,33 @@ def cache_response(query, schema, sql_query, summary, visualization, follow_up,
         print(f"Error caching response: {e}")
         return False
 
-def get_cached_response(query, schema):
-    """Retrieve cached response from database."""
+def _is_complete(response):
+    # Ensure visualization data has required fields
+    if 'visualization' in response:
+        return bool(response['visualization']) and 'data' in response['visualization']
+    return True
+
+def get_cached_response(query, schema, data_version=None):
+    """
+    Retrieve cached response from database. With a data version, only an
+    answer computed on that data, or cached before versions were recorded,
+    is returned.
+    """
     try:
-        cache_key = get_cache_key(query, schema)
-        response = get_from_db_cache(cache_key)
-        if response and 'visualization' in response:
-            # Ensure visualization data has required fields
-            if 'data' not in response['visualization']:
-                return None
+        with span('cache_lookup') as s:
+            keys = [get_cache_key(query, schema, data_version)]
+            if data_version is not None:
+                keys.append(get_cache_key(query, schema))
+            response = None
+            for cache_key in keys:
+                candidate = get_from_db_cache(cache_key)
+                if candidate and candidate.pop('data_version', None) in (None, data_version) \
+                        and _is_complete(candidate):
+                    # Only answers actually served count towards popularity
+                    record_cache_hit(cache_key)
+                    response = candidate
+                    break
+            s['cache_hit'] = response is not None
         return response
     except Exception as e:
         print(f"Error retrieving from cache: {e}")
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# The tables, columns, indexes and foreign keys of a database, read in one
+# query through SQLite's table-valued pragma functions rather than one PRAGMA
+# per table. The catalog, and the schema text and declared types built from
+# it, are kept in memory until the database's schema_version changes, so a
+# database with thousands of tables is only introspected once per change.
+CATALOG_CACHE_DATABASES = int(os.getenv("CATALOG_CACHE_DATABASES", "32"))
+
+CATALOG_QUERY = '''
+SELECT m.rowid, 0, m.name, c.cid, c.name, c.type, c."notnull", NULL, c.pk
+FROM main.sqlite_master m, pragma_table_info(m.name, 'main') c
+WHERE m.type = 'table'
+UNION ALL
+SELECT m.rowid, 1, m.name, i.seq, i.name, ic.name, i."unique", ic.seqno, i.origin
+FROM main.sqlite_master m, pragma_index_list(m.name, 'main') i
+LEFT JOIN pragma_index_info(i.name, 'main') ic
+WHERE m.type = 'table'
+UNION ALL
+SELECT m.rowid, 2, m.name, f.id, f."from", f."table", NULL, f.seq, f."to"
+FROM main.sqlite_master m, pragma_foreign_key_list(m.name, 'main') f
+WHERE m.type = 'table'
+'''
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def read_catalog(conn):
+    """
+    Tables of the connection's main database, in creation order, as
+    {name: {'columns': [...], 'indexes': {...}, 'foreign_keys': [...]}}.
+    """
+    tables = OrderedDict()
+    # Rows are (table rowid, kind, table, number, name, detail, flag, seq, extra):
+    # columns carry notnull as the flag and pk as extra, indexes unique and
+    # origin, foreign keys the referenced column as extra. Sorting here is
+    # cheaper than an ORDER BY over the union.
+    rows = sorted(conn.execute(CATALOG_QUERY), key=lambda row: (row[0], row[1], row[3], row[7] or 0))
+    for _, kind, table, number, name, detail, flag, seq, extra in rows:
+        entry = tables.setdefault(table, {'columns': [], 'indexes': {}, 'foreign_keys': []})
+        if kind == 0:
+            entry['columns'].append({'name': name, 'type': detail, 'notnull': bool(flag), 'pk': extra})
+        elif kind == 1:
+            index = entry['indexes'].setdefault(name, {'unique': bool(flag), 'origin': extra, 'columns': []})
+            if detail is not None:
+                index['columns'].append(detail)
+        else:
+            if not entry['foreign_keys'] or entry['foreign_keys'][-1]['id'] != number:
+                entry['foreign_keys'].append({'id': number, 'table': detail, 'columns': [], 'references': []})
+            entry['foreign_keys'][-1]['columns'].append(name)
+            entry['foreign_keys'][-1]['references'].append(extra)
+    return tables
+
+def render_schema(tables):
+    """Schema text as passed to the prompts and used in cache keys."""
+    lines = []
+    for table, entry in tables.items():
+        lines.append(f"Table: {table}\n")
+        lines.extend(f"  - {column['name']} ({column['type']})\n" for column in entry['columns'])
+    return "".join(lines)
+
+def declared_types(tables):
+    """
+    Column names mapped to their declared type across all tables. Names
+    declared with different types in different tables are left out.
+    """
+    types = {}
+    conflicting = set()
+    for entry in tables.values():
+        for column in entry['columns']:
+            name, decltype = column['name'], (column['type'] or '').upper()
+            if name in types and types[name] != decltype:
+                conflicting.add(name)
+            types[name] = decltype
+    return {name: t for name, t in types.items() if name not in conflicting}
+
+def _build(conn):
+    tables = read_catalog(conn)
+    return {'tables': tables, 'schema': render_schema(tables), 'declared_types': declared_types(tables)}
+
+def _main_file(conn):
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == 'main':
+            return path or None
+    return None
+
+def get_catalog(db_path=None, conn=None):
+    """
+    The catalog of a database as {'tables', 'schema', 'declared_types'},
+    from an open connection's main database or from db_path. Rebuilt only
+    when the schema changes; treat it as read-only.
+    """
+    own_conn = conn is None
+    conn = sqlite3.connect(db_path) if own_conn else conn
+    try:
+        path = _main_file(conn)
+        if path is None:
+            # In-memory databases have nothing to key a cache entry on
+            return _build(conn)
+        # A file replaced at the same path starts its own schema_version count
+        key = (conn.execute("PRAGMA main.schema_version").fetchone()[0], os.stat(path).st_ino)
+        with _cache_lock:
+            cached = _cache.get(path)
+            if cached and cached[0] == key:
+                _cache.move_to_end(path)
+                return cached[1]
+        catalog = _build(conn)
+        with _cache_lock:
+            _cache[path] = (key, catalog)
+            _cache.move_to_end(path)
+            while len(_cache) > CATALOG_CACHE_DATABASES:
+                _cache.popitem(last=False)
+        return catalog
+    finally:
+        if own_conn:
+            conn.close()
@@ -0,0 +1,214 @@
+import sqlite3
+import json
+import base64
+import uuid
+from datetime import datetime
+from functools import lru_cache
+from utils import connect_initialized, get_db_path
+
+CHAT_DB = get_db_path('chat_history.db')
+
+# Default number of messages shown, and how many more "load older" adds
+PAGE_SIZE = 20
+
+def init_chat_db():
+    """Initialize the chat history database with message and payload tables."""
+    # Workers starting together would otherwise race to add the same columns
+    conn = sqlite3.connect(CHAT_DB, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+
+    # Message bodies are small and read on every rerun; visualization data and
+    # chart specs live in a separate table and are only read when displayed
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT UNIQUE NOT NULL,
+        username TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT,
+        has_visualization INTEGER DEFAULT 0,
+        created_at TIMESTAMP
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (username, seq)')
+    # The SQL behind an answer, so its rows can be browsed later
+    existing = [row[1] for row in cursor.execute("PRAGMA table_info(messages)")]
+    if 'sql_query' not in existing:
+        cursor.execute("ALTER TABLE messages ADD COLUMN sql_query TEXT")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS message_payloads (
+        message_id TEXT PRIMARY KEY,
+        visualization TEXT,
+        chart_spec TEXT
+    )
+    ''')
+    # When the payload last changed, so processes can tell their memoized
+    # chart specs are out of date
+    existing = [row[1] for row in cursor.execute("PRAGMA table_info(message_payloads)")]
+    if 'updated_at' not in existing:
+        cursor.execute("ALTER TABLE message_payloads ADD COLUMN updated_at TIMESTAMP")
+
+    cursor.execute("COMMIT")
+    conn.close()
+
+def _connect():
+    return connect_initialized(CHAT_DB, init_chat_db)
+
+def _encode_spec(spec):
+    """Serialize a chart spec whose datasets are Arrow bytes."""
+    if spec is None:
+        return None
+    encoded = dict(spec)
+    encoded['datasets'] = {
+        name: base64.b64encode(data).decode('ascii') if isinstance(data, bytes) else data
+        for name, data in spec.get('datasets', {}).items()
+    }
+    return json.dumps(encoded, default=str)
+
+def _decode_spec(text):
+    if text is None:
+        return None
+    spec = json.loads(text)
+    spec['datasets'] = {
+        name: base64.b64decode(data) if isinstance(data, str) else data
+        for name, data in spec.get('datasets', {}).items()
+    }
+    return spec
+
+def add_message(username, role, content, visualization=None, chart_spec=None, sql_query=None):
+    """Store a chat message and its optional payload. Returns the message id."""
+    message_id = uuid.uuid4().hex
+    conn = _connect()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        INSERT INTO messages (id, username, role, content, has_visualization, created_at, sql_query)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            message_id, username, role, content,
+            1 if visualization else 0,
+            datetime.now().isoformat(),
+            sql_query
+        ))
+        if visualization:
+            cursor.execute('''
+            INSERT INTO message_payloads (message_id, visualization, chart_spec, updated_at)
+            VALUES (?, ?, ?, ?)
+            ''', (message_id, json.dumps(visualization, default=str), _encode_spec(chart_spec),
+                  datetime.now().isoformat()))
+        conn.commit()
+        return message_id
+    finally:
+        conn.close()
+
+def count_messages(username):
+    """Number of messages stored for a user."""
+    conn = _connect()
+    try:
+        return conn.execute('SELECT COUNT(*) FROM messages WHERE username = ?', (username,)).fetchone()[0]
+    finally:
+        conn.close()
+
+def get_recent_messages(username, limit=PAGE_SIZE):
+    """
+    Return the user's most recent `limit` messages, oldest first.
+
+    Only message bodies are loaded; use get_chart_spec or get_visualization
+    for the payload of messages that have one.
+    """
+    conn = _connect()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        SELECT id, role, content, has_visualization, created_at, sql_query
+        FROM messages
+        WHERE username = ?
+        ORDER BY seq DESC
+        LIMIT ?
+        ''', (username, limit))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {
+            'id': row[0],
+            'role': row[1],
+            'content': row[2],
+            'has_visualization': bool(row[3]),
+            'timestamp': row[4],
+            'sql_query': row[5]
+        }
+        for row in reversed(rows)
+    ]
+
+def get_visualization(message_id):
+    """Load the stored visualization data and settings of a message."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            'SELECT visualization FROM message_payloads WHERE message_id = ?', (message_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row and row[0] else None
+
+def get_chart_spec(message_id):
+    """
+    Load the chart spec of a message. Decoded specs are memoized per process
+    and shared by its sessions, keyed by when the payload last changed so a
+    spec replaced by another process is read again.
+    """
+    conn = _connect()
+    try:
+        row = conn.execute(
+            'SELECT updated_at FROM message_payloads WHERE message_id = ?', (message_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return _load_chart_spec(message_id, row[0]) if row else None
+
+@lru_cache(maxsize=256)
+def _load_chart_spec(message_id, updated_at):
+    conn = _connect()
+    try:
+        row = conn.execute(
+            'SELECT chart_spec FROM message_payloads WHERE message_id = ?', (message_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return _decode_spec(row[0]) if row else None
+
+def save_chart_spec(message_id, chart_spec):
+    """Store a chart spec built after the message was saved."""
+    conn = _connect()
+    try:
+        conn.execute(
+            'UPDATE message_payloads SET chart_spec = ?, updated_at = ? WHERE message_id = ?',
+            (_encode_spec(chart_spec), datetime.now().isoformat(), message_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def update_message(message_id, content, visualization=None, chart_spec=None):
+    """Replace the content and payload of a stored message, e.g. when an exact answer arrives."""
+    conn = _connect()
+    try:
+        conn.execute(
+            'UPDATE messages SET content = ?, has_visualization = ? WHERE id = ?',
+            (content, 1 if visualization else 0, message_id)
+        )
+        conn.execute('DELETE FROM message_payloads WHERE message_id = ?', (message_id,))
+        if visualization:
+            conn.execute('''
+            INSERT INTO message_payloads (message_id, visualization, chart_spec, updated_at)
+            VALUES (?, ?, ?, ?)
+            ''', (message_id, json.dumps(visualization, default=str), _encode_spec(chart_spec),
+                  datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
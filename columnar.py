@@ -0,0 +1,159 @@
+import sqlite3
+import pyarrow as pa
+import pyarrow.compute as pc
+from catalog import get_catalog
+
+# Rows pulled from the cursor per fetchmany call
+BATCH_SIZE = 10000
+
+def declared_column_types(conn):
+    """
+    Map column names to their declared SQLite type across all tables.
+
+    Names declared with different types in different tables are left out,
+    since a result column cannot be traced back to one of them. Read from
+    the catalog, which is only rebuilt when the schema changes.
+    """
+    return get_catalog(conn=conn)['declared_types']
+
+def arrow_type_for(decltype):
+    """Arrow type for a declared SQLite type, following SQLite's affinity rules."""
+    if not decltype:
+        return None
+    if 'INT' in decltype:
+        return pa.int64()
+    if 'CHAR' in decltype or 'CLOB' in decltype or 'TEXT' in decltype:
+        return pa.string()
+    if 'REAL' in decltype or 'FLOA' in decltype or 'DOUB' in decltype:
+        return pa.float64()
+    # BLOB and NUMERIC affinity columns can hold anything; infer from values
+    return None
+
+def _is_number(arrow_type):
+    return pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)
+
+def _to_array(values, arrow_type):
+    """
+    Build an Arrow array, falling back to inference when values do not fit the type.
+
+    Values are converted untyped and then cast with a safe cast, which fails
+    rather than truncating (e.g. an AVG aliased to an INTEGER column's name).
+    """
+    try:
+        array = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed values in one column (SQLite is dynamically typed): keep them as text
+        array = pa.array([None if v is None else str(v) for v in values], type=pa.string())
+    if arrow_type is None or pa.types.is_null(arrow_type) or array.type == arrow_type:
+        return array
+    # Only numbers move between numeric types; values of another kind keep theirs
+    if pa.types.is_null(array.type) or (_is_number(array.type) and _is_number(arrow_type)):
+        try:
+            return array.cast(arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            pass
+    return array
+
+def _unify(chunks):
+    """Cast the chunks of one column to a common type."""
+    types = {chunk.type for chunk in chunks if not pa.types.is_null(chunk.type)}
+    if not types:
+        return pa.chunked_array(chunks, type=pa.null())
+    if len(types) == 1:
+        target = types.pop()
+    elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        target = pa.float64()
+    else:
+        target = pa.string()
+    return pa.chunked_array([chunk.cast(target) for chunk in chunks], type=target)
+
+def fetch_arrow_table(cursor, declared_types=None):
+    """
+    Read the remaining rows of an executed cursor into an Arrow table, one
+    typed column at a time, in batches of BATCH_SIZE rows.
+    """
+    declared_types = declared_types or {}
+    columns = [description[0] for description in cursor.description]
+    types = [arrow_type_for(declared_types.get(name)) for name in columns]
+    chunks = [[] for _ in columns]
+
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for i, values in enumerate(zip(*rows)):
+            array = _to_array(values, types[i])
+            # Later batches reuse the type inferred from the first one
+            if types[i] is None and not pa.types.is_null(array.type):
+                types[i] = array.type
+            chunks[i].append(array)
+
+    arrays = [
+        _unify(column_chunks) if column_chunks else pa.chunked_array([], type=types[i] or pa.null())
+        for i, column_chunks in enumerate(chunks)
+    ]
+    return coerce_numeric_strings(pa.table(arrays, names=columns), declared_types)
+
+def coerce_numeric_strings(table, declared_types=None):
+    """
+    Turn text columns that hold only numbers into numeric columns.
+
+    Only columns without a declared type (or with NUMERIC affinity) are
+    coerced: a TEXT column such as a zip code keeps its leading zeros.
+    """
+    declared_types = declared_types or {}
+    for i, field in enumerate(table.schema):
+        if not pa.types.is_string(field.type):
+            continue
+        if arrow_type_for(declared_types.get(field.name)) is not None:
+            continue
+        column = table.column(i)
+        if column.null_count == len(column):
+            continue
+        for target in (pa.int64(), pa.float64()):
+            try:
+                table = table.set_column(i, field.name, pc.cast(column, target))
+                break
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                continue
+    return table
+
+def rows_to_table(rows, columns):
+    """Build an Arrow table from a list of row tuples, e.g. legacy cached results."""
+    arrays = [_to_array(list(values), None) for values in zip(*rows)] if rows else \
+        [pa.array([], type=pa.null()) for _ in columns]
+    return coerce_numeric_strings(pa.table(arrays, names=list(columns)))
+
+def numeric_columns(table):
+    return [f.name for f in table.schema
+            if pa.types.is_integer(f.type) or pa.types.is_floating(f.type) or pa.types.is_decimal(f.type)]
+
+def categorical_columns(table):
+    return [f.name for f in table.schema
+            if pa.types.is_string(f.type) or pa.types.is_large_string(f.type)]
+
+def table_to_ipc(table):
+    """Serialize a table to Arrow IPC stream bytes."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def table_from_ipc(data):
+    return pa.ipc.open_stream(data).read_all()
+
+def execute_to_arrow(sql_query, db_path, conn=None):
+    """
+    Run a query and return its result as an Arrow table. An open connection
+    (e.g. one with extra databases attached) may be passed and is left open.
+    """
+    own_conn = conn is None
+    conn = sqlite3.connect(db_path) if own_conn else conn
+    try:
+        declared_types = declared_column_types(conn)
+        cursor = conn.cursor()
+        cursor.execute(sql_query)
+        return fetch_arrow_table(cursor, declared_types)
+    finally:
+        if own_conn:
+            conn.close()
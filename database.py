@@ -1,34 +1,21 @@
-import sqlite3
-import streamlit as st
 import os
-from utils import get_db_path
+from catalog import get_catalog
 
-def handle_database_upload(uploaded_file):
+def handle_database_upload(uploaded_file, username):
+    """Store an uploaded database in the user's storage and return its path."""
+    import storage
     try:
-        db_path = get_db_path(uploaded_file.name)
-        with open(db_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        return db_path
+        return storage.store_upload(username, uploaded_file.name, uploaded_file.getbuffer())
+    except storage.QuotaExceeded:
+        raise
     except Exception as e:
-        st.error(f"Error saving database file: {e}")
+        print(f"Error saving database file: {e}")
         return None
 
 def get_database_schema(db_path):
+    """Schema text of a database, rendered from its catalog (see catalog.py)."""
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        schema = ""
-        for table in tables:
-            table_name = table[0]
-            schema += f"Table: {table_name}\n"
-            cursor.execute(f"PRAGMA table_info({table_name});")
-            columns = cursor.fetchall()
-            for column in columns:
-                schema += f"  - {column[1]} ({column[2]})\n"
-        conn.close()
-        return schema
+        return get_catalog(db_path)['schema']
     except Exception as e:
-        st.error(f"Error extracting database schema: {e}")
+        print(f"Error extracting database schema: {e}")
         return None
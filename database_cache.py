@@ -1,12 +1,19 @@
+import os
+import time
 import sqlite3
 import json
 import hashlib
 from datetime import datetime
+from utils import connect_initialized, get_db_path
+
+CACHE_DB = get_db_path('query_cache.db')
 
 def init_cache_db():
     """Initialize the cache database with required tables."""
-    conn = sqlite3.connect('query_cache.db')
+    # Workers starting together would otherwise race to add the same columns
+    conn = sqlite3.connect(CACHE_DB, timeout=30, isolation_level=None)
     cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
     
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS query_cache (
@@ -23,21 +30,51 @@ def init_cache_db():
         last_accessed TIMESTAMP
     )
     ''')
+
+    # Arrow results are stored as IPC bytes next to the legacy JSON rows
+    existing = [row[1] for row in cursor.execute("PRAGMA table_info(query_cache)")]
+    if 'results_arrow' not in existing:
+        cursor.execute("ALTER TABLE query_cache ADD COLUMN results_arrow BLOB")
+    # Which data an answer was computed on, and how often it has been served,
+    # so the most asked answers can be refreshed when new data arrives
+    if 'data_version' not in existing:
+        cursor.execute("ALTER TABLE query_cache ADD COLUMN data_version TEXT")
+    if 'hit_count' not in existing:
+        cursor.execute("ALTER TABLE query_cache ADD COLUMN hit_count INTEGER DEFAULT 0")
+    # Answers are kept per data version; question_key groups the versions of
+    # one question. Rows from before versions were recorded are their own group.
+    if 'question_key' not in existing:
+        cursor.execute("ALTER TABLE query_cache ADD COLUMN question_key TEXT")
+        cursor.execute("UPDATE query_cache SET question_key = cache_key")
+    cursor.execute("CREATE INDEX IF NOT EXISTS query_cache_question ON query_cache (question_key)")
+
+    # Questions being answered right now, so identical ones can wait for them
+    _init_inflight_table(cursor)
     
-    conn.commit()
+    cursor.execute("COMMIT")
     conn.close()
 
+def _connect(**kwargs):
+    return connect_initialized(CACHE_DB, init_cache_db, **kwargs)
+
 def store_in_db_cache(cache_key, query_data):
     """Store query results in database cache."""
-    conn = sqlite3.connect('query_cache.db')
+    conn = _connect()
     cursor = conn.cursor()
     
+    import pyarrow as pa
+    from columnar import table_to_ipc
+    results = query_data['results']
+    is_arrow = isinstance(results, pa.Table)
+
     try:
         cursor.execute('''
         INSERT OR REPLACE INTO query_cache
         (cache_key, query, schema_hash, sql_query, summary, visualization_data, 
-         follow_up_questions, results, columns, created_at, last_accessed)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+         follow_up_questions, results, results_arrow, columns, created_at, last_accessed,
+         data_version, question_key, hit_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                COALESCE((SELECT hit_count FROM query_cache WHERE cache_key = ?), 0))
         ''', (
             cache_key,
             query_data['query'],
@@ -46,46 +83,178 @@ def store_in_db_cache(cache_key, query_data):
             query_data['summary'],
             json.dumps(query_data['visualization']),
             json.dumps(query_data['follow_up_questions']),
-            json.dumps(query_data['results']),
-            json.dumps(query_data['columns']),
+            None if is_arrow else json.dumps(results),
+            table_to_ipc(results) if is_arrow else None,
+            json.dumps(list(query_data['columns'])),
+            datetime.now().isoformat(),
             datetime.now().isoformat(),
-            datetime.now().isoformat()
+            query_data.get('data_version'),
+            query_data.get('question_key', cache_key),
+            cache_key
         ))
         conn.commit()
     finally:
         conn.close()
 
+CACHED_COLUMNS = '''sql_query, summary, visualization_data, follow_up_questions,
+       results, columns, schema_hash, results_arrow, data_version'''
+
+def _to_response(row):
+    from columnar import table_from_ipc
+    return {
+        'sql_query': row[0],
+        'summary': row[1],
+        'visualization': json.loads(row[2]),
+        'follow_up_questions': json.loads(row[3]),
+        'results': table_from_ipc(row[7]) if row[7] is not None else json.loads(row[4]),
+        'columns': json.loads(row[5]),
+        'data_version': row[8]
+    }
+
 def get_from_db_cache(cache_key):
     """Retrieve query results from database cache."""
-    conn = sqlite3.connect('query_cache.db')
-    cursor = conn.cursor()
-    
+    conn = _connect()
     try:
-        cursor.execute('''
-        SELECT sql_query, summary, visualization_data, follow_up_questions, 
-               results, columns, schema_hash
-        FROM query_cache 
+        row = conn.execute(f"SELECT {CACHED_COLUMNS} FROM query_cache WHERE cache_key = ?",
+                           (cache_key,)).fetchone()
+        return _to_response(row) if row else None
+    finally:
+        conn.close()
+
+def record_cache_hit(cache_key):
+    """Note that a cached answer was served, for recency and popularity."""
+    conn = _connect()
+    try:
+        conn.execute('''
+        UPDATE query_cache
+        SET last_accessed = ?, hit_count = COALESCE(hit_count, 0) + 1
         WHERE cache_key = ?
-        ''', (cache_key,))
-        
-        result = cursor.fetchone()
-        if result:
-            # Update last accessed time
-            cursor.execute('''
-            UPDATE query_cache 
-            SET last_accessed = ? 
-            WHERE cache_key = ?
-            ''', (datetime.now().isoformat(), cache_key))
-            conn.commit()
-            
-            return {
-                'sql_query': result[0],
-                'summary': result[1],
-                'visualization': json.loads(result[2]),
-                'follow_up_questions': json.loads(result[3]),
-                'results': json.loads(result[4]),
-                'columns': json.loads(result[5])
-            }
-        return None
+        ''', (datetime.now().isoformat(), cache_key))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_other_version(question_key, data_version):
+    """The most recently used answer to a question computed on data other than `data_version`, or of unknown version."""
+    conn = _connect()
+    try:
+        row = conn.execute(f'''
+        SELECT {CACHED_COLUMNS} FROM query_cache
+        WHERE question_key = ? AND (data_version IS NULL OR data_version != ?)
+        ORDER BY last_accessed DESC LIMIT 1
+        ''', (question_key, data_version)).fetchone()
+        return _to_response(row) if row else None
+    finally:
+        conn.close()
+
+def get_logged_sql_queries(schema_hash=None, limit=500):
+    """Recently used generated SQL, optionally only for one database schema."""
+    conn = _connect()
+    try:
+        if schema_hash:
+            rows = conn.execute('''
+            SELECT sql_query FROM query_cache WHERE schema_hash = ?
+            ORDER BY last_accessed DESC LIMIT ?
+            ''', (schema_hash, limit)).fetchall()
+        else:
+            rows = conn.execute('''
+            SELECT sql_query FROM query_cache ORDER BY last_accessed DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        return [row[0] for row in rows if row[0]]
+    finally:
+        conn.close()
+
+def get_stale_cached_answers(schema_hash, data_version, limit):
+    """
+    (question_key, query) of the most served questions for a schema that
+    have answers on other data but none on `data_version`. Whether an answer
+    can be re-run is for the caller to tell (refresh.is_replayable).
+    """
+    conn = _connect()
+    try:
+        return conn.execute('''
+        SELECT question_key, MAX(query) FROM query_cache
+        WHERE schema_hash = ?
+        GROUP BY question_key
+        HAVING SUM(COALESCE(data_version = ?, 0)) = 0
+        ORDER BY SUM(COALESCE(hit_count, 0)) DESC, MAX(last_accessed) DESC
+        LIMIT ?
+        ''', (schema_hash, data_version, limit)).fetchall()
+    finally:
+        conn.close()
+
+def _init_inflight_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inflight_queries (
+        cache_key TEXT PRIMARY KEY,
+        owner TEXT,
+        pid INTEGER,
+        expires_at REAL
+    )
+    ''')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+def try_lock_query(cache_key, owner, ttl):
+    """
+    Claim the right to answer a question. Returns True if `owner` now holds the
+    lock; locks past their expiry or held by a process that has exited are taken over.
+    """
+    conn = _connect(timeout=10, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT owner, pid, expires_at FROM inflight_queries WHERE cache_key = ?",
+                           (cache_key,)).fetchone()
+        if row and row[0] != owner and row[2] > time.time() and _pid_alive(row[1]):
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute("INSERT OR REPLACE INTO inflight_queries VALUES (?, ?, ?, ?)",
+                     (cache_key, owner, os.getpid(), time.time() + ttl))
+        conn.execute("COMMIT")
+        return True
+    finally:
+        conn.close()
+
+def unlock_query(cache_key, owner):
+    """Release a lock taken with try_lock_query."""
+    conn = _connect(timeout=10)
+    try:
+        conn.execute("DELETE FROM inflight_queries WHERE cache_key = ? AND owner = ?", (cache_key, owner))
+        conn.commit()
+    finally:
+        conn.close()
+
+def is_query_locked(cache_key):
+    """Whether someone holds a live lock on the question."""
+    conn = _connect(timeout=10)
+    try:
+        row = conn.execute("SELECT pid, expires_at FROM inflight_queries WHERE cache_key = ?",
+                           (cache_key,)).fetchone()
+        return row is not None and row[1] > time.time() and _pid_alive(row[0])
+    finally:
+        conn.close()
+
+def delete_cached_for_version(data_version):
+    """Drop cached answers computed on one database's data, e.g. when it is deleted."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM query_cache WHERE data_version = ?", (data_version,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def delete_cached_for_schema(schema_hash):
+    """Drop cached answers for a database schema, e.g. when its last database is deleted."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM query_cache WHERE schema_hash = ?", (schema_hash,))
+        conn.commit()
     finally:
         conn.close()
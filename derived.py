@@ -0,0 +1,22 @@
+import os
+import sqlite3
+
+# Tables derived from an uploaded database (rollups, indexes over its values)
+# live in a sidecar file next to it, attached as "derived". Uploads are written
+# over the database file, so nothing stored inside it would survive.
+DERIVED_SCHEMA = "derived"
+
+def derived_path(db_path):
+    return f"{db_path}.derived"
+
+def has_derived(db_path):
+    return os.path.exists(derived_path(db_path))
+
+def attach(conn, db_path):
+    """Attach the sidecar database of db_path to an open connection."""
+    conn.execute(f"ATTACH DATABASE ? AS {DERIVED_SCHEMA}", (derived_path(db_path),))
+    return conn
+
+def connect(db_path):
+    """Open a database with its sidecar attached, creating the sidecar if needed."""
+    return attach(sqlite3.connect(db_path), db_path)
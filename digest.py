@@ -0,0 +1,225 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Rough prompt budget for the digest; about four characters per token
+DIGEST_TOKEN_BUDGET = int(os.getenv("SUMMARY_DIGEST_TOKENS", "400"))
+CHARS_PER_TOKEN = 4
+
+TOP_CATEGORIES = 5
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+TIME_HINTS = ('date', 'time', 'day', 'week', 'month', 'quarter', 'year', 'period')
+
+def _fmt(value):
+    """Compact number formatting for the prompt."""
+    if value is None:
+        return "n/a"
+    # bool is a subclass of int
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value)).lower()
+    if isinstance(value, (int, np.integer)):
+        return f"{value:,}"
+    if isinstance(value, (float, np.floating)):
+        if not np.isfinite(value):
+            return str(value)
+        if abs(value) >= 1000:
+            return f"{value:,.0f}"
+        return f"{value:.3g}"
+    text = str(value)
+    return text if len(text) <= 40 else text[:37] + "..."
+
+def _is_numeric(field):
+    return pa.types.is_integer(field.type) or pa.types.is_floating(field.type) or pa.types.is_decimal(field.type)
+
+def _is_text(field):
+    return pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+
+def _time_column(table):
+    """Pick a column that orders the rows in time, if there is one."""
+    for field in table.schema:
+        name = field.name.lower()
+        if pa.types.is_temporal(field.type):
+            return field.name
+        if any(hint in name for hint in TIME_HINTS) and (_is_text(field) or pa.types.is_integer(field.type)):
+            return field.name
+    return None
+
+def _is_identifier(name):
+    name = name.lower()
+    return name in ('id', 'rowid') or name.endswith('_id')
+
+def _unique_names(names):
+    """Column names with repeats numbered (id, id_2), as joins can return the same name twice."""
+    used, unique = set(names), []
+    for name in names:
+        candidate, n = name, 1
+        while candidate in unique or (n > 1 and candidate in used):
+            n += 1
+            candidate = f"{name}_{n}"
+        unique.append(candidate)
+    return unique
+
+def numeric_stats(column):
+    """Min, max, mean, total, quantiles and IQR outlier count of a numeric column."""
+    values = pc.drop_null(column)
+    if len(values) == 0:
+        return None
+    if pa.types.is_decimal(values.type):
+        values = pc.cast(values, pa.float64())
+    min_max = pc.min_max(values)
+    quantiles = pc.quantile(values, q=QUANTILES).to_pylist()
+    q1, q3 = quantiles[1], quantiles[3]
+    iqr = q3 - q1
+    low, high = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    outliers = pc.sum(pc.or_(pc.less(values, low), pc.greater(values, high))).as_py() if iqr > 0 else 0
+    return {
+        'min': min_max['min'].as_py(),
+        'max': min_max['max'].as_py(),
+        'mean': pc.mean(values).as_py(),
+        'sum': pc.sum(values).as_py(),
+        'quantiles': dict(zip(QUANTILES, quantiles)),
+        'nulls': column.null_count,
+        'outliers': outliers,
+        'outlier_bounds': (low, high)
+    }
+
+def top_categories(table, column, measure=None, k=TOP_CATEGORIES):
+    """
+    Most important categories of a text column with their share: by the
+    total of `measure` when given, otherwise by row count. NULL is not a
+    category.
+    """
+    table = table.filter(pc.is_valid(table.column(column)))
+    if measure:
+        grouped = table.group_by(column).aggregate([(measure, 'sum')])
+        weights = grouped.column(f"{measure}_sum")
+        labels = grouped.column(column)
+    else:
+        counts = pc.value_counts(table.column(column))
+        labels = counts.field('values')
+        weights = counts.field('counts')
+    total = pc.sum(weights).as_py() or 0
+    order = pc.array_sort_indices(weights, order="descending")
+    top = order[:k].to_pylist()
+    labels, weights = labels.to_pylist(), weights.to_pylist()
+    return [
+        (labels[i], weights[i], (weights[i] / total) if total else None)
+        for i in top
+    ], len(labels)
+
+def trend(table, time_col, measure):
+    """Direction and size of change of a measure's mean along the time column."""
+    grouped = table.group_by(time_col).aggregate([(measure, 'mean')]).sort_by(time_col)
+    keys = grouped.column(time_col).to_pylist()
+    values = grouped.column(f"{measure}_mean").to_numpy(zero_copy_only=False).astype(float)
+    mask = ~np.isnan(values)
+    if mask.sum() < 3:
+        return None
+    keys = [k for k, keep in zip(keys, mask) if keep]
+    values = values[mask]
+    slope = np.polyfit(np.arange(len(values)), values, 1)[0]
+    # Compare the first and last tenth of the periods so one noisy period
+    # does not decide the reported change
+    window = max(1, len(values) // 10)
+    start, end = values[:window].mean(), values[-window:].mean()
+    change = (end - start) / abs(start) if start else None
+    return {
+        'direction': 'rising' if slope > 0 else 'falling' if slope < 0 else 'flat',
+        'start': (keys[0], start),
+        'end': (keys[-1], end),
+        'change': change,
+        'peak': (keys[int(np.argmax(values))], float(values.max()))
+    }
+
+def build_digest(table, max_tokens=None):
+    """
+    Summarize a whole result table in a fixed prompt budget.
+
+    Statistics are computed over every row; lines are then added in order of
+    importance (shape, per-column stats, top categories, outliers and trends,
+    example rows) until the budget is used up.
+    """
+    max_chars = (max_tokens or DIGEST_TOKEN_BUDGET) * CHARS_PER_TOKEN
+    if len(set(table.column_names)) < table.num_columns:
+        table = table.rename_columns(_unique_names(table.column_names))
+    fields = list(table.schema)
+    numeric = [f.name for f in fields if _is_numeric(f)]
+    text = [f.name for f in fields if _is_text(f)]
+    time_col = _time_column(table)
+    measures = [name for name in numeric
+                if name != time_col and not _is_identifier(name)
+                and table.column(name).null_count < table.num_rows]
+    measure = measures[0] if measures else None
+
+    shape = f"{table.num_rows:,} rows x {table.num_columns} columns: {', '.join(table.column_names)}"
+    if not table.num_rows:
+        return f"{shape}\nThe query returned no rows."
+    tiers = [[shape], [], [], [], []]
+    stats_by_column = {}
+
+    for field in fields:
+        name = field.name
+        if name in numeric:
+            stats = numeric_stats(table.column(name))
+            if not stats:
+                tiers[1].append(f"{name}: all null")
+                continue
+            stats_by_column[name] = stats
+            q = stats['quantiles']
+            tiers[1].append(
+                f"{name}: min {_fmt(stats['min'])}, p25 {_fmt(q[0.25])}, median {_fmt(q[0.5])}, "
+                f"p75 {_fmt(q[0.75])}, max {_fmt(stats['max'])}, mean {_fmt(stats['mean'])}, "
+                f"total {_fmt(stats['sum'])}" + (f", {stats['nulls']:,} null" if stats['nulls'] else "")
+            )
+        elif name == time_col:
+            values = pc.drop_null(table.column(name))
+            if len(values):
+                bounds = pc.min_max(values)
+                tiers[1].append(f"{name}: from {_fmt(bounds['min'].as_py())} to {_fmt(bounds['max'].as_py())}")
+        elif name in text:
+            categories, distinct = top_categories(table, name, measure)
+            basis = f"share of {measure}" if measure else "share of rows"
+            nulls = table.column(name).null_count
+            tiers[1].append(f"{name}: {distinct:,} distinct values" + (f", {nulls:,} null" if nulls else ""))
+            if categories:
+                listed = "; ".join(
+                    f"{_fmt(label)} {_fmt(weight)}" + (f" ({share:.0%})" if share is not None else "")
+                    for label, weight, share in categories
+                )
+                tiers[2].append(f"top {name} by {basis}: {listed}")
+        else:
+            tiers[1].append(f"{name}: {field.type}, {table.column(name).null_count:,} null")
+
+    for name, stats in stats_by_column.items():
+        if stats['outliers']:
+            low, high = stats['outlier_bounds']
+            tiers[3].append(
+                f"{name}: {stats['outliers']:,} outliers outside [{_fmt(low)}, {_fmt(high)}]"
+            )
+
+    if time_col:
+        for name in measures[:2]:
+            result = trend(table, time_col, name)
+            if result:
+                change = f" ({result['change']:+.0%})" if result['change'] is not None else ""
+                tiers[3].append(
+                    f"{name} over {time_col}: {result['direction']}, about {_fmt(result['start'][1])} near "
+                    f"{_fmt(result['start'][0])} to {_fmt(result['end'][1])} near {_fmt(result['end'][0])}"
+                    f"{change}; peak {_fmt(result['peak'][1])} at {_fmt(result['peak'][0])}"
+                )
+
+    for row in table.slice(0, 3).to_pylist():
+        tiers[4].append("example row: " + ", ".join(f"{k}={_fmt(v)}" for k, v in row.items()))
+
+    lines, used, skipped = [], 0, 0
+    for tier in tiers:
+        for line in tier:
+            if used + len(line) + 1 > max_chars:
+                skipped += 1
+                continue
+            lines.append(line)
+            used += len(line) + 1
+    if skipped:
+        lines.append(f"({skipped} further facts omitted for length)")
+    return "\n".join(lines)
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Point budgets per chart type; results at or below these are charted as-is
+MAX_LINE_POINTS = int(os.getenv("VIZ_MAX_LINE_POINTS", "1000"))
+MAX_BARS = int(os.getenv("VIZ_MAX_BARS", "30"))
+MAX_SCATTER_POINTS = int(os.getenv("VIZ_MAX_SCATTER_POINTS", "2000"))  # also heatmaps
+HEATMAP_BINS = int(os.getenv("VIZ_HEATMAP_BINS", "40"))
+
+# Column added by binning; charts use it as the weight of each cell
+COUNT_COL = "_count"
+OTHER_LABEL = "Other"
+
+def _as_numeric(series):
+    """Return a float array for numeric or datetime-like series, otherwise None."""
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return series.to_numpy(dtype=float)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy(dtype="datetime64[ns]").astype("int64").astype(float)
+    if series.dtype == object:
+        # Check a sample first so text columns are not parsed in full
+        sample = series.dropna().head(50)
+        if sample.empty or pd.to_datetime(sample, errors="coerce", format="mixed").isna().any():
+            return None
+        parsed = pd.to_datetime(series, errors="coerce", format="mixed")
+        if parsed.notna().all():
+            return parsed.to_numpy(dtype="datetime64[ns]").astype("int64").astype(float)
+    return None
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: pick `threshold` indices of a series
+    sorted by x that preserve its visual shape.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Bucket boundaries for the n - 2 interior points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    starts, ends = edges[:-1], edges[1:]
+
+    # Average of every bucket, used as the third triangle vertex
+    csum_x = np.concatenate(([0.0], np.cumsum(x)))
+    csum_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = ends - starts
+    avg_x = (csum_x[ends] - csum_x[starts]) / counts
+    avg_y = (csum_y[ends] - csum_y[starts]) / counts
+    avg_x = np.append(avg_x[1:], x[-1])
+    avg_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        bx, by = x[start:end], y[start:end]
+        areas = np.abs(
+            (x[previous] - avg_x[i]) * (by - y[previous])
+            - (x[previous] - bx) * (avg_y[i] - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+def reduce_line(df, x_col, y_col, threshold=None):
+    """Downsample a line chart with LTTB, ordered by the x column."""
+    threshold = threshold or MAX_LINE_POINTS
+    if len(df) <= threshold:
+        return df
+    y = _as_numeric(df[y_col])
+    if y is None:
+        return df
+    x = _as_numeric(df[x_col])
+    if x is None:
+        # Categorical x: keep the row order and downsample by position
+        ordered = df.reset_index(drop=True)
+        x = np.arange(len(ordered), dtype=float)
+    else:
+        order = np.argsort(x, kind="stable")
+        ordered = df.iloc[order].reset_index(drop=True)
+        x = x[order]
+        y = y[order]
+    valid = ~np.isnan(y)
+    if not valid.all():
+        ordered, x, y = ordered[valid].reset_index(drop=True), x[valid], y[valid]
+    return ordered.iloc[lttb_indices(x, y, threshold)].reset_index(drop=True)
+
+def reduce_bar(df, x_col, y_col, k=None):
+    """Keep the k largest bars and fold the remainder into a single 'Other' bar."""
+    k = k or MAX_BARS
+    if len(df) <= k or not pd.api.types.is_numeric_dtype(df[y_col]):
+        return df
+    totals = df.groupby(x_col, sort=False, dropna=False)[y_col].sum()
+    if len(totals) <= k:
+        return totals.reset_index()
+    top = totals.nlargest(k - 1)
+    other = totals.drop(top.index).sum()
+    top_df = top.reset_index()
+    # Numeric categories become labels so that 'Other' can share the axis
+    top_df[x_col] = top_df[x_col].astype(str)
+    other_df = pd.DataFrame({x_col: [OTHER_LABEL], y_col: [other]})
+    return pd.concat([top_df, other_df], ignore_index=True)
+
+def _bin_axis(series, bins):
+    """
+    Map a column with many distinct values onto at most `bins` values: bin
+    centres for numeric columns, the most frequent categories plus 'Other'
+    for everything else.
+    """
+    if series.nunique(dropna=True) <= bins:
+        return series
+    values = _as_numeric(series)
+    if values is None:
+        top = series.value_counts().index[:bins - 1]
+        return series.where(series.isin(top), OTHER_LABEL)
+    finite = values[~np.isnan(values)]
+    if finite.size == 0:
+        return series
+    edges = np.linspace(finite.min(), finite.max(), bins + 1)
+    codes = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, bins - 1)
+    centres = (edges[:-1] + edges[1:]) / 2
+    binned = np.where(np.isnan(values), np.nan, centres[codes])
+    if pd.api.types.is_datetime64_any_dtype(series) or series.dtype == object:
+        return pd.Series(pd.to_datetime(binned), index=series.index, name=series.name)
+    return pd.Series(binned, index=series.index, name=series.name)
+
+def reduce_2d(df, x_col, y_col, bins=None):
+    """Aggregate points into a 2-D grid of cells with a point count per cell."""
+    bins = bins or HEATMAP_BINS
+    if COUNT_COL in df.columns:
+        return df
+    binned = pd.DataFrame({
+        x_col: _bin_axis(df[x_col], bins),
+        y_col: _bin_axis(df[y_col], bins)
+    })
+    return binned.groupby([x_col, y_col], dropna=False).size().reset_index(name=COUNT_COL)
+
+def reduce_for_chart(df, chart_type, x_col, y_col):
+    """
+    Reduce a result set to what the chart can usefully draw.
+
+    Returns the (possibly) reduced DataFrame; small inputs are returned unchanged.
+    """
+    if df is None or df.empty or x_col not in df.columns or y_col not in df.columns:
+        return df
+    if x_col == y_col:
+        return df
+    if chart_type == "line":
+        return reduce_line(df, x_col, y_col)
+    if chart_type == "bar":
+        return reduce_bar(df, x_col, y_col)
+    if chart_type in ("scatter", "heatmap"):
+        if len(df) <= MAX_SCATTER_POINTS:
+            return df
+        # Heatmaps chart counts per cell, so pre-aggregating loses nothing
+        # unless a numeric axis has to be binned
+        return reduce_2d(df, x_col, y_col)
+    return df
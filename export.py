@@ -0,0 +1,177 @@
+import os
+import io
+import re
+import csv
+import time
+import glob
+import sqlite3
+import secrets
+from utils import get_db_path
+
+# Full results of an answer, without the LIMIT that keeps the displayed answer
+# small, streamed from the cursor into a CSV or Parquet file a batch at a time.
+# Memory use depends on the batch and row group sizes, not on the result.
+EXPORT_DIR = get_db_path(os.getenv("EXPORT_DIR", "exports"))
+# Rows per Parquet row group; the writer holds one row group in memory
+EXPORT_ROW_GROUP_ROWS = int(os.getenv("EXPORT_ROW_GROUP_ROWS", "100000"))
+# Finished exports are deleted after this long
+EXPORT_TTL = int(os.getenv("EXPORT_TTL_MINUTES", "60")) * 60
+# Rows pulled from the cursor per fetchmany call
+FETCH_ROWS = 10000
+# SQLite virtual machine steps between checks for cancellation
+CANCEL_CHECK_STEPS = 10000
+
+FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+}
+
+LIMIT_CLAUSE = re.compile(r"\s+LIMIT\s+\d+(\s*(OFFSET|,)\s*\d+)?\s*$", re.IGNORECASE)
+
+class ExportCancelled(Exception):
+    pass
+
+def full_result_sql(sql_query):
+    """The query without its trailing LIMIT (and OFFSET)."""
+    return LIMIT_CLAUSE.sub("", sql_query.strip().rstrip(";").strip())
+
+def iter_batches(sql_query, db_path, conversation=None, cancelled=None):
+    """
+    Yield (columns, declared types, rows) for each batch of FETCH_ROWS rows
+    of the query's full result. The query runs as an answer would: with the
+    conversation's scratch tables attached and through rollups and indexes.
+    Setting the `cancelled` event stops it, even in the middle of a sort.
+    """
+    from nl2sql import open_query_connection, rewrite_for_execution
+    from columnar import declared_column_types
+    conn = open_query_connection(db_path, conversation)
+    try:
+        if cancelled is not None:
+            conn.set_progress_handler(lambda: 1 if cancelled.is_set() else 0, CANCEL_CHECK_STEPS)
+        declared = declared_column_types(conn)
+        try:
+            cursor = conn.execute(rewrite_for_execution(full_result_sql(sql_query), conn, db_path))
+            columns = [description[0] for description in cursor.description]
+            # The first batch, possibly empty, always comes so writers get the columns
+            rows = cursor.fetchmany(FETCH_ROWS)
+            yield columns, declared, rows
+            while rows:
+                rows = cursor.fetchmany(FETCH_ROWS)
+                if rows:
+                    yield columns, declared, rows
+        except sqlite3.OperationalError:
+            if cancelled is not None and cancelled.is_set():
+                raise ExportCancelled("Export cancelled")
+            raise
+    finally:
+        conn.close()
+
+def _check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise ExportCancelled("Export cancelled")
+
+def write_csv(sql_query, db_path, out, conversation=None, progress=None, cancelled=None):
+    """Write the full result as UTF-8 CSV to a binary file object. Returns the row count."""
+    count = 0
+    for i, (columns, _, rows) in enumerate(iter_batches(sql_query, db_path, conversation, cancelled)):
+        _check_cancelled(cancelled)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if i == 0:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        out.write(buffer.getvalue().encode("utf-8"))
+        count += len(rows)
+        if progress:
+            progress(count)
+    return count
+
+def _batch_arrays(columns, rows, types):
+    """Typed Arrow arrays for a batch. Types still unknown are taken from the values and stored in `types`."""
+    import pyarrow as pa
+    from columnar import _to_array
+    arrays = []
+    for i, name in enumerate(columns):
+        values = [row[i] for row in rows]
+        array = _to_array(values, types[i])
+        if types[i] is None:
+            # Parquet needs the schema up front; all-NULL columns become text
+            types[i] = pa.string() if pa.types.is_null(array.type) else array.type
+        if array.type != types[i]:
+            try:
+                array = array.cast(types[i])
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                raise ValueError(f"Column {name} changes type from {types[i]} to {array.type}; "
+                                 "export it as CSV instead")
+        arrays.append(array)
+    return arrays
+
+def write_parquet(sql_query, db_path, out, conversation=None, progress=None, cancelled=None):
+    """
+    Write the full result as Parquet to a path or file object, one row group
+    of EXPORT_ROW_GROUP_ROWS rows at a time. Returns the row count.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from columnar import arrow_type_for
+    writer, types, pending, pending_rows, count = None, None, [], 0, 0
+    try:
+        for columns, declared, rows in iter_batches(sql_query, db_path, conversation, cancelled):
+            _check_cancelled(cancelled)
+            if types is None:
+                types = [arrow_type_for(declared.get(name)) for name in columns]
+            batch = pa.RecordBatch.from_arrays(_batch_arrays(columns, rows, types), names=columns)
+            if writer is None:
+                writer = pq.ParquetWriter(out, batch.schema)
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= EXPORT_ROW_GROUP_ROWS:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=EXPORT_ROW_GROUP_ROWS)
+                pending, pending_rows = [], 0
+            count += batch.num_rows
+            if progress:
+                progress(count)
+        if pending_rows:
+            writer.write_table(pa.Table.from_batches(pending), row_group_size=EXPORT_ROW_GROUP_ROWS)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+WRITERS = {'csv': write_csv, 'parquet': write_parquet}
+
+def export_path(token, fmt):
+    return os.path.join(EXPORT_DIR, f"{token}{FORMATS[fmt][1]}")
+
+def export_to_file(sql_query, db_path, fmt, conversation=None, progress=None, cancelled=None):
+    """
+    Export the full result to a file under EXPORT_DIR and return its path.
+    A cancelled or failed export leaves no file behind.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    cleanup_exports()
+    path = export_path(secrets.token_urlsafe(16), fmt)
+    partial = f"{path}.partial"
+    try:
+        with open(partial, "wb") as out:
+            WRITERS[fmt](sql_query, db_path, out, conversation, progress, cancelled)
+        os.replace(partial, path)
+        return path
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+def cleanup_exports(max_age=None):
+    """Delete exports older than EXPORT_TTL."""
+    cutoff = time.time() - (EXPORT_TTL if max_age is None else max_age)
+    for path in glob.glob(os.path.join(EXPORT_DIR, "*")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def download_name(question, fmt):
+    """A file name for an export, from the question it answers."""
+    stem = re.sub(r"[^A-Za-z0-9]+", "_", question or "").strip("_")[:60] or "result"
+    return f"{stem}{FORMATS[fmt][1]}"
@@ -1,11 +1,4 @@
-import openai
-import os
-import streamlit as st
-from utils import load_env
-
-load_env()
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from model_router import complete
 
 def generate_follow_up_questions(user_query, schema):
     """Generate relevant follow-up questions based on the current query."""
@@ -25,15 +18,12 @@ def generate_follow_up_questions(user_query, schema):
         Format: Return only the questions, one per line.
         """
         
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}],
-            temperature=0.7,
-            max_tokens=200
-        )
+        text = complete('follow_up', [{"role": "system", "content": prompt}],
+                        check=lambda text: None if text else "No questions suggested",
+                        temperature=0.7, max_tokens=200)
         
         # Split the response into individual questions
-        questions = response.choices[0].message.content.strip().split('\n')
+        questions = text.split('\n')
         # Remove any empty questions and limit to 3
         questions = [q.strip() for q in questions if q.strip()][:3]
         
@@ -0,0 +1,259 @@
+import os
+import re
+import sqlite3
+import hashlib
+from datetime import datetime
+import derived
+from derived import DERIVED_SCHEMA
+
+# Tables smaller than this are scanned quickly enough as they are
+FTS_MIN_ROWS = int(os.getenv("FTS_MIN_ROWS", "10000"))
+# Text columns with more distinct values than this are left alone
+FTS_MAX_DISTINCT = int(os.getenv("FTS_MAX_DISTINCT", "100000"))
+# Past this share of a column's values, scanning beats index lookups
+FTS_MAX_MATCH_FRACTION = float(os.getenv("FTS_MAX_MATCH_FRACTION", "0.2"))
+
+# The trigram tokenizer needs at least three characters to match on
+MIN_PATTERN_LENGTH = 3
+ROWID_ALIASES = ('rowid', 'oid', '_rowid_')
+
+IDENT = r'"[^"]+"|\[[^\]]+\]|`[^`]+`|[A-Za-z_]\w*'
+LIKE_PREDICATE = re.compile(
+    rf"(?<![\w.])(?:(?P<qualifier>{IDENT})\s*\.\s*)?(?P<column>{IDENT})\s+LIKE\s+'%(?P<text>(?:[^'%_]|'')+)%'"
+    r"(?!\s*ESCAPE)",
+    re.IGNORECASE
+)
+NOT_ALIASES = (
+    'where', 'join', 'left', 'right', 'full', 'inner', 'outer', 'cross', 'natural', 'on', 'using', 'from',
+    'group', 'order', 'limit', 'having', 'union', 'intersect', 'except', 'window', 'indexed', 'not'
+)
+# A table or subquery after FROM, JOIN or a comma in a FROM list, with its alias
+TABLE_REFERENCE = re.compile(
+    rf"(?:\b(?:FROM|JOIN)|(?P<comma>,))\s*(?:(?P<subquery>\()|(?:{IDENT})\s*\.\s*)?(?P<table>{IDENT})?"
+    rf"(?:\s+(?:AS\s+)?(?!(?:{'|'.join(NOT_ALIASES)})\b)(?P<alias>{IDENT}))?",
+    re.IGNORECASE
+)
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def _unquote(identifier):
+    if identifier[0] in '"[`':
+        return identifier[1:-1]
+    return identifier
+
+def _fts_name(table, column):
+    digest = hashlib.md5(f"{table}|{column}".encode()).hexdigest()[:8]
+    return f"fts_{re.sub(r'[^A-Za-z0-9_]', '_', table)}_{digest}"
+
+def _rows_name(table, column):
+    return _fts_name(table, column) + "_rows"
+
+def _ensure_meta(conn):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {DERIVED_SCHEMA}.fts_sources (
+        base_table TEXT,
+        column_name TEXT,
+        fts_table TEXT,
+        distinct_values INTEGER,
+        row_count INTEGER,
+        max_rowid INTEGER,
+        built_at TIMESTAMP,
+        PRIMARY KEY (base_table, column_name)
+    )
+    ''')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {DERIVED_SCHEMA}.fts_files (
+        db_size INTEGER,
+        db_mtime INTEGER
+    )
+    ''')
+
+def _file_signature(db_path):
+    stat = os.stat(db_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def index_table(conn, table):
+    """
+    Build trigram indexes over the distinct values of a table's text columns
+    with low to mid cardinality, plus a value -> rowid table for each such
+    column so matching values lead straight to their rows. Everything lives
+    in the sidecar: the uploaded file may be shared and is never written.
+    """
+    columns = conn.execute(f"PRAGMA main.table_info({_quote(table)})").fetchall()
+    if any(column[1].lower() in ROWID_ALIASES for column in columns):
+        # rowid would name the column, not the row
+        return []
+    row_count, max_rowid = conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM main.{_quote(table)}").fetchone()
+    state = {
+        row[0]: row[1:] for row in conn.execute(f'''
+        SELECT column_name, row_count, max_rowid FROM {DERIVED_SCHEMA}.fts_sources WHERE base_table = ?
+        ''', (table,))
+    }
+    built = []
+    for _, column, decltype, _, _, pk in columns:
+        decltype = (decltype or '').upper()
+        if pk or not any(t in decltype for t in ('CHAR', 'CLOB', 'TEXT')):
+            continue
+        fts_table, rows_table = _fts_name(table, column), _rows_name(table, column)
+        if state.get(column) == (row_count, max_rowid) and conn.execute(
+                f"SELECT 1 FROM {DERIVED_SCHEMA}.sqlite_master WHERE name = ?", (rows_table,)).fetchone():
+            continue
+        distinct, nulls = conn.execute(f'''
+        SELECT (SELECT COUNT(*) FROM (SELECT DISTINCT {_quote(column)} FROM main.{_quote(table)} LIMIT ?)),
+               (SELECT COUNT(*) FROM main.{_quote(table)} WHERE {_quote(column)} IS NULL)
+        ''', (FTS_MAX_DISTINCT + 1,)).fetchone()
+        conn.execute(f"DROP TABLE IF EXISTS {DERIVED_SCHEMA}.{_quote(fts_table)}")
+        conn.execute(f"DROP TABLE IF EXISTS {DERIVED_SCHEMA}.{_quote(rows_table)}")
+        conn.execute(f"DELETE FROM {DERIVED_SCHEMA}.fts_sources WHERE base_table = ? AND column_name = ?",
+                     (table, column))
+        # Lookups read every NULL row too (see rewrite_like), so mostly empty
+        # columns are cheaper to scan
+        if not 2 <= distinct <= FTS_MAX_DISTINCT or nulls > row_count * FTS_MAX_MATCH_FRACTION:
+            continue
+        conn.execute(f"CREATE VIRTUAL TABLE {DERIVED_SCHEMA}.{_quote(fts_table)} USING fts5(value, tokenize='trigram')")
+        conn.execute(f'''
+        INSERT INTO {DERIVED_SCHEMA}.{_quote(fts_table)} (value)
+        SELECT DISTINCT {_quote(column)} FROM main.{_quote(table)} WHERE {_quote(column)} IS NOT NULL
+        ''')
+        conn.execute(f"CREATE TABLE {DERIVED_SCHEMA}.{_quote(rows_table)} (value, row_id INTEGER)")
+        conn.execute(f'''
+        INSERT INTO {DERIVED_SCHEMA}.{_quote(rows_table)} (value, row_id)
+        SELECT {_quote(column)}, rowid FROM main.{_quote(table)} ORDER BY 1, 2
+        ''')
+        conn.execute(f"CREATE INDEX {DERIVED_SCHEMA}.{_quote(rows_table + '_value')} "
+                     f"ON {_quote(rows_table)} (value, row_id)")
+        conn.execute(f'''
+        INSERT INTO {DERIVED_SCHEMA}.fts_sources
+        (base_table, column_name, fts_table, distinct_values, row_count, max_rowid, built_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (table, column, fts_table, distinct, row_count, max_rowid, datetime.now().isoformat()))
+        built.append(column)
+    conn.commit()
+    return built
+
+def ensure_fts_indexes(db_path):
+    """Build or refresh the text indexes of every large table. Returns {table: [indexed columns built now]}."""
+    conn = derived.connect(db_path)
+    try:
+        _ensure_meta(conn)
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )]
+        outcome = {}
+        for table in tables:
+            try:
+                row_count = conn.execute(f"SELECT COUNT(*) FROM main.{_quote(table)}").fetchone()[0]
+                if row_count >= FTS_MIN_ROWS:
+                    outcome[table] = index_table(conn, table)
+            except sqlite3.OperationalError as e:
+                print(f"Error indexing text columns of {table}: {e}")
+        conn.commit()
+        # Record the file as it was indexed, so queries can skip the
+        # freshness check while it stays untouched
+        conn.execute(f"DELETE FROM {DERIVED_SCHEMA}.fts_files")
+        conn.execute(f"INSERT INTO {DERIVED_SCHEMA}.fts_files VALUES (?, ?)", _file_signature(db_path))
+        conn.commit()
+        return outcome
+    finally:
+        conn.close()
+
+def _fresh_sources(conn, db_path):
+    """Indexed (table, column) -> (fts table, distinct values) that still match the data."""
+    sources = conn.execute(f'''
+    SELECT base_table, column_name, fts_table, distinct_values, row_count, max_rowid
+    FROM {DERIVED_SCHEMA}.fts_sources
+    ''').fetchall()
+    signature = conn.execute(f"SELECT db_size, db_mtime FROM {DERIVED_SCHEMA}.fts_files").fetchone()
+    unchanged = signature is not None and tuple(signature) == _file_signature(db_path)
+    fresh, checked = {}, {}
+    for table, column, fts_table, distinct, row_count, max_rowid in sources:
+        if not unchanged:
+            if table not in checked:
+                checked[table] = tuple(conn.execute(
+                    f"SELECT COUNT(*), MAX(rowid) FROM main.{_quote(table)}"
+                ).fetchone())
+            if checked[table] != (row_count, max_rowid):
+                continue
+        fresh[(table.lower(), column.lower())] = (fts_table, distinct)
+    return fresh
+
+def _table_references(sql):
+    """
+    Tables the query reads, as {name or alias: table}, and whether that list
+    is complete: subqueries in FROM and comma joins are not resolved.
+    """
+    references, complete = {}, True
+    for match in TABLE_REFERENCE.finditer(sql):
+        if match.group('comma'):
+            # A comma after a table name in a FROM list joins another table
+            before = sql[:match.start()].rstrip()
+            if not re.search(rf"\bFROM\s+(?:{IDENT})(?:\s*\.\s*(?:{IDENT}))?(?:\s+(?:AS\s+)?(?:{IDENT}))?$",
+                             before, re.IGNORECASE):
+                continue
+        if match.group('subquery') or not match.group('table'):
+            complete = False
+            continue
+        table = _unquote(match.group('table')).lower()
+        references[_unquote(match.group('alias') or table).lower()] = table
+    return references, complete
+
+def rewrite_like(sql, conn, db_path):
+    """
+    Turn `column LIKE '%text%'` predicates on indexed columns into lookups of
+    the matching rows through the column's trigram index and value -> rowid
+    table: `(rowid IN (SELECT row_id FROM <rows> WHERE value IS NULL OR value
+    IN (SELECT value FROM <fts> WHERE value MATCH '"text"' AND value LIKE
+    '%text%')) AND column = column)`. The LIKE stays because the trigram
+    tokenizer folds the case of all letters while LIKE folds ASCII letters
+    only; the NULL rows and `column = column` keep LIKE's NULL for them.
+
+    Predicates are left as they are when the column is not indexed or its
+    index is stale, when it cannot be told which table the column belongs
+    to (it must be qualified by that table or its alias, or be the only
+    table read), when the text is shorter than three characters or has
+    wildcards inside it, or when it matches so many values that a scan is
+    cheaper. `conn` must have the derived database attached.
+    """
+    if 'like' not in sql.lower():
+        return sql
+    try:
+        sources = _fresh_sources(conn, db_path)
+    except sqlite3.Error:
+        return sql
+    if not sources:
+        return sql
+    references, complete = _table_references(sql)
+
+    def replace(match):
+        column = _unquote(match.group('column')).lower()
+        text = match.group('text').replace("''", "'")
+        if len(text) < MIN_PATTERN_LENGTH:
+            return match.group(0)
+        if match.group('qualifier'):
+            table = references.get(_unquote(match.group('qualifier')).lower())
+        else:
+            tables = set(references.values())
+            table = tables.pop() if complete and len(tables) == 1 else None
+        if (table, column) not in sources:
+            return match.group(0)
+        fts_table, distinct = sources[(table, column)]
+        rows_table = fts_table + "_rows"
+        phrase = '"' + text.replace('"', '""') + '"'
+        try:
+            matched = conn.execute(
+                f"SELECT COUNT(*) FROM {DERIVED_SCHEMA}.{_quote(fts_table)} WHERE value MATCH ?", (phrase,)
+            ).fetchone()[0]
+        except sqlite3.Error:
+            return match.group(0)
+        if matched > distinct * FTS_MAX_MATCH_FRACTION:
+            return match.group(0)
+        target = match.group(0)[:match.end('column') - match.start(0)]
+        rowid = f"{match.group('qualifier')}.rowid" if match.group('qualifier') else "rowid"
+        literal = "'" + phrase.replace("'", "''") + "'"
+        return (f"({rowid} IN (SELECT row_id FROM {DERIVED_SCHEMA}.{_quote(rows_table)} WHERE value IS NULL "
+                f"OR value IN (SELECT value FROM {DERIVED_SCHEMA}.{_quote(fts_table)} "
+                f"WHERE value MATCH {literal} AND value LIKE '%{match.group('text')}%')) "
+                f"AND {target} = {target})")
+
+    return LIKE_PREDICATE.sub(replace, sql)
@@ -0,0 +1,382 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bench_columnar import make_database
+
+# Simulated analysts against one node. Each user logs in (bcrypt, as
+# auth.authenticate_user does), uploads the team's database and asks a mix of
+# popular questions, answered from the cache, and new ones, which run the
+# whole pipeline. Questions go through the same core as the app and the API:
+# claim_question, then submit_question on the query pool. Model calls go over
+# HTTP to a local OpenAI-compatible endpoint that answers each stage after a
+# realistic, lognormally distributed delay. Every concurrency level runs in a
+# fresh process with its own data directory, so CPU, memory and the SQLite
+# files are measured for that level alone.
+
+USER_LEVELS = [1, 2, 4, 8, 16, 32]
+DURATION = 30
+# Share of questions taken from the popular, already cached ones
+CACHED_SHARE = 0.7
+POPULAR_QUESTIONS = 20
+# Mean pause between a user's questions, in seconds
+THINK_TIME = 2.0
+ROWS = 200_000
+
+# Median and spread (sigma of the log) of model latency per stage, in seconds
+STAGE_LATENCY = {
+    'classify': (0.5, 0.4),
+    'refine': (0.9, 0.5),
+    'generate': (1.6, 0.6),
+    'summarize': (1.4, 0.5),
+    'follow_up': (0.9, 0.5),
+}
+
+SQL_TEMPLATES = [
+    "SELECT Product, SUM(Units_Sold) AS total_units FROM sales GROUP BY Product ORDER BY total_units DESC LIMIT 10",
+    "SELECT Store_Location, AVG(Price) AS avg_price FROM sales GROUP BY Store_Location",
+    "SELECT substr(Sale_Date, 1, 7) AS month, SUM(Units_Sold * Price) AS revenue FROM sales GROUP BY month",
+    "SELECT Store_Location, COUNT(*) AS sales FROM sales WHERE Units_Sold > 25 GROUP BY Store_Location",
+    "SELECT Product, MAX(Price) AS max_price FROM sales WHERE Product LIKE '%1%' GROUP BY Product LIMIT 20",
+    "SELECT * FROM sales WHERE Price > 90 ORDER BY Price DESC LIMIT 50",
+]
+
+class FakeModels(BaseHTTPRequestHandler):
+    """Chat completions for models named loadtest-<stage>, after that stage's latency."""
+    scale = 1.0
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        stage = request['model'].split('-', 1)[1]
+        prompt = request['messages'][-1]['content']
+        median, sigma = STAGE_LATENCY[stage]
+        time.sleep(random.lognormvariate(0, sigma) * median * FakeModels.scale)
+        reply = fake_reply(stage, prompt)
+        body = json.dumps({
+            'id': 'chatcmpl-loadtest', 'object': 'chat.completion', 'model': request['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(reply) // 4,
+                      'total_tokens': (len(prompt) + len(reply)) // 4}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def fake_reply(stage, prompt):
+    digest = hashlib.md5(prompt.encode()).hexdigest()
+    if stage == 'classify':
+        return "DB"
+    if stage == 'refine':
+        # Distinct questions get distinct SQL
+        return f"Refined question {digest[:8]}"
+    if stage == 'generate':
+        return SQL_TEMPLATES[int(digest, 16) % len(SQL_TEMPLATES)]
+    if stage == 'follow_up':
+        return "Which product sold most?\nHow do stores compare?\nWhat changed by month?"
+    return "Sales are concentrated in a few products; the North store leads on revenue."
+
+def start_fake_models(scale):
+    FakeModels.scale = scale
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeModels)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+class LineCounter:
+    """Stands in for stdout in a level's process: counts the pipeline's printed errors instead of showing them."""
+    def __init__(self):
+        self.locked = 0
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            self.locked += text.count("database is locked")
+        return len(text)
+
+    def flush(self):
+        pass
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Sampler(threading.Thread):
+    """
+    Samples memory and probes the shared SQLite files for a free write lock.
+    A probe that cannot take the lock at once is one a writer would have waited on.
+    """
+    def __init__(self, databases, interval=0.1):
+        super().__init__(daemon=True)
+        self.databases = databases
+        self.interval = interval
+        self.rss = []
+        self.probes = {name: [0, 0] for name in databases}
+        self.stopped = threading.Event()
+
+    def probe(self, path):
+        conn = sqlite3.connect(path, timeout=0, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("ROLLBACK")
+            return False
+        except sqlite3.OperationalError:
+            return True
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.rss.append(_rss_bytes())
+            for name, path in self.databases.items():
+                if os.path.exists(path):
+                    self.probes[name][0] += 1
+                    self.probes[name][1] += self.probe(path)
+
+    def busy_share(self):
+        return {name: busy / probes for name, (probes, busy) in self.probes.items() if probes}
+
+def ask(pipeline, username, question, db_path, schema, conversation):
+    """Ask like the app does. Returns 'cached' or 'uncached' and whether the answer is usable."""
+    while True:
+        outcome, value = pipeline.claim_question(question, schema, timeout=0.05, db_path=db_path)
+        if outcome == 'cached':
+            return 'cached', True
+        if outcome == 'claimed':
+            response = pipeline.submit_question(username, question, db_path, schema, value,
+                                                conversation=conversation).result()
+            return 'uncached', bool(response and response.get('sql_query'))
+
+def run_level(users, args, endpoint, db_file):
+    """Run one concurrency level in this process and print its measurements as JSON."""
+    for stage in STAGE_LATENCY:
+        os.environ[f"MODEL_POLICY_{stage.upper()}"] = f"loadtest-{stage}@{endpoint}"
+    os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+    real_stdout, counter = sys.stdout, LineCounter()
+    sys.stdout = counter
+
+    import auth
+    import pipeline
+    import scratch
+    import storage
+    import metrics
+    import chat_history
+    import database_cache
+    import state_backend
+
+    with open(db_file, "rb") as f:
+        data = f.read()
+    popular = [f"Popular question {i}" for i in range(args.popular)]
+    usernames = [f"analyst{i}" for i in range(users)]
+    for username in usernames:
+        auth.register_user(username, "secret-password")
+
+    # The popular questions were asked before; their answers are cached
+    db_path = storage.store_upload("warmup", "team.db", data)
+    schema = pipeline.load_schema(db_path)
+    pipeline.prepare_database(db_path, schema)
+    for question in popular:
+        ask(pipeline, "warmup", question, db_path, schema, None)
+
+    databases = {
+        'query_cache': database_cache.CACHE_DB, 'metrics': metrics.METRICS_DB,
+        'storage': storage.STORAGE_DB, 'users': auth.DATABASE_FILE, 'chat_history': chat_history.CHAT_DB,
+    }
+    # Shared session state, unless it lives in Redis
+    if getattr(state_backend.get_backend(), 'path', None):
+        databases['state'] = state_backend.get_backend().path
+    sampler = Sampler(databases)
+    results = {'login': [], 'upload': [], 'cached': [], 'uncached': [], 'failed': 0}
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    barrier = threading.Barrier(users)
+
+    def record(kind, seconds):
+        with results_lock:
+            results[kind].append(seconds)
+
+    def user(username, seed):
+        rnd = random.Random(seed)
+        barrier.wait()
+        try:
+            start = time.perf_counter()
+            if not auth.check_credentials(username, "secret-password"):
+                raise RuntimeError("login failed")
+            record('login', time.perf_counter() - start)
+            start = time.perf_counter()
+            user_db = storage.store_upload(username, "team.db", data)
+            user_schema = pipeline.load_schema(user_db)
+            pipeline.prepare_database(user_db, user_schema, username)
+            state_backend.set_active_database(username, user_db, user_schema)
+            record('upload', time.perf_counter() - start)
+            conversation = scratch.conversation_id(username, user_db)
+            asked = 0
+            while time.perf_counter() < deadline:
+                if rnd.random() < args.cached_share:
+                    question = rnd.choice(popular)
+                else:
+                    asked += 1
+                    question = f"New question {asked} from {username}"
+                start = time.perf_counter()
+                kind, ok = ask(pipeline, username, question, user_db, user_schema, conversation)
+                record(kind, time.perf_counter() - start)
+                if not ok:
+                    with results_lock:
+                        results['failed'] += 1
+                time.sleep(rnd.expovariate(1 / args.think) if args.think else 0)
+        except Exception as e:
+            with results_lock:
+                results['failed'] += 1
+            print(f"Error in simulated user {username}: {e}")
+
+    cpu_before, started = os.times(), time.perf_counter()
+    sampler.start()
+    threads = [threading.Thread(target=user, args=(name, i)) for i, name in enumerate(usernames)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cpu_after = os.times()
+    sampler.stopped.set()
+    sampler.join()
+
+    answered = results['cached'] + results['uncached']
+    real_stdout.write(json.dumps({
+        'users': users,
+        'questions': len(answered),
+        'throughput': len(answered) / elapsed,
+        'p50': percentile(answered, 50), 'p95': percentile(answered, 95), 'p99': percentile(answered, 99),
+        'cached_p95': percentile(results['cached'], 95), 'uncached_p95': percentile(results['uncached'], 95),
+        'cached_share': len(results['cached']) / len(answered) if answered else None,
+        'login_p95': percentile(results['login'], 95), 'upload_p95': percentile(results['upload'], 95),
+        'cpu_cores': ((cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)) / elapsed,
+        'rss_mb': max(sampler.rss or [_rss_bytes()]) / 1024 / 1024,
+        'lock_busy': sampler.busy_share(),
+        'locked_errors': counter.locked,
+        'failed': results['failed'],
+    }) + "\n")
+
+def saturation(rows):
+    """The level past which more users stop adding throughput (under 10% more), or None."""
+    for previous, row in zip(rows, rows[1:]):
+        if row['throughput'] < previous['throughput'] * 1.1:
+            return previous
+    return None
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+def print_table(rows):
+    print(f"{'users':>5} {'q/s':>6} {'p95 s':>6} {'p99 s':>6} {'hit':>6} {'miss':>6} {'cached':>6} "
+          f"{'login':>6} {'upload':>6} {'cpu':>5} {'rss MB':>7} {'busy':>6} {'locked':>6} {'failed':>6}")
+    for row in rows:
+        busiest = max(row['lock_busy'].items(), key=lambda item: item[1], default=(None, 0))
+        print(f"{row['users']:>5} {row['throughput']:>6.2f} {_fmt(row['p95'], '6.2f')} {_fmt(row['p99'], '6.2f')} "
+              f"{_fmt(row['cached_p95'], '6.2f')} {_fmt(row['uncached_p95'], '6.2f')} "
+              f"{_fmt(row['cached_share'], '6.0%')} {_fmt(row['login_p95'], '6.2f')} "
+              f"{_fmt(row['upload_p95'], '6.2f')} {row['cpu_cores']:>5.2f} {row['rss_mb']:>7.0f} "
+              f"{busiest[1]:>6.1%} {row['locked_errors']:>6} {row['failed']:>6}")
+    print("p95/p99 are per question, hit and miss the p95 of cached and uncached ones; login and upload "
+          "are p95 s; cpu is in cores; busy is the share of probes that found the busiest SQLite file write-locked")
+
+def write_chart(rows, path):
+    """Throughput and p95 latency against users, as an HTML page."""
+    import altair as alt
+    import pandas as pd
+    df = pd.DataFrame([{'users': r['users'], 'throughput (q/s)': r['throughput'], 'p95 latency (s)': r['p95']}
+                       for r in rows])
+    base = alt.Chart(df).encode(x=alt.X('users:Q', scale=alt.Scale(type='log', base=2)))
+    chart = alt.layer(
+        base.mark_line(point=True, color='steelblue').encode(y='throughput (q/s):Q'),
+        base.mark_line(point=True, color='firebrick').encode(y='p95 latency (s):Q')
+    ).resolve_scale(y='independent').properties(title='Saturation curve')
+    chart.save(path)
+
+def run_loadtest(args):
+    server, endpoint = start_fake_models(args.llm_scale)
+    db_file = os.path.join(tempfile.mkdtemp(), 'team.db')
+    make_database(db_file, args.rows)
+    here = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    try:
+        for users in args.users:
+            # A fresh data directory per level: no cache, metrics or uploads carry over
+            env = dict(os.environ, DATA_DIR=tempfile.mkdtemp())
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-level', str(users), '--endpoint', endpoint,
+                 '--db-file', db_file] + _level_args(args),
+                capture_output=True, text=True, check=True, cwd=here, env=env
+            ).stdout
+            rows.append(json.loads(out.strip().splitlines()[-1]))
+            print(f"{users} users: {rows[-1]['throughput']:.2f} questions/s, p95 {_fmt(rows[-1]['p95'], '.2f')} s")
+    finally:
+        server.shutdown()
+
+    print()
+    print_table(rows)
+    knee = saturation(rows)
+    if knee:
+        print(f"Saturation at about {knee['users']} users: {knee['throughput']:.2f} questions/s, "
+              f"p95 {knee['p95']:.2f} s")
+    else:
+        print("Throughput was still rising at the highest level; add more users to find saturation")
+    if args.csv:
+        import csv
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[key for key in rows[0] if key != 'lock_busy'] + ['lock_busy'])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(dict(row, lock_busy=json.dumps(row['lock_busy'])))
+    if args.chart:
+        write_chart(rows, args.chart)
+
+def _level_args(args):
+    return ['--duration', str(args.duration), '--cached-share', str(args.cached_share),
+            '--popular', str(args.popular), '--think', str(args.think)]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent analysts and find where one node saturates.")
+    parser.add_argument('--users', type=lambda s: [int(n) for n in s.split(',')], default=USER_LEVELS,
+                        help="comma separated concurrency levels")
+    parser.add_argument('--duration', type=float, default=DURATION, help="seconds per level")
+    parser.add_argument('--cached-share', type=float, default=CACHED_SHARE)
+    parser.add_argument('--popular', type=int, default=POPULAR_QUESTIONS)
+    parser.add_argument('--think', type=float, default=THINK_TIME, help="mean pause between questions")
+    parser.add_argument('--rows', type=int, default=ROWS, help="rows in the uploaded database")
+    parser.add_argument('--llm-scale', type=float, default=1.0, help="multiplies the model latencies")
+    parser.add_argument('--csv', help="write the results to this CSV file")
+    parser.add_argument('--chart', help="write the saturation curve to this HTML file")
+    parser.add_argument('--run-level', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--endpoint', help=argparse.SUPPRESS)
+    parser.add_argument('--db-file', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.run_level:
+        run_level(args.run_level, args, args.endpoint, args.db_file)
+    else:
+        run_loadtest(args)
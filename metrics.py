@@ -0,0 +1,256 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from utils import connect_initialized, get_db_path
+
+METRICS_DB = get_db_path('metrics.db')
+
+# Pipeline stages that get a span; used to order the dashboard and exports
+STAGES = [
+    'queue_wait', 'cache_lookup', 'classify', 'refine', 'generate', 'approximate',
+    'execute', 'summarize', 'follow_up', 'query_job', 'render'
+]
+
+# Quantiles reported on the dashboard and in the Prometheus export
+QUANTILES = [0.5, 0.95, 0.99]
+
+def init_metrics_db():
+    """Initialize the metrics database with the spans table."""
+    conn = sqlite3.connect(METRICS_DB)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS spans (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        stage TEXT NOT NULL,
+        started_at TIMESTAMP,
+        duration_ms REAL,
+        model TEXT,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        cache_hit INTEGER,
+        row_count INTEGER,
+        error TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_spans_stage ON spans (stage, started_at)')
+
+    conn.commit()
+    conn.close()
+
+def _connect():
+    return connect_initialized(METRICS_DB, init_metrics_db)
+
+
+def record_span(span_data):
+    """Store a finished span in the metrics database."""
+    conn = _connect()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        INSERT INTO spans
+        (stage, started_at, duration_ms, model, prompt_tokens, completion_tokens,
+         cache_hit, row_count, error)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            span_data['stage'],
+            span_data['started_at'],
+            span_data['duration_ms'],
+            span_data.get('model'),
+            span_data.get('prompt_tokens') or 0,
+            span_data.get('completion_tokens') or 0,
+            None if span_data.get('cache_hit') is None else int(span_data['cache_hit']),
+            span_data.get('rows'),
+            span_data.get('error')
+        ))
+        conn.commit()
+    finally:
+        conn.close()
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    Time a pipeline stage and record it as a span.
+
+    Yields a dict the caller can fill in with model, token, cache_hit and rows
+    information while the stage runs.
+    """
+    span_data = {
+        'stage': stage,
+        'started_at': datetime.now().isoformat(),
+        'model': None,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'cache_hit': None,
+        'rows': None,
+        'error': None
+    }
+    span_data.update(attributes)
+    start = time.perf_counter()
+    try:
+        yield span_data
+    except Exception as e:
+        span_data['error'] = str(e)
+        raise
+    finally:
+        span_data['duration_ms'] = (time.perf_counter() - start) * 1000
+        try:
+            record_span(span_data)
+        except Exception as e:
+            # Instrumentation must never break the pipeline
+            print(f"Error recording span: {e}")
+
+def record_usage(span_data, response):
+    """Copy model and token usage from an OpenAI response into a span."""
+    try:
+        span_data['model'] = response.get('model')
+        usage = response.get('usage') or {}
+        span_data['prompt_tokens'] += usage.get('prompt_tokens', 0)
+        span_data['completion_tokens'] += usage.get('completion_tokens', 0)
+    except Exception as e:
+        print(f"Error reading token usage: {e}")
+
+def percentile(sorted_values, q):
+    """Return the q-th quantile of an already sorted list (linear interpolation)."""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+
+def get_stage_stats(since=None):
+    """
+    Aggregate recorded spans per stage.
+
+    Returns a list of dicts with count, error count, latency quantiles,
+    token totals and cache hit rate for every stage that has spans.
+    """
+    conn = _connect()
+    cursor = conn.cursor()
+
+    try:
+        where = "WHERE started_at >= ?" if since else ""
+        params = (since,) if since else ()
+        cursor.execute(f'''
+        SELECT stage, duration_ms, prompt_tokens, completion_tokens, cache_hit, error, model
+        FROM spans {where}
+        ORDER BY stage, duration_ms
+        ''', params)
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    grouped = {}
+    for stage, duration, prompt_tokens, completion_tokens, cache_hit, error, model in rows:
+        stats = grouped.setdefault(stage, {
+            'durations': [], 'prompt_tokens': 0, 'completion_tokens': 0,
+            'cache_hits': 0, 'cache_lookups': 0, 'errors': 0, 'models': set()
+        })
+        stats['durations'].append(duration)
+        stats['prompt_tokens'] += prompt_tokens or 0
+        stats['completion_tokens'] += completion_tokens or 0
+        if cache_hit is not None:
+            stats['cache_lookups'] += 1
+            stats['cache_hits'] += cache_hit
+        if error:
+            stats['errors'] += 1
+        if model:
+            stats['models'].add(model)
+
+    ordered = [s for s in STAGES if s in grouped] + sorted(s for s in grouped if s not in STAGES)
+    summary = []
+    for stage in ordered:
+        stats = grouped[stage]
+        durations = stats['durations']
+        summary.append({
+            'stage': stage,
+            'count': len(durations),
+            'errors': stats['errors'],
+            'p50_ms': percentile(durations, 0.5),
+            'p95_ms': percentile(durations, 0.95),
+            'p99_ms': percentile(durations, 0.99),
+            'total_ms': sum(durations),
+            'prompt_tokens': stats['prompt_tokens'],
+            'completion_tokens': stats['completion_tokens'],
+            'cache_hit_rate': (stats['cache_hits'] / stats['cache_lookups']) if stats['cache_lookups'] else None,
+            'models': ', '.join(sorted(stats['models']))
+        })
+    return summary
+
+def get_route_stats(since=None):
+    """
+    Aggregate spans per stage and model, for tuning the model routing policy.
+
+    Returns a list of dicts with call and failure counts, latency quantiles
+    and mean tokens per call for every (stage, model) pair that has spans.
+    """
+    conn = _connect()
+    try:
+        where = "AND started_at >= ?" if since else ""
+        params = (since,) if since else ()
+        rows = conn.execute(f'''
+        SELECT stage, model, duration_ms, prompt_tokens, completion_tokens, error
+        FROM spans WHERE model IS NOT NULL {where}
+        ORDER BY stage, model, duration_ms
+        ''', params).fetchall()
+    finally:
+        conn.close()
+
+    grouped = {}
+    for stage, model, duration, prompt_tokens, completion_tokens, error in rows:
+        stats = grouped.setdefault((stage, model), {'durations': [], 'tokens': 0, 'failures': 0})
+        stats['durations'].append(duration)
+        stats['tokens'] += (prompt_tokens or 0) + (completion_tokens or 0)
+        if error:
+            stats['failures'] += 1
+
+    summary = []
+    for (stage, model), stats in grouped.items():
+        durations = stats['durations']
+        summary.append({
+            'stage': stage,
+            'model': model,
+            'count': len(durations),
+            'failures': stats['failures'],
+            'failure_rate': stats['failures'] / len(durations),
+            'p50_ms': percentile(durations, 0.5),
+            'p95_ms': percentile(durations, 0.95),
+            'mean_tokens': stats['tokens'] / len(durations)
+        })
+    return summary
+
+def export_prometheus(since=None):
+    """Render the per-stage statistics in the Prometheus text exposition format."""
+    stats = get_stage_stats(since)
+    lines = [
+        '# HELP nl2sql_stage_duration_seconds Latency of each pipeline stage.',
+        '# TYPE nl2sql_stage_duration_seconds summary'
+    ]
+    for s in stats:
+        for q, key in zip(QUANTILES, ['p50_ms', 'p95_ms', 'p99_ms']):
+            lines.append(f'nl2sql_stage_duration_seconds{{stage="{s["stage"]}",quantile="{q}"}} {s[key] / 1000:.6f}')
+        lines.append(f'nl2sql_stage_duration_seconds_sum{{stage="{s["stage"]}"}} {s["total_ms"] / 1000:.6f}')
+        lines.append(f'nl2sql_stage_duration_seconds_count{{stage="{s["stage"]}"}} {s["count"]}')
+
+    lines.append('# HELP nl2sql_stage_errors_total Spans that ended with an error.')
+    lines.append('# TYPE nl2sql_stage_errors_total counter')
+    for s in stats:
+        lines.append(f'nl2sql_stage_errors_total{{stage="{s["stage"]}"}} {s["errors"]}')
+
+    lines.append('# HELP nl2sql_tokens_total OpenAI tokens spent per stage.')
+    lines.append('# TYPE nl2sql_tokens_total counter')
+    for s in stats:
+        lines.append(f'nl2sql_tokens_total{{stage="{s["stage"]}",kind="prompt"}} {s["prompt_tokens"]}')
+        lines.append(f'nl2sql_tokens_total{{stage="{s["stage"]}",kind="completion"}} {s["completion_tokens"]}')
+
+    lines.append('# HELP nl2sql_cache_hit_ratio Share of lookups answered from cache.')
+    lines.append('# TYPE nl2sql_cache_hit_ratio gauge')
+    for s in stats:
+        if s['cache_hit_rate'] is not None:
+            lines.append(f'nl2sql_cache_hit_ratio{{stage="{s["stage"]}"}} {s["cache_hit_rate"]:.6f}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,85 @@
+import os
+import streamlit as st
+import pandas as pd
+from datetime import datetime, timedelta
+from metrics import get_stage_stats, export_prometheus
+from model_router import policy_report
+from query_pool import pool_stats, export_pool_prometheus, QUERY_POOL_WORKERS
+
+def is_admin(username):
+    """Admins are listed in the comma separated ADMIN_USERS environment variable."""
+    admins = [u.strip() for u in os.getenv("ADMIN_USERS", "").split(",") if u.strip()]
+    return username in admins
+
+def show_metrics_dashboard():
+    """Admin page with per-stage latency quantiles and token spend."""
+    st.header("Pipeline Metrics")
+
+    windows = {
+        "Last hour": timedelta(hours=1),
+        "Last 24 hours": timedelta(days=1),
+        "Last 7 days": timedelta(days=7),
+        "All time": None
+    }
+    window = st.selectbox("Time window", list(windows.keys()), index=1)
+    since = (datetime.now() - windows[window]).isoformat() if windows[window] else None
+
+    pool = pool_stats()
+    st.subheader("Query pool")
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Workers", pool['workers'])
+    col2.metric("Running", pool['running'])
+    col3.metric("Queued", pool['queued'])
+    col4.metric("Utilization (5 min)", f"{pool['utilization']:.0%}")
+
+    stats = get_stage_stats(since)
+    if not stats:
+        st.info("No spans recorded in this window yet.")
+        return
+
+    df = pd.DataFrame(stats)
+    df['total_tokens'] = df['prompt_tokens'] + df['completion_tokens']
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Spans", int(df['count'].sum()))
+    col2.metric("Tokens", f"{int(df['total_tokens'].sum()):,}")
+    col3.metric("Errors", int(df['errors'].sum()))
+
+    # Busy share of the pool over the selected window, from recorded job spans
+    jobs = df[df['stage'] == 'query_job']
+    if not jobs.empty and windows[window]:
+        capacity_ms = QUERY_POOL_WORKERS * windows[window].total_seconds() * 1000
+        st.caption(f"Pool utilization over {window.lower()}: {jobs['total_ms'].iloc[0] / capacity_ms:.1%}")
+
+    st.subheader("Latency per stage (ms)")
+    st.dataframe(
+        df[['stage', 'count', 'p50_ms', 'p95_ms', 'p99_ms', 'errors', 'cache_hit_rate']].round(1),
+        hide_index=True,
+        use_container_width=True
+    )
+    st.bar_chart(df.set_index('stage')[['p50_ms', 'p95_ms', 'p99_ms']])
+
+    st.subheader("Token spend per stage")
+    st.dataframe(
+        df[['stage', 'models', 'prompt_tokens', 'completion_tokens', 'total_tokens']],
+        hide_index=True,
+        use_container_width=True
+    )
+    st.bar_chart(df.set_index('stage')[['prompt_tokens', 'completion_tokens']])
+
+    # Failure rates include answers rejected by a stage's check; the router
+    # skips a model whose rate stays high
+    st.subheader("Model routes")
+    routes = pd.DataFrame(policy_report())
+    st.dataframe(
+        routes[['stage', 'model', 'active', 'count', 'failure_rate', 'p50_ms', 'p95_ms', 'mean_tokens']].round(2),
+        hide_index=True,
+        use_container_width=True
+    )
+
+    st.download_button(
+        "Export Prometheus metrics",
+        data=export_prometheus(since) + export_pool_prometheus(),
+        file_name="nl2sql_metrics.prom",
+        mime="text/plain"
+    )
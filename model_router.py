@@ -0,0 +1,132 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from metrics import span, record_usage, get_route_stats
+from utils import get_openai
+
+# Every LLM call in the pipeline goes through complete() with its stage name.
+# The policy gives each stage a ladder of models, fastest and cheapest first;
+# a call moves up the ladder when a model errors or its answer fails the
+# stage's check (generated SQL that does not compile, say). Override a ladder
+# with MODEL_POLICY_<STAGE>, e.g. MODEL_POLICY_GENERATE=gpt-4o-mini,gpt-4o.
+# A model may be given as "model@base_url" to call an OpenAI-compatible
+# endpoint other than OpenAI's, such as a local one.
+DEFAULT_POLICY = {
+    'classify': ['gpt-4o-mini', 'chatgpt-4o-latest'],
+    'refine': ['gpt-4o-mini', 'chatgpt-4o-latest'],
+    'generate': ['gpt-4o-mini', 'chatgpt-4o-latest'],
+    'summarize': ['chatgpt-4o-latest'],
+    'follow_up': ['gpt-4o-mini', 'gpt-4'],
+}
+
+# A model that failed at least this share of its recent calls for a stage,
+# over at least ROUTER_MIN_CALLS calls, is skipped: it only adds latency
+# before the escalation
+ROUTER_MAX_FAILURE_RATE = float(os.getenv("ROUTER_MAX_FAILURE_RATE", "0.5"))
+ROUTER_MIN_CALLS = int(os.getenv("ROUTER_MIN_CALLS", "20"))
+ROUTER_WINDOW_HOURS = float(os.getenv("ROUTER_WINDOW_HOURS", "24"))
+# How long route statistics are reused before being read again
+ROUTER_STATS_TTL = 60
+
+class Rejected(Exception):
+    """A model's answer failed the stage's check."""
+
+def policy(stage):
+    """The configured ladder of models for a stage."""
+    configured = os.getenv(f"MODEL_POLICY_{stage.upper()}")
+    if configured:
+        return [m.strip() for m in configured.split(",") if m.strip()]
+    return list(DEFAULT_POLICY.get(stage, DEFAULT_POLICY['summarize']))
+
+_stats = {'loaded_at': 0, 'routes': {}}
+_stats_lock = threading.Lock()
+
+def route_stats():
+    """Recent {(stage, model): stats} from the recorded spans, refreshed every ROUTER_STATS_TTL seconds."""
+    with _stats_lock:
+        if time.time() - _stats['loaded_at'] > ROUTER_STATS_TTL:
+            since = (datetime.now() - timedelta(hours=ROUTER_WINDOW_HOURS)).isoformat()
+            try:
+                _stats['routes'] = {(r['stage'], r['model']): r for r in get_route_stats(since)}
+            except Exception as e:
+                print(f"Error reading route statistics: {e}")
+            _stats['loaded_at'] = time.time()
+        return _stats['routes']
+
+def ladder(stage):
+    """
+    The models a stage tries, in order: its policy without the leading
+    models that recently failed too often. The strongest model always stays.
+    """
+    models = policy(stage)
+    stats = route_stats()
+    while len(models) > 1:
+        route = stats.get((stage, models[0]))
+        if not route or route['count'] < ROUTER_MIN_CALLS or route['failure_rate'] < ROUTER_MAX_FAILURE_RATE:
+            break
+        models.pop(0)
+    return models
+
+def _create(route, messages, params):
+    model, _, api_base = route.partition("@")
+    kwargs = dict(params, model=model, messages=messages)
+    if api_base:
+        kwargs['api_base'] = api_base
+        kwargs['api_key'] = os.getenv("MODEL_API_KEY") or os.getenv("OPENAI_API_KEY") or "local"
+    return get_openai().ChatCompletion.create(**kwargs)
+
+def complete(stage, messages, check=None, **params):
+    """
+    Text of a chat completion for a pipeline stage, from the first model on
+    its ladder that answers and whose answer passes `check`. `check(text)`
+    returns None for a usable answer, or why it is not. Every attempt is
+    recorded as a span of the stage. Raises the last error when no model
+    gives a usable answer.
+    """
+    routes = ladder(stage)
+    for i, route in enumerate(routes):
+        try:
+            with span(stage, model=route) as s:
+                response = _create(route, messages, params)
+                record_usage(s, response)
+                # Statistics are kept per policy entry, not per model version
+                s['model'] = route
+                text = response.choices[0].message.content.strip()
+                problem = check(text) if check else None
+                if problem:
+                    raise Rejected(problem)
+            return text
+        except Exception as e:
+            if i + 1 == len(routes):
+                raise
+            print(f"{stage}: {route} failed ({e}); escalating to {routes[i + 1]}")
+
+def policy_report():
+    """Per-stage ladders with the recent statistics of each model on them."""
+    stats = route_stats()
+    report = []
+    for stage in sorted(set(DEFAULT_POLICY) | {s for s, _ in stats}):
+        active = ladder(stage)
+        for model in policy(stage):
+            route = stats.get((stage, model), {})
+            report.append({
+                'stage': stage,
+                'model': model,
+                'active': model in active,
+                'count': route.get('count', 0),
+                'failure_rate': route.get('failure_rate'),
+                'p50_ms': route.get('p50_ms'),
+                'p95_ms': route.get('p95_ms'),
+                'mean_tokens': route.get('mean_tokens')
+            })
+    return report
+
+if __name__ == "__main__":
+    # Print each stage's ladder with its recent latency, tokens and failures
+    fmt = lambda value, spec: "-" if value is None else format(value, spec)
+    print(f"{'stage':<10} {'model':<40} {'calls':>6} {'fail':>6} {'p50 ms':>8} {'p95 ms':>8} {'tokens':>7}")
+    for row in policy_report():
+        model = row['model'] if row['active'] else f"{row['model']} (skipped)"
+        print(f"{row['stage']:<10} {model:<40} {row['count']:>6} {fmt(row['failure_rate'], '.0%'):>6} "
+              f"{fmt(row['p50_ms'], '.0f'):>8} {fmt(row['p95_ms'], '.0f'):>8} {fmt(row['mean_tokens'], '.0f'):>7}")
@@ -1,38 +1,78 @@
-import os
-import openai
-from dotenv import load_dotenv
 import sqlite3
-import json
-import streamlit as st
-import pandas as pd
-from utils import get_db_path, load_env
-from visualization import generate_visualization
+from model_router import complete
 from follow_up import generate_follow_up_questions
+from metrics import span
+import scratch
+import derived
+import query_pool
+from rollups import rewrite_query
+from sampling import approximate_query
+from fts_index import rewrite_like
+from catalog import get_catalog
+
+# openai, pyarrow and pandas are imported where they are first needed, so
+# importing this module stays cheap for workers, tests and scripts
+
+def open_query_connection(db_path, conversation=None):
+    """
+    Connection for answering questions: the user's database, with the
+    conversation's scratch database and the derived rollup tables attached.
+    """
+    conn = scratch.connect(db_path, conversation) if conversation else sqlite3.connect(db_path)
+    if derived.has_derived(db_path):
+        derived.attach(conn, db_path)
+    return conn
+
+def uses_rollup(sql_query, db_path):
+    """Whether a query would be answered from a rollup table."""
+    conn = open_query_connection(db_path)
+    try:
+        return rewrite_query(sql_query, conn) != sql_query
+    finally:
+        conn.close()
 
-# Load environment variables at the start
-load_dotenv()
-
-# Debug print for API key (first few characters)
-api_key = os.getenv("OPENAI_API_KEY")
-print(f"API Key loaded in nl2sql.py starts with: {api_key[:10]}...")
-
-# Initialize OpenAI client
-openai.api_key = api_key
+def rewrite_for_execution(sql_query, conn, db_path):
+    """The query to actually run: answered from a rollup or through a trigram index where possible."""
+    executed_query = rewrite_query(sql_query, conn)
+    if executed_query == sql_query:
+        executed_query = rewrite_like(sql_query, conn, db_path)
+    if executed_query != sql_query:
+        print(f"Rewritten query: {executed_query}")
+    return executed_query
 
-def execute_sql(sql_query, db_path):
+def execute_sql(sql_query, db_path, columnar=False, conversation=None):
     """
     Runs the given SQL query against the SQLite database and returns results and columns.
+
+    With columnar=True the results are a typed Arrow table built straight from
+    the cursor instead of a list of row tuples. With a conversation id the
+    conversation's scratch database is attached, so the query can read
+    earlier answers. Aggregate queries that a rollup can answer are run
+    against the rollup instead of the base table, and `LIKE '%text%'` filters
+    on indexed text columns go through their trigram index. On the query
+    pool, cancelling the job interrupts the running query.
     """
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        results = cursor.fetchall()
-        columns = [description[0] for description in cursor.description]
-        conn.close()
+        with span('execute') as s:
+            conn = query_pool.interrupt_on_cancel(open_query_connection(db_path, conversation))
+            try:
+                executed_query = rewrite_for_execution(sql_query, conn, db_path)
+                if columnar:
+                    from columnar import execute_to_arrow
+                    results = execute_to_arrow(executed_query, db_path, conn=conn)
+                    columns = results.column_names
+                    s['rows'] = results.num_rows
+                    return results, columns
+                cursor = conn.cursor()
+                cursor.execute(executed_query)
+                results = cursor.fetchall()
+                columns = [description[0] for description in cursor.description]
+                s['rows'] = len(results)
+            finally:
+                conn.close()
         return results, columns
     except Exception as e:
-        st.error(f"Error executing SQL query: {e}")
+        print(f"Error executing SQL query: {e}")
         return None, None
 
 def refine_query(user_query, schema):
@@ -98,16 +138,11 @@ def refine_query(user_query, schema):
     """
 
     try:
-        response = openai.ChatCompletion.create(
-            model="chatgpt-4o-latest",
-            messages=[{"role": "system", "content": prompt}],
-            temperature=0.2
-        )
-        refined_query = response.choices[0].message.content.strip()
+        refined_query = complete('refine', [{"role": "system", "content": prompt}], temperature=0.2)
         print(f"Refined Query: {refined_query}")
         return refined_query
     except Exception as e:
-        st.error(f"Error refining user query: {e}")
+        print(f"Error refining user query: {e}")
         # Fallback to the original user query if refinement fails
         return user_query
 
@@ -121,26 +156,16 @@ def is_column_query(query):
     query_lower = query.lower()
     return any(keyword in query_lower for keyword in keywords)
 
+def _describe_columns(table):
+    return [f"{column['name']} ({column['type']})" for column in table['columns']]
+
 def get_table_columns(db_path, table_name=None):
     """Get column information from the database."""
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
+        tables = get_catalog(db_path)['tables']
         if table_name:
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = [f"{row[1]} ({row[2]})" for row in cursor.fetchall()]
-        else:
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = cursor.fetchall()
-            columns = {}
-            for table in tables:
-                table_name = table[0]
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns[table_name] = [f"{row[1]} ({row[2]})" for row in cursor.fetchall()]
-        
-        conn.close()
-        return columns
+            return _describe_columns(tables[table_name]) if table_name in tables else []
+        return {name: _describe_columns(entry) for name, entry in tables.items()}
     except Exception as e:
         print(f"Error getting columns: {e}")
         return None
@@ -192,15 +217,10 @@ def classify_query(user_query, schema):
     """
 
     try:
-        response = openai.ChatCompletion.create(
-            model="chatgpt-4o-latest",
-            messages=[
-                {"role": "system", "content": "You are an expert data analyst and business consultant."},
-                {"role": "user", "content": classification_prompt}
-            ],
-            temperature=0.1  # Lower temperature for more consistent classification
-        )
-        answer = response.choices[0].message.content.strip()
+        answer = complete('classify', [
+            {"role": "system", "content": "You are an expert data analyst and business consultant."},
+            {"role": "user", "content": classification_prompt}
+        ], temperature=0.1)  # Lower temperature for more consistent classification
         
         if answer.upper() == "DB":
             return True, None
@@ -208,15 +228,41 @@ def classify_query(user_query, schema):
             return False, answer
 
     except Exception as e:
-        st.error(f"Error in classification step: {e}")
+        print(f"Error in classification step: {e}")
         return False, "I apologize, but I encountered an error processing your question. Could you please rephrase it?"
 
-def generate_sql(user_query, schema):
+def sql_error(sql_query, db_path=None, conversation=None):
+    """Why generated SQL is unusable, or None. It must be a SELECT that compiles against the database."""
+    if not sql_query.upper().startswith('SELECT'):
+        return "Generated query does not start with SELECT"
+    if db_path:
+        conn = open_query_connection(db_path, conversation)
+        try:
+            conn.execute(f"EXPLAIN {sql_query}")
+        except sqlite3.Error as e:
+            return str(e)
+        finally:
+            conn.close()
+    return None
+
+def generate_sql(user_query, schema, intermediates=None, db_path=None, conversation=None):
     """
     Generate an SQL query based on user query and metadata using LLM.
     Enhance the prompt to focus on aggregated or filtered results.
+
+    `intermediates` describes earlier answers of the conversation that are
+    stored as tables in the attached scratch database. With db_path, SQL
+    that does not compile against the database is rejected.
     """
     schema_text = schema
+    if intermediates:
+        schema_text += f"""
+
+    Results of earlier questions in this conversation are stored in these tables:
+    {intermediates}
+    If the question drills into or refers back to one of those answers, query its
+    scratch table instead of the base tables; it is much smaller.
+    """
 
     prompt = f"""
     You are a helpful assistant that converts natural language questions into SQL queries.
@@ -238,24 +284,88 @@ def generate_sql(user_query, schema):
     """
 
     try:
-        response = openai.ChatCompletion.create(
-            model="chatgpt-4o-latest",  # Changed from chatgpt-4o-latest to gpt-4
-            messages=[{"role": "system", "content": prompt}],
-            max_tokens=1000,
-            temperature=0
-        )
-        sql_query = response.choices[0].message.content.strip()
-        if not sql_query.upper().startswith('SELECT'):
-            raise ValueError("Generated query does not start with SELECT")
+        # SQL that does not compile is regenerated by a stronger model
+        sql_query = complete('generate', [{"role": "system", "content": prompt}],
+                             check=lambda sql: sql_error(sql, db_path, conversation),
+                             max_tokens=1000, temperature=0)
         print(f"SQL Query: {sql_query}")
         return sql_query
     except Exception as e:
-        st.error(f"Error generating SQL: {e}")
+        print(f"Error generating SQL: {e}")
         return None
 
-def process_query(user_query, db_path, schema):
+def build_answer(user_query, schema, sql_query, results, columns, follow_up_questions=None):
+    """Summary, follow-up questions and default chart data for a query result."""
+    from columnar import numeric_columns, categorical_columns
+    from downsample import reduce_for_chart
+    summary = summarize_results(sql_query, results, columns)
+    if follow_up_questions is None:
+        follow_up_questions = generate_follow_up_questions(user_query, schema)
+
+    # Ensure numeric and categorical columns are properly identified
+    numeric_cols = numeric_columns(results)
+    categorical_cols = categorical_columns(results)
+
+    # Default to first column if no categorical columns
+    default_x = categorical_cols[0] if categorical_cols else columns[0]
+    default_y = numeric_cols[0] if numeric_cols else columns[0]
+
+    # Only ship what the default chart can draw; the exact rows
+    # stay in "results" for tables and exports. Columns are picked by
+    # position, as joins can return several columns with the same name
+    names = results.column_names
+    chart_df = results.select(list(dict.fromkeys([names.index(default_x), names.index(default_y)]))).to_pandas()
+    chart_df = reduce_for_chart(chart_df, "bar", default_x, default_y)
+
+    # Prepare visualization data
+    viz_data = {
+        "data": chart_df.to_dict('records'),
+        "row_count": results.num_rows,
+        "reduced": len(chart_df) < results.num_rows,
+        "columns": columns,
+        "numeric_columns": numeric_cols,
+        "categorical_columns": categorical_cols,
+        "default_settings": {
+            "chart_type": "bar",
+            "x_col": default_x,
+            "y_col": default_y
+        }
+    }
+
+    return {
+        "sql_query": sql_query,
+        "summary": summary,
+        "visualization": viz_data,
+        "follow_up_questions": follow_up_questions,
+        "results": results,
+        "columns": columns
+    }
+
+def answer_exactly(user_query, db_path, schema, sql_query, conversation=None, follow_up_questions=None):
+    """Run already generated SQL on the full table, e.g. to replace an approximate answer."""
+    query_pool.check_cancelled()
+    results, columns = execute_sql(sql_query, db_path, columnar=True, conversation=conversation)
+    query_pool.check_cancelled()
+    if results is None:
+        return None
+    if conversation:
+        scratch.materialize_result(db_path, conversation, user_query, sql_query, results)
+    return build_answer(user_query, schema, sql_query, results, columns, follow_up_questions)
+
+def process_query(user_query, db_path, schema, conversation=None, approximate=False, progress=None):
+    """
+    Answer a question about the database. With a conversation id, earlier
+    answers are offered to SQL generation and this answer is stored for
+    follow-ups. With approximate=True, aggregate queries on sampled tables
+    are answered from the sample and the response carries an "approximate"
+    entry with the sample size and confidence intervals. `progress`, if
+    given, is called as progress(event, data) when the SQL is generated
+    ("sql") and when its results are in ("results"), before the summary.
+    On the query pool, a cancelled job stops between stages with JobCancelled.
+    """
     try:
         is_db_query, classification_response = classify_query(user_query, schema)
+        query_pool.check_cancelled()
         
         if is_db_query:
             if classification_response == "SHOW_COLUMNS":  # Changed to match new classification
@@ -283,55 +393,42 @@ def process_query(user_query, db_path, schema):
             
             # Continue with normal query processing
             refined_query = refine_query(user_query, schema)
+            query_pool.check_cancelled()
             if refined_query:
-                sql_query = generate_sql(refined_query, schema)
+                intermediates = scratch.describe_intermediates(db_path, conversation) if conversation else ""
+                sql_query = generate_sql(refined_query, schema, intermediates, db_path, conversation)
+                query_pool.check_cancelled()
                 if not sql_query:
                     return {"summary": "Failed to generate SQL query. Please try rephrasing your question."}
+                if progress:
+                    progress('sql', {'sql_query': sql_query})
                 
-                results, columns = execute_sql(sql_query, db_path)
+                # Answer from the table's sample first when asked to, unless a
+                # rollup answers exactly; the caller runs the exact query with
+                # answer_exactly
+                if approximate and not uses_rollup(sql_query, db_path):
+                    with span('approximate') as s:
+                        approx = approximate_query(sql_query, db_path)
+                        s['rows'] = approx[0].num_rows if approx else None
+                    query_pool.check_cancelled()
+                    if approx:
+                        if progress:
+                            progress('results', {'results': approx[0], 'columns': approx[0].column_names})
+                        response = build_answer(user_query, schema, sql_query, approx[0], approx[0].column_names)
+                        response['approximate'] = approx[1]
+                        return response
+
+                # Results come back as a typed Arrow table; column types are
+                # read from its schema rather than re-inferred
+                results, columns = execute_sql(sql_query, db_path, columnar=True, conversation=conversation)
+                query_pool.check_cancelled()
                 if results is not None:
-                    df = pd.DataFrame(results, columns=columns)
-                    
-                    # Convert numeric columns if possible
-                    for col in df.columns:
-                        try:
-                            df[col] = pd.to_numeric(df[col], errors='ignore')
-                        except:
-                            continue
-                    
-                    # Get summary and follow-up questions
-                    summary = summarize_results(sql_query, results, columns)
-                    follow_up_questions = generate_follow_up_questions(user_query, schema)
-                    
-                    # Ensure numeric and categorical columns are properly identified
-                    numeric_cols = df.select_dtypes(include=['int64', 'float64']).columns.tolist()
-                    categorical_cols = df.select_dtypes(include=['object']).columns.tolist()
-                    
-                    # Default to first column if no categorical columns
-                    default_x = categorical_cols[0] if categorical_cols else columns[0]
-                    default_y = numeric_cols[0] if numeric_cols else columns[0]
-                    
-                    # Prepare visualization data
-                    viz_data = {
-                        "data": df.to_dict('records'),
-                        "columns": columns,
-                        "numeric_columns": numeric_cols,
-                        "categorical_columns": categorical_cols,
-                        "default_settings": {
-                            "chart_type": "bar",
-                            "x_col": default_x,
-                            "y_col": default_y
-                        }
-                    }
-                    
-                    return {
-                        "sql_query": sql_query,
-                        "summary": summary,
-                        "visualization": viz_data,
-                        "follow_up_questions": follow_up_questions,
-                        "results": results,
-                        "columns": columns
-                    }
+                    if progress:
+                        progress('results', {'results': results, 'columns': columns})
+                    if conversation:
+                        scratch.touch_intermediates(db_path, conversation, sql_query)
+                        scratch.materialize_result(db_path, conversation, user_query, sql_query, results)
+                    return build_answer(user_query, schema, sql_query, results, columns)
                 else:
                     return {"summary": "No results found for this query."}
         else:
@@ -343,6 +440,8 @@ def process_query(user_query, db_path, schema):
                 "follow_up_questions": None
             }
         
+    except query_pool.JobCancelled:
+        raise
     except Exception as e:
         print(f"Error in process_query: {str(e)}")  # Add debug print
         return {
@@ -356,16 +455,23 @@ def summarize_results(sql_query, results, columns):
     """
     Generate a natural language summary of the SQL query results.
     """
-    if not results:
+    if results is None or len(results) == 0:
         return "No results found for this query."
     
     try:
+        # Statistics over every row, rendered in a fixed token budget, so the
+        # prompt stays the same size however large the result is
+        from columnar import rows_to_table
+        from digest import build_digest
+        table = rows_to_table(results, columns) if isinstance(results, list) else results
+        result_digest = build_digest(table)
         summary_prompt = f"""
         As a data insights specialist, analyze these SQL query results:
 
         Query: {sql_query}
-        Results (First 5): {results[:5]}
         Columns: {columns}
+        Digest of all {table.num_rows} result rows:
+{result_digest}
 
         Provide a concise summary that:
         1. Highlights key findings and patterns
@@ -384,13 +490,7 @@ def summarize_results(sql_query, results, columns):
         Focus on actionable insights rather than just describing the data.
         """
 
-        response = openai.ChatCompletion.create(
-            model="chatgpt-4o-latest",
-            messages=[{"role": "system", "content": summary_prompt}],
-            temperature=0.3,
-            max_tokens=600
-        )
-        
-        return response.choices[0].message.content.strip()
+        return complete('summarize', [{"role": "system", "content": summary_prompt}],
+                        temperature=0.3, max_tokens=600)
     except Exception as e:
         return f"Error generating summary: {str(e)}"
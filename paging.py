@@ -0,0 +1,182 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from scratch import SCRATCH_SCHEMA
+
+# Table views page through an answer's full result without holding it. The
+# first request runs the answer's SQL (without its display LIMIT) once into a
+# table in the conversation's scratch database. Each sort order gets a table
+# of row positions, 1..n, and a page is read by seeking to its first
+# position, so the millionth row costs the same as the first.
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+# Pages kept in memory per process, most recently used
+PAGE_CACHE_PAGES = int(os.getenv("PAGE_CACHE_PAGES", "64"))
+# Disk budget for paged results per conversation; least recently used go first
+PAGING_MAX_BYTES = int(os.getenv("PAGING_MAX_MB", "512")) * 1024 * 1024
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def result_name(sql_query):
+    """Scratch table holding the full result of a query."""
+    from export import full_result_sql
+    return f"pages_{hashlib.sha256(full_result_sql(sql_query).encode()).hexdigest()[:16]}"
+
+def _ensure_meta(conn):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {SCRATCH_SCHEMA}.paged_results (
+        name TEXT PRIMARY KEY,
+        sql_query TEXT,
+        row_count INTEGER,
+        bytes INTEGER,
+        last_used REAL
+    )
+    ''')
+
+def _connect(db_path, conversation):
+    from nl2sql import open_query_connection
+    conn = open_query_connection(db_path, conversation)
+    _ensure_meta(conn)
+    return conn
+
+def _scratch_bytes(conn):
+    page_count = conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.page_count").fetchone()[0]
+    page_size = conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.page_size").fetchone()[0]
+    return page_count * page_size
+
+def _drop(conn, name):
+    tables = [row[0] for row in conn.execute(
+        f"SELECT name FROM {SCRATCH_SCHEMA}.sqlite_master WHERE type = 'table' AND (name = ? OR name LIKE ?)",
+        (name, f"{name}_by_%"))]
+    for table in tables:
+        conn.execute(f"DROP TABLE IF EXISTS {SCRATCH_SCHEMA}.{_quote(table)}")
+    conn.execute(f"DELETE FROM {SCRATCH_SCHEMA}.paged_results WHERE name = ?", (name,))
+    with _cache_lock:
+        for key in [key for key in _cache if key[1] == name]:
+            del _cache[key]
+
+def evict(conn, keep=None, max_bytes=None):
+    """Drop least recently used paged results until they fit their budget."""
+    max_bytes = PAGING_MAX_BYTES if max_bytes is None else max_bytes
+    rows = conn.execute(f"SELECT name, bytes FROM {SCRATCH_SCHEMA}.paged_results ORDER BY last_used ASC").fetchall()
+    total = sum(size for _, size in rows)
+    evicted = []
+    for name, size in rows:
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        _drop(conn, name)
+        total -= size
+        evicted.append(name)
+    if evicted:
+        conn.commit()
+        conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.incremental_vacuum")
+    return evicted
+
+def open_result(db_path, conversation, sql_query):
+    """
+    Make sure the full result of a query is stored for paging. Returns its
+    table name and row count; only the first call runs the query.
+    """
+    from export import full_result_sql
+    from nl2sql import rewrite_for_execution
+    name = result_name(sql_query)
+    conn = _connect(db_path, conversation)
+    try:
+        row = conn.execute(f"SELECT row_count FROM {SCRATCH_SCHEMA}.paged_results WHERE name = ?",
+                           (name,)).fetchone()
+        if row is None:
+            query = rewrite_for_execution(full_result_sql(sql_query), conn, db_path)
+            before = _scratch_bytes(conn)
+            # Rows get rowids 1..n in the query's own order
+            conn.execute(f"CREATE TABLE {SCRATCH_SCHEMA}.{_quote(name)} AS SELECT * FROM ({query})")
+            count = conn.execute(f"SELECT COUNT(*) FROM {SCRATCH_SCHEMA}.{_quote(name)}").fetchone()[0]
+            conn.execute(f"INSERT INTO {SCRATCH_SCHEMA}.paged_results VALUES (?, ?, ?, ?, ?)",
+                         (name, sql_query, count, _scratch_bytes(conn) - before, time.time()))
+            conn.commit()
+            evict(conn, keep=name)
+            return name, count
+        conn.execute(f"UPDATE {SCRATCH_SCHEMA}.paged_results SET last_used = ? WHERE name = ?",
+                     (time.time(), name))
+        conn.commit()
+        return name, row[0]
+    finally:
+        conn.close()
+
+def result_columns(db_path, conversation, sql_query):
+    """Column names of a paged result, after open_result."""
+    conn = _connect(db_path, conversation)
+    try:
+        return [row[1] for row in conn.execute(
+            f"PRAGMA {SCRATCH_SCHEMA}.table_info({_quote(result_name(sql_query))})")]
+    finally:
+        conn.close()
+
+def _position_table(conn, name, column):
+    """
+    Table of (pos, row) with the result's rowids in ascending order of
+    `column`, ties broken by the query's own order. Built on first use.
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.table_info({_quote(name)})")]
+    if column not in columns:
+        raise ValueError(f"No column {column} in the result")
+    positions = f"{name}_by_{columns.index(column)}"
+    exists = conn.execute(f"SELECT 1 FROM {SCRATCH_SCHEMA}.sqlite_master WHERE name = ?", (positions,)).fetchone()
+    if not exists:
+        before = _scratch_bytes(conn)
+        conn.execute(f"CREATE TABLE {SCRATCH_SCHEMA}.{_quote(positions)} (pos INTEGER PRIMARY KEY, row INTEGER)")
+        conn.execute(f'''
+        INSERT INTO {SCRATCH_SCHEMA}.{_quote(positions)} (row)
+        SELECT rowid FROM {SCRATCH_SCHEMA}.{_quote(name)} ORDER BY {_quote(column)}, rowid
+        ''')
+        conn.execute(f"UPDATE {SCRATCH_SCHEMA}.paged_results SET bytes = bytes + ? WHERE name = ?",
+                     (_scratch_bytes(conn) - before, name))
+        conn.commit()
+    return positions
+
+def get_page(db_path, conversation, sql_query, page, sort=None, descending=False, page_size=PAGE_SIZE):
+    """
+    Rows of one page (0-based) of a query's full result as a list of tuples,
+    sorted by the `sort` column if given, else in the query's own order.
+    """
+    name = result_name(sql_query)
+    key = (conversation, name, sort, descending, page, page_size)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    name, count = open_result(db_path, conversation, sql_query)
+    table = f"{SCRATCH_SCHEMA}.{_quote(name)}"
+    conn = _connect(db_path, conversation)
+    try:
+        if sort is None:
+            # rowids are the positions in the query's own order
+            select, source, pos = "*", table, "rowid"
+        else:
+            positions = f"{SCRATCH_SCHEMA}.{_quote(_position_table(conn, name, sort))}"
+            select, source, pos = "t.*", f"{positions} p JOIN {table} t ON t.rowid = p.row", "p.pos"
+        # Seek to the page's first position instead of skipping rows with OFFSET
+        if descending:
+            rows = conn.execute(f"SELECT {select} FROM {source} WHERE {pos} <= ? ORDER BY {pos} DESC LIMIT ?",
+                                (count - page * page_size, page_size)).fetchall()
+        else:
+            rows = conn.execute(f"SELECT {select} FROM {source} WHERE {pos} > ? ORDER BY {pos} LIMIT ?",
+                                (page * page_size, page_size)).fetchall()
+    finally:
+        conn.close()
+
+    with _cache_lock:
+        _cache[key] = rows
+        while len(_cache) > PAGE_CACHE_PAGES:
+            _cache.popitem(last=False)
+    return rows
+
+def page_count(row_count, page_size=PAGE_SIZE):
+    return max(1, -(-row_count // page_size))
@@ -0,0 +1,180 @@
+import os
+import json
+import datetime
+import query_pool
+import singleflight
+import sampling
+import scratch
+import storage
+import refresh
+from nl2sql import process_query, answer_exactly
+from cache import get_cached_response, cache_response, get_cache_key
+from database import get_database_schema
+from rollups import ensure_rollups
+from fts_index import ensure_fts_indexes
+
+# The core question -> SQL -> result -> summary flow, shared by the Streamlit
+# app and the HTTP API. Nothing here touches a UI; errors are printed and
+# surface as the response summary or a None result.
+
+# Rows of a result included in JSON responses
+API_MAX_ROWS = int(os.getenv("API_MAX_ROWS", "1000"))
+
+def prepare_database(db_path, schema=None, username=None):
+    """
+    Build or refresh the rollups, samples and text indexes of an uploaded
+    database. With a username, cached answers computed on other data of the
+    same schema are refreshed for this one in the background.
+    """
+    try:
+        ensure_rollups(db_path, schema)
+        sampling.ensure_samples(db_path)
+        ensure_fts_indexes(db_path)
+    except Exception as e:
+        print(f"Error building rollups: {e}")
+    if username:
+        refresh.start_refresh(username, db_path, schema or load_schema(db_path))
+
+def load_schema(db_path):
+    """Schema text of a database, as passed to the prompts and used in cache keys."""
+    return get_database_schema(db_path)
+
+def is_cacheable(response):
+    """
+    Answers from a sample are replaced by the exact one, which is cached
+    instead. Answers reading a conversation's scratch tables hold only in
+    that conversation and are never shared.
+    """
+    return bool(response and response.get('sql_query') and not response.get('approximate')
+                and not scratch.reads_scratch(response['sql_query']))
+
+def _shared_answer(question, schema, version):
+    """A cached answer that any conversation may use."""
+    response = get_cached_response(question, schema, version)
+    if response and scratch.reads_scratch(response.get('sql_query')):
+        return None
+    return response
+
+def claim_question(question, schema, timeout=0, db_path=None):
+    """
+    One step of waiting for an identical question being answered elsewhere.
+    Returns ('cached', response) when the answer is in the cache, ('claimed',
+    token) when the caller should answer it and pass the token to
+    submit_question, or ('waiting', None) when it should ask again later.
+    With db_path, answers computed on other data count as not cached.
+    """
+    version = storage.data_version(db_path) if db_path else None
+    cached_response = _shared_answer(question, schema, version)
+    if cached_response:
+        return 'cached', cached_response
+    cache_key = get_cache_key(question, schema, version)
+    token = singleflight.acquire(cache_key)
+    if token:
+        # The other answer may have landed just before the lock was free
+        cached_response = _shared_answer(question, schema, version)
+        if cached_response:
+            singleflight.release(cache_key, token)
+            return 'cached', cached_response
+        return 'claimed', token
+    if timeout:
+        singleflight.wait(cache_key, timeout)
+    return 'waiting', None
+
+def cache_answer(question, schema, response, db_path=None):
+    """Store an answer in the query cache if it is one that should be reused."""
+    if is_cacheable(response):
+        cache_response(question, schema, response['sql_query'],
+                       response['summary'], response['visualization'],
+                       response['follow_up_questions'], response.get('results', []),
+                       response.get('columns', []),
+                       storage.data_version(db_path) if db_path else None)
+
+def _replay_stale(question, db_path, schema, conversation, progress):
+    """Answer from the stored SQL of an answer computed on other data, if there is one that still runs."""
+    cached = refresh.stale_answer(question, schema, db_path)
+    replayed = refresh.replay_answer(question, db_path, schema, cached) if cached else None
+    if replayed is None:
+        return None
+    response = replayed[0]
+    if progress:
+        progress('sql', {'sql_query': response['sql_query']})
+        progress('results', {'results': response['results'], 'columns': response['columns']})
+    if conversation:
+        scratch.materialize_result(db_path, conversation, question, response['sql_query'], response['results'])
+    return response
+
+def _answer_and_cache(question, db_path, schema, conversation, approximate, progress):
+    response = None if approximate else _replay_stale(question, db_path, schema, conversation, progress)
+    query_pool.check_cancelled()
+    if response is None:
+        response = process_query(question, db_path, schema, conversation=conversation,
+                                 approximate=approximate, progress=progress)
+    cache_answer(question, schema, response, db_path)
+    return response
+
+def submit_question(username, question, db_path, schema, token=None, conversation=None,
+                    approximate=False, progress=None):
+    """
+    Answer a question on the query pool and cache the answer. Returns the pool
+    Job; its result is the process_query response. The single-flight token
+    from claim_question is released when the job ends, however it ends.
+    """
+    # Databases in use are the last to be evicted from storage
+    storage.touch(db_path)
+    job = query_pool.submit(username, _answer_and_cache, question, db_path, schema,
+                            conversation, approximate, progress)
+    cache_key = get_cache_key(question, schema, storage.data_version(db_path))
+    job.add_done_callback(lambda _: singleflight.release(cache_key, token))
+    return job
+
+def _exact_and_cache(question, db_path, schema, sql_query, conversation, follow_up_questions):
+    response = answer_exactly(question, db_path, schema, sql_query, conversation, follow_up_questions)
+    cache_answer(question, schema, response, db_path)
+    return response
+
+def submit_exact(username, question, db_path, schema, response, conversation=None):
+    """
+    Compute the exact answer behind an approximate response on the pool, at
+    refine priority, and cache it. Returns the pool Job; its result is the
+    exact response, or None if the query failed.
+    """
+    return query_pool.submit(username, _exact_and_cache, question, db_path, schema,
+                             response['sql_query'], conversation, response['follow_up_questions'],
+                             priority=query_pool.REFINE)
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+def result_rows(results, limit=API_MAX_ROWS):
+    """First `limit` rows of a result as lists, from an Arrow table or row tuples."""
+    import pyarrow as pa
+    if isinstance(results, pa.Table):
+        head = results.slice(0, limit)
+        return [list(row) for row in zip(*(column.to_pylist() for column in head.columns))]
+    return [list(row) for row in (results or [])[:limit]]
+
+def result_count(results):
+    import pyarrow as pa
+    if isinstance(results, pa.Table):
+        return results.num_rows
+    return len(results or [])
+
+def response_to_json(response, limit=API_MAX_ROWS):
+    """A response as a JSON-serializable dict, with at most `limit` result rows."""
+    if response is None:
+        return None
+    payload = {key: value for key, value in response.items() if key != 'results'}
+    if 'results' in response:
+        payload['columns'] = list(response.get('columns') or [])
+        payload['rows'] = result_rows(response['results'], limit)
+        payload['row_count'] = result_count(response['results'])
+        payload['truncated'] = payload['row_count'] > len(payload['rows'])
+    return payload
+
+def dumps(payload):
+    """JSON text of a payload built by response_to_json or progress events."""
+    return json.dumps(payload, default=_json_default)
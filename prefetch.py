@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+import query_pool
+from nl2sql import process_query
+import singleflight
+import storage
+from cache import get_cached_response, get_cache_key
+from pipeline import cache_answer, is_cacheable
+
+# Per-user spend limit; prefetches run at background priority on the query pool
+PREFETCH_BUDGET_PER_HOUR = int(os.getenv("PREFETCH_BUDGET_PER_HOUR", "30"))
+
+# Re-entrant because job callbacks may run synchronously while it is held
+_lock = threading.RLock()
+_user_state = {}
+
+def _get_user_state(username):
+    return _user_state.setdefault(username, {'tasks': {}, 'spent': []})
+
+def _run_prefetch(cancelled, question, db_path, schema):
+    """Answer a suggested question in the background and store it in the query cache."""
+    if cancelled.is_set():
+        return False
+    version = storage.data_version(db_path)
+    if get_cached_response(question, schema, version):
+        return True
+
+    # Someone is already answering this question and will cache the answer
+    cache_key = get_cache_key(question, schema, version)
+    token = singleflight.acquire(cache_key)
+    if token is None:
+        return False
+    try:
+        response = process_query(question, db_path, schema)
+        if cancelled.is_set():
+            return False
+        if not is_cacheable(response):
+            return False
+        cache_answer(question, schema, response, db_path)
+        return True
+    finally:
+        singleflight.release(cache_key, token)
+
+def _take_budget(state):
+    """Reserve one prefetch from the user's hourly budget. Caller holds the lock."""
+    cutoff = time.time() - 3600
+    state['spent'] = [t for t in state['spent'] if t > cutoff]
+    if len(state['spent']) >= PREFETCH_BUDGET_PER_HOUR:
+        return False
+    state['spent'].append(time.time())
+    return True
+
+def prefetch_follow_ups(username, questions, db_path, schema):
+    """
+    Precompute answers for suggested follow-up questions.
+
+    Any prefetches still queued for this user are cancelled first, so only the
+    suggestions for the latest answer are worked on.
+    """
+    if not username or not questions or not db_path:
+        return
+    cancel_prefetch(username)
+    with _lock:
+        state = _get_user_state(username)
+        for question in questions:
+            if question in state['tasks'] or not _take_budget(state):
+                continue
+            cancelled = threading.Event()
+            job = query_pool.submit(username, _run_prefetch, cancelled, question, db_path, schema,
+                                    priority=query_pool.BACKGROUND)
+            state['tasks'][question] = (job, cancelled)
+            job.add_done_callback(lambda j, q=question: _forget(username, q, j))
+
+def _forget(username, question, job):
+    with _lock:
+        tasks = _get_user_state(username)['tasks']
+        if question in tasks and tasks[question][0] is job:
+            del tasks[question]
+
+def cancel_prefetch(username, keep=None):
+    """Cancel this user's prefetches, except the one for `keep` if given."""
+    with _lock:
+        tasks = _get_user_state(username)['tasks']
+        for question, (job, cancelled) in list(tasks.items()):
+            if question == keep:
+                continue
+            cancelled.set()
+            job.cancel()
+            tasks.pop(question, None)
+
+def wait_for_prefetch(username, question, timeout=60):
+    """If `question` is being prefetched, wait for it so the answer comes from cache."""
+    with _lock:
+        task = _get_user_state(username)['tasks'].get(question)
+    if task is None:
+        return False
+    job = task[0]
+    try:
+        return bool(job.result(timeout=timeout))
+    except Exception as e:
+        print(f"Prefetch for '{question}' did not finish: {e}")
+        return False
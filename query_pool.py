@@ -0,0 +1,304 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from metrics import record_span
+
+# Questions run on a shared pool instead of each session's script thread.
+# Total concurrency is capped, users take turns within a priority level, and
+# background work never takes the last worker.
+QUERY_POOL_WORKERS = int(os.getenv("QUERY_POOL_WORKERS", "4"))
+QUERY_POOL_PER_USER = int(os.getenv("QUERY_POOL_PER_USER", "2"))
+# Background (prefetch) jobs may use at most this many workers at once
+QUERY_POOL_BACKGROUND = max(1, min(int(os.getenv("PREFETCH_WORKERS", "2")), QUERY_POOL_WORKERS - 1))
+
+# Priorities, highest first
+INTERACTIVE = 0   # a question the user is waiting for
+REFINE = 1        # exact answers replacing approximate ones
+BACKGROUND = 2    # speculative work such as prefetching
+
+# Window over which utilization is reported
+UTILIZATION_WINDOW = 300
+# SQLite virtual machine steps between checks for cancellation of a running query
+CANCEL_CHECK_STEPS = 10000
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """A unit of work on the pool; a small future with queue position and cancellation."""
+
+    def __init__(self, username, priority, fn, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.state = QUEUED
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = threading.Event()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def position(self):
+        """Place in the queue, 1 being next to start; 0 once running."""
+        return _position(self)
+
+    def cancel(self):
+        """
+        Cancel the job. Queued jobs are dropped; running jobs are flagged via
+        `cancelled`, stop at their next check_cancelled() or inside a running
+        query, and their result is discarded when they finish.
+        """
+        _cancel(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the job and return its result, raising its error if it failed."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Job did not finish in time")
+        if self.state == CANCELLED:
+            raise RuntimeError("Job was cancelled")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call callback(job) when the job finishes, now if it already has."""
+        with _lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, state, result=None, error=None):
+        with _lock:
+            if self._done.is_set():
+                return
+            self.state = state
+            self._result = result
+            self._error = error
+            self.finished_at = time.time()
+            callbacks, self._callbacks = self._callbacks, []
+            self._done.set()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Error in job callback: {e}")
+
+# Re-entrant because job callbacks may run while it is held
+_lock = threading.RLock()
+_work = threading.Condition(_lock)
+_queues = {}          # priority -> OrderedDict(username -> deque of jobs)
+_running = {}         # job id -> job
+_workers = []
+_busy_periods = deque()  # (start, end) of finished jobs, for utilization
+_current = threading.local()  # the job a worker thread is running
+
+def _ensure_workers():
+    """Start the worker threads on first use. Caller holds the lock."""
+    while len(_workers) < QUERY_POOL_WORKERS:
+        worker = threading.Thread(target=_worker_loop, name=f"query-pool-{len(_workers)}", daemon=True)
+        _workers.append(worker)
+        worker.start()
+
+def submit(username, fn, *args, priority=INTERACTIVE, **kwargs):
+    """Queue fn(*args, **kwargs) for `username` and return its Job."""
+    job = Job(username, priority, fn, args, kwargs)
+    with _lock:
+        _ensure_workers()
+        _queues.setdefault(priority, OrderedDict()).setdefault(username, deque()).append(job)
+        _work.notify()
+    return job
+
+def _running_for(username, background):
+    return sum(1 for job in _running.values()
+               if job.username == username and (job.priority == BACKGROUND) == background)
+
+def _can_start(priority, username):
+    # Prefetches have their own per-user allowance, so they never keep the
+    # user's own questions waiting
+    if _running_for(username, priority == BACKGROUND) >= QUERY_POOL_PER_USER:
+        return False
+    if priority == BACKGROUND:
+        background = sum(1 for job in _running.values() if job.priority == BACKGROUND)
+        return background < QUERY_POOL_BACKGROUND
+    return True
+
+def _next_job():
+    """
+    Take the next job to run: highest priority first, and within a priority
+    the users take turns, one job each. Caller holds the lock.
+    """
+    for priority in sorted(_queues):
+        users = _queues[priority]
+        for username in list(users):
+            if not _can_start(priority, username):
+                continue
+            jobs = users[username]
+            job = jobs.popleft()
+            # The user goes to the back of the line for their next job
+            del users[username]
+            if jobs:
+                users[username] = jobs
+            return job
+    return None
+
+def _schedule_order():
+    """All queued jobs in the order they would start if nothing else arrived. Caller holds the lock."""
+    order = []
+    for priority in sorted(_queues):
+        lines = [deque(jobs) for jobs in _queues[priority].values()]
+        while any(lines):
+            for line in lines:
+                if line:
+                    order.append(line.popleft())
+    return order
+
+def _position(job):
+    with _lock:
+        if job.state != QUEUED:
+            return 0
+        order = _schedule_order()
+        return order.index(job) + 1 if job in order else 0
+
+def _remove_queued(job):
+    users = _queues.get(job.priority, {})
+    jobs = users.get(job.username)
+    if jobs and job in jobs:
+        jobs.remove(job)
+        if not jobs:
+            del users[job.username]
+        return True
+    return False
+
+def _cancel(job):
+    with _lock:
+        job.cancelled.set()
+        removed = job.state == QUEUED and _remove_queued(job)
+    if removed:
+        job._finish(CANCELLED)
+
+def cancel_user_jobs(username, priority=None):
+    """Cancel all of a user's queued and running jobs, optionally of one priority."""
+    with _lock:
+        jobs = [job for users in _queues.values() for job in users.get(username, [])]
+        jobs += [job for job in _running.values() if job.username == username]
+    for job in jobs:
+        if priority is None or job.priority == priority:
+            job.cancel()
+
+def cancel_event():
+    """The `cancelled` event of the job running on this thread, None outside the pool."""
+    job = getattr(_current, 'job', None)
+    return job.cancelled if job is not None else None
+
+def check_cancelled():
+    """Raise JobCancelled if the job running on this thread was cancelled; call between stages of work."""
+    event = cancel_event()
+    if event is not None and event.is_set():
+        raise JobCancelled("Job was cancelled")
+
+def interrupt_on_cancel(conn):
+    """Make a SQLite connection abort its running statement once this thread's job is cancelled."""
+    event = cancel_event()
+    if event is not None:
+        conn.set_progress_handler(lambda: 1 if event.is_set() else 0, CANCEL_CHECK_STEPS)
+    return conn
+
+def _record(stage, started, duration_s, error=None):
+    try:
+        record_span({
+            'stage': stage,
+            'started_at': datetime.fromtimestamp(started).isoformat(),
+            'duration_ms': duration_s * 1000,
+            'error': error
+        })
+    except Exception as e:
+        print(f"Error recording span: {e}")
+
+def _worker_loop():
+    while True:
+        with _lock:
+            job = _next_job()
+            while job is None:
+                _work.wait()
+                job = _next_job()
+            job.state = RUNNING
+            job.started_at = time.time()
+            _running[job.id] = job
+        _record('queue_wait', job.submitted_at, job.started_at - job.submitted_at)
+
+        result, error = None, None
+        _current.job = job
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except Exception as e:
+            error = e
+        finally:
+            _current.job = None
+        finished = time.time()
+        _record('query_job', job.started_at, finished - job.started_at, str(error) if error else None)
+
+        with _lock:
+            _running.pop(job.id, None)
+            _busy_periods.append((job.started_at, finished))
+            cutoff = finished - UTILIZATION_WINDOW
+            while _busy_periods and _busy_periods[0][1] < cutoff:
+                _busy_periods.popleft()
+            # A finished job may let a user or background job start
+            _work.notify_all()
+        if job.cancelled.is_set():
+            job._finish(CANCELLED)
+        elif error is not None:
+            job._finish(FAILED, error=error)
+        else:
+            job._finish(DONE, result=result)
+
+def pool_stats():
+    """Current queue length, running jobs and worker utilization over the last few minutes."""
+    now = time.time()
+    with _lock:
+        queued = sum(len(jobs) for users in _queues.values() for jobs in users.values())
+        start = now - UTILIZATION_WINDOW
+        busy = sum(min(end, now) - max(begin, start) for begin, end in _busy_periods if end > start)
+        busy += sum(now - max(job.started_at, start) for job in _running.values())
+        return {
+            'workers': QUERY_POOL_WORKERS,
+            'running': len(_running),
+            'queued': queued,
+            'utilization': busy / (QUERY_POOL_WORKERS * UTILIZATION_WINDOW)
+        }
+
+def export_pool_prometheus():
+    """Current pool gauges in the Prometheus text exposition format."""
+    stats = pool_stats()
+    return "\n".join([
+        '# HELP nl2sql_pool_workers Worker threads in the query pool.',
+        '# TYPE nl2sql_pool_workers gauge',
+        f'nl2sql_pool_workers {stats["workers"]}',
+        '# HELP nl2sql_pool_running Jobs running on the query pool.',
+        '# TYPE nl2sql_pool_running gauge',
+        f'nl2sql_pool_running {stats["running"]}',
+        '# HELP nl2sql_pool_queued Jobs waiting for a worker.',
+        '# TYPE nl2sql_pool_queued gauge',
+        f'nl2sql_pool_queued {stats["queued"]}',
+        '# HELP nl2sql_pool_utilization Share of worker time busy over the last five minutes.',
+        '# TYPE nl2sql_pool_utilization gauge',
+        f'nl2sql_pool_utilization {stats["utilization"]:.4f}'
+    ]) + "\n"
@@ -0,0 +1,107 @@
+import os
+import hashlib
+import query_pool
+import singleflight
+import storage
+from cache import get_cache_key, cache_response
+from database_cache import get_from_db_cache, get_other_version, get_stale_cached_answers
+from metrics import span
+from scratch import reads_scratch
+
+# Cached answers are kept per data version, so a database uploaded with the
+# schema of an earlier one but other data starts without answers. Rather than
+# generating their SQL again, the stored SQL of an answer on other data is
+# re-run on the new data and cached next to it; only answers whose results
+# changed get a new summary, the one model call left. The most asked
+# questions are refreshed in the background right after the upload, the
+# others when they are next asked.
+CACHE_REFRESH = os.getenv("CACHE_REFRESH", "1") == "1"
+# Stale answers refreshed per upload, most served first
+CACHE_REFRESH_TOP_N = int(os.getenv("CACHE_REFRESH_TOP_N", "50"))
+
+def is_replayable(sql_query):
+    """Stored SQL that runs on any database with the schema: a SELECT not reading scratch tables."""
+    sql_query = (sql_query or '').strip()
+    return sql_query.upper().startswith('SELECT') and not reads_scratch(sql_query)
+
+def results_equal(old, new, columns):
+    """Whether a cached result (Arrow table or legacy rows) has the same columns and values as a new one."""
+    from columnar import rows_to_table
+    if isinstance(old, list):
+        old = rows_to_table(old, columns)
+    return old.column_names == new.column_names and old.to_pylist() == new.to_pylist()
+
+def stale_answer(question, schema, db_path):
+    """
+    An answer to the question computed on other data that can be re-run on
+    this database, if it has none of its own yet.
+    """
+    version = storage.data_version(db_path)
+    if get_from_db_cache(get_cache_key(question, schema, version)):
+        return None
+    cached = get_other_version(get_cache_key(question, schema), version)
+    if not cached or not is_replayable(cached['sql_query']):
+        return None
+    return cached
+
+def replay_answer(question, db_path, schema, cached):
+    """
+    Re-run a cached answer's SQL on the database. Returns (response, changed);
+    the summary is regenerated only if the results changed. Returns None if
+    the SQL no longer runs.
+    """
+    from nl2sql import execute_sql, build_answer
+    sql_query = cached['sql_query']
+    results, columns = execute_sql(sql_query, db_path, columnar=True)
+    if results is None:
+        return None
+    if results_equal(cached['results'], results, columns):
+        response = {key: cached[key] for key in ('sql_query', 'summary', 'visualization', 'follow_up_questions')}
+        response.update(results=results, columns=columns)
+        return response, False
+    return build_answer(question, schema, sql_query, results, columns, cached['follow_up_questions']), True
+
+def store_replayed(question, schema, db_path, response):
+    cache_response(question, schema, response['sql_query'], response['summary'],
+                   response['visualization'], response['follow_up_questions'],
+                   response['results'], response['columns'], storage.data_version(db_path))
+
+def refresh_answers(db_path, schema, limit=None):
+    """
+    Re-run the most served questions for the database's schema that have no
+    answer on its data yet, and cache their answers for it. Returns how many
+    were unchanged, changed, skipped (being answered elsewhere, or SQL that
+    cannot be re-run alone) and failed.
+    """
+    version = storage.data_version(db_path)
+    schema_hash = hashlib.sha256(schema.encode()).hexdigest()
+    counts = {'unchanged': 0, 'changed': 0, 'skipped': 0, 'failed': 0}
+    with span('cache_refresh') as s:
+        for _, question in get_stale_cached_answers(schema_hash, version, limit or CACHE_REFRESH_TOP_N):
+            cache_key = get_cache_key(question, schema, version)
+            token = singleflight.acquire(cache_key)
+            if token is None:
+                counts['skipped'] += 1
+                continue
+            try:
+                cached = stale_answer(question, schema, db_path)
+                replayed = replay_answer(question, db_path, schema, cached) if cached else None
+                if replayed is None:
+                    counts['failed' if cached else 'skipped'] += 1
+                    continue
+                response, changed = replayed
+                store_replayed(question, schema, db_path, response)
+                counts['changed' if changed else 'unchanged'] += 1
+            except Exception as e:
+                print(f"Error refreshing cached answer to '{question}': {e}")
+                counts['failed'] += 1
+            finally:
+                singleflight.release(cache_key, token)
+        s['rows'] = counts['unchanged'] + counts['changed']
+    return counts
+
+def start_refresh(username, db_path, schema):
+    """Refresh stale answers for a newly uploaded database on the query pool, at background priority."""
+    if not CACHE_REFRESH or not schema:
+        return None
+    return query_pool.submit(username, refresh_answers, db_path, schema, priority=query_pool.BACKGROUND)
@@ -0,0 +1,464 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from collections import Counter
+from datetime import datetime
+import derived
+from derived import DERIVED_SCHEMA
+
+# Tables smaller than this are fast enough to aggregate directly
+ROLLUP_MIN_ROWS = int(os.getenv("ROLLUP_MIN_ROWS", "10000"))
+# Columns with more distinct values than this are not used as dimensions
+ROLLUP_MAX_CARDINALITY = int(os.getenv("ROLLUP_MAX_CARDINALITY", "1000"))
+# A rollup is only worth keeping if it is this much smaller than its table
+ROLLUP_MAX_RATIO = float(os.getenv("ROLLUP_MAX_RATIO", "0.1"))
+ROLLUP_MAX_PER_TABLE = int(os.getenv("ROLLUP_MAX_PER_TABLE", "6"))
+
+# Rows read when profiling column cardinality
+PROFILE_SAMPLE_ROWS = 200000
+# Integer columns are measures unless their name says they are a period
+PERIOD_HINTS = ('year', 'month', 'quarter', 'week', 'day', 'hour')
+
+AGGREGATES = ('SUM', 'AVG', 'COUNT', 'MIN', 'MAX', 'TOTAL')
+ROWID_ALIASES = {'rowid', 'oid', '_rowid_'}
+IDENT = r'"[^"]+"|\[[^\]]+\]|`[^`]+`|[A-Za-z_]\w*'
+SIMPLE_AGGREGATE = re.compile(rf"\b({'|'.join(AGGREGATES)})\s*\(\s*(\*|{IDENT})\s*\)", re.IGNORECASE)
+ANY_AGGREGATE = re.compile(rf"\b({'|'.join(AGGREGATES)}|GROUP_CONCAT)\s*\(", re.IGNORECASE)
+UNSUPPORTED = re.compile(r"\b(JOIN|UNION|INTERSECT|EXCEPT|WITH|OVER|DISTINCT|WINDOW)\b", re.IGNORECASE)
+QUERY = re.compile(rf"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+(?P<table>{IDENT})(?P<rest>.*)$",
+                   re.IGNORECASE | re.DOTALL)
+CLAUSE_START = re.compile(r"^\s*(WHERE|GROUP|ORDER|HAVING|LIMIT)\b|^\s*$", re.IGNORECASE)
+
+def _unquote(identifier):
+    if identifier[0] in '"[`':
+        return identifier[1:-1]
+    return identifier
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def _mask_literals(sql):
+    """Blank out string literal contents, keeping offsets, so they are not parsed as SQL."""
+    return re.sub(r"'(?:[^']|'')*'", lambda m: "'" + "_" * (len(m.group()) - 2) + "'", sql)
+
+def _split_top_level(text, start, end):
+    """(start, end) spans of the comma separated items of text[start:end]."""
+    spans, depth, item_start = [], 0, start
+    for i in range(start, end):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+        elif text[i] == ',' and depth == 0:
+            spans.append((item_start, i))
+            item_start = i + 1
+    spans.append((item_start, end))
+    return spans
+
+def _has_alias(item):
+    """Whether a masked select item ends in an alias."""
+    item = item.strip()
+    if re.search(rf"\bAS\s+({IDENT})$", item, re.IGNORECASE):
+        return True
+    match = re.search(rf"({IDENT})$", item)
+    if not match:
+        return False
+    before = item[:match.start()].rstrip()
+    return bool(before) and (before[-1] == ')' or before[-1].isalnum() or before[-1] in '_"]`')
+
+def parse_aggregate_query(sql):
+    """
+    Recognize a single-table aggregate query that a rollup could answer.
+
+    Returns a dict with the table name, the aggregate calls (function,
+    argument, span) and the other identifiers the query references, or None
+    for anything else (joins, subqueries, DISTINCT, window functions,
+    aggregates over expressions).
+    """
+    sql = sql.strip().rstrip(';')
+    masked = _mask_literals(sql)
+    if UNSUPPORTED.search(masked) or len(re.findall(r"\bSELECT\b", masked, re.IGNORECASE)) != 1:
+        return None
+    match = QUERY.match(masked)
+    if not match or not CLAUSE_START.match(match.group('rest')):
+        return None
+
+    aggregates = [
+        (m.group(1).upper(), None if m.group(2) == '*' else _unquote(m.group(2)), m.span())
+        for m in SIMPLE_AGGREGATE.finditer(masked)
+    ]
+    if not aggregates or len(aggregates) != len(ANY_AGGREGATE.findall(masked)):
+        return None
+
+    outside = masked
+    for _, _, (start, end) in aggregates:
+        outside = outside[:start] + " " * (end - start) + outside[end:]
+    outside = re.sub(r"'_*'", " ", outside)
+    # Aliases may reuse column names without referring to them
+    outside = re.sub(rf"\bAS\s+({IDENT})", lambda m: " " * len(m.group()), outside, flags=re.IGNORECASE)
+    identifiers = {_unquote(token).lower() for token in re.findall(IDENT, outside[match.end('table'):])}
+    identifiers |= {_unquote(token).lower() for token in re.findall(IDENT, outside[match.start('select'):match.end('select')])}
+
+    return {
+        'sql': sql,
+        'masked': masked,
+        'table': _unquote(match.group('table')),
+        'table_span': match.span('table'),
+        'select_span': match.span('select'),
+        'aggregates': aggregates,
+        'identifiers': identifiers
+    }
+
+def _ensure_meta(conn):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {DERIVED_SCHEMA}.rollup_sources (
+        base_table TEXT PRIMARY KEY,
+        table_sql TEXT,
+        row_count INTEGER,
+        max_rowid INTEGER,
+        totals TEXT,
+        updated_at TIMESTAMP
+    )
+    ''')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {DERIVED_SCHEMA}.rollups (
+        name TEXT PRIMARY KEY,
+        base_table TEXT,
+        dims TEXT,
+        measures TEXT,
+        row_count INTEGER
+    )
+    ''')
+
+def _is_identifier_column(name, pk):
+    name = name.lower()
+    return pk or name in ('id', 'rowid') or name.endswith('_id')
+
+def profile_table(conn, table):
+    """Row count, candidate dimension cardinalities and numeric measures of a table."""
+    columns = conn.execute(f"PRAGMA main.table_info({_quote(table)})").fetchall()
+    row_count = conn.execute(f"SELECT COUNT(*) FROM main.{_quote(table)}").fetchone()[0]
+    measures, candidates = [], []
+    for _, name, decltype, _, _, pk in columns:
+        decltype = (decltype or '').upper()
+        if _is_identifier_column(name, pk):
+            continue
+        if any(t in decltype for t in ('INT', 'REAL', 'FLOA', 'DOUB', 'NUM', 'DEC')):
+            measures.append(name)
+            if 'INT' in decltype and any(hint in name.lower() for hint in PERIOD_HINTS):
+                candidates.append(name)
+        else:
+            candidates.append(name)
+    if not candidates:
+        return row_count, {}, measures
+    counts = conn.execute(
+        "SELECT " + ", ".join(f"COUNT(DISTINCT {_quote(c)})" for c in candidates) +
+        f" FROM (SELECT * FROM main.{_quote(table)} LIMIT {PROFILE_SAMPLE_ROWS})"
+    ).fetchone()
+    dims = {c: n for c, n in zip(candidates, counts) if 2 <= n <= ROLLUP_MAX_CARDINALITY}
+    return row_count, dims, measures
+
+def choose_rollups(table, row_count, dims, logged_sql=()):
+    """
+    Pick the dimension sets to roll up: groupings seen in the query log first,
+    then single dimensions and pairs, smallest first, while each rollup stays
+    well below the table size.
+    """
+    limit = row_count * ROLLUP_MAX_RATIO
+    lookup = {d.lower(): d for d in dims}
+
+    def size(dim_set):
+        estimate = 1
+        for d in dim_set:
+            estimate *= dims[d]
+        return min(estimate, row_count)
+
+    logged = Counter()
+    for sql in logged_sql:
+        parsed = parse_aggregate_query(sql)
+        if not parsed or parsed['table'].lower() != table.lower():
+            continue
+        used = tuple(sorted(lookup[i] for i in parsed['identifiers'] if i in lookup))
+        if used and len(used) <= 3:
+            logged[used] += 1
+
+    chosen = [d for d, _ in logged.most_common() if size(d) <= limit]
+    ordered = sorted(dims, key=dims.get)
+    generic = [(d,) for d in ordered] + [
+        (a, b) for i, a in enumerate(ordered) for b in ordered[i + 1:]
+    ]
+    for dim_set in sorted(generic, key=size):
+        dim_set = tuple(sorted(dim_set))
+        if dim_set not in chosen and size(dim_set) <= limit:
+            chosen.append(dim_set)
+    return chosen[:ROLLUP_MAX_PER_TABLE]
+
+def _aggregate_columns(measures):
+    """Column expressions of a rollup built from base rows."""
+    parts = ["COUNT(*) AS _rows"]
+    for m in measures:
+        q = _quote(m)
+        parts += [f"SUM({q}) AS {_quote(m + '__sum')}", f"COUNT({q}) AS {_quote(m + '__cnt')}",
+                  f"MIN({q}) AS {_quote(m + '__min')}", f"MAX({q}) AS {_quote(m + '__max')}"]
+    return parts
+
+def _reaggregate_columns(measures):
+    """Column expressions that combine rows of a rollup into a coarser one."""
+    parts = ["SUM(_rows) AS _rows"]
+    for m in measures:
+        parts += [f"SUM({_quote(m + '__sum')}) AS {_quote(m + '__sum')}",
+                  f"SUM({_quote(m + '__cnt')}) AS {_quote(m + '__cnt')}",
+                  f"MIN({_quote(m + '__min')}) AS {_quote(m + '__min')}",
+                  f"MAX({_quote(m + '__max')}) AS {_quote(m + '__max')}"]
+    return parts
+
+def _rollup_name(table, dims):
+    digest = hashlib.md5("|".join([table] + list(dims)).encode()).hexdigest()[:8]
+    return f"rollup_{re.sub(r'[^A-Za-z0-9_]', '_', table)}_{digest}"
+
+def _table_totals(conn, table, measures, max_rowid=None):
+    """Row count and per-measure totals, used to tell appends from other changes."""
+    where = f" WHERE rowid <= {int(max_rowid)}" if max_rowid is not None else ""
+    row = conn.execute(
+        "SELECT " + ", ".join(["COUNT(*)"] + [f"TOTAL({_quote(m)})" for m in measures]) +
+        f" FROM main.{_quote(table)}{where}"
+    ).fetchone()
+    return list(row)
+
+def _build_table(table, dims, measures, built, where=""):
+    """Create a rollup from the smallest already built rollup that covers it, or from the base table."""
+    dim_cols = ", ".join(_quote(d) for d in dims)
+    sources = [(rows, name) for name, (source_dims, rows) in built.items() if set(dims) <= set(source_dims)]
+    if sources and not where:
+        source = f"{DERIVED_SCHEMA}.{_quote(min(sources)[1])}"
+        columns = _reaggregate_columns(measures)
+    else:
+        source = f"main.{_quote(table)}{where}"
+        columns = _aggregate_columns(measures)
+    return f"SELECT {dim_cols}, {', '.join(columns)} FROM {source} GROUP BY {dim_cols}"
+
+def _merge_append(conn, table, name, dims, measures, old_max_rowid):
+    """Fold rows appended after old_max_rowid into an existing rollup."""
+    dim_cols = ", ".join(_quote(d) for d in dims)
+    column_names = ["_rows"] + [f"{m}__{k}" for m in measures for k in ('sum', 'cnt', 'min', 'max')]
+    all_cols = dim_cols + ", " + ", ".join(_quote(c) for c in column_names)
+    delta = _build_table(table, dims, measures, {}, where=f" WHERE rowid > {int(old_max_rowid)}")
+    merged = f"{name}__merged"
+    conn.execute(f"DROP TABLE IF EXISTS {DERIVED_SCHEMA}.{_quote(merged)}")
+    conn.execute(f'''
+    CREATE TABLE {DERIVED_SCHEMA}.{_quote(merged)} AS
+    SELECT {dim_cols}, {', '.join(_reaggregate_columns(measures))}
+    FROM (SELECT {all_cols} FROM {DERIVED_SCHEMA}.{_quote(name)} UNION ALL {delta})
+    GROUP BY {dim_cols}
+    ''')
+    conn.execute(f"DROP TABLE {DERIVED_SCHEMA}.{_quote(name)}")
+    conn.execute(f"ALTER TABLE {DERIVED_SCHEMA}.{_quote(merged)} RENAME TO {_quote(name)}")
+
+def _source_state(conn, table):
+    table_sql = conn.execute(
+        "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()[0]
+    max_rowid = conn.execute(f"SELECT MAX(rowid) FROM main.{_quote(table)}").fetchone()[0] or 0
+    return table_sql, max_rowid
+
+def refresh_table(conn, table, logged_sql=()):
+    """
+    Bring the rollups of one table up to date.
+
+    Unchanged tables are left alone, rows appended since the last build are
+    merged into the existing rollups, and any other change rebuilds them.
+    """
+    try:
+        table_sql, max_rowid = _source_state(conn, table)
+    except sqlite3.OperationalError:
+        # WITHOUT ROWID tables cannot be checked for appends
+        return 'skipped'
+    state = conn.execute(f'''
+    SELECT table_sql, row_count, max_rowid, totals FROM {DERIVED_SCHEMA}.rollup_sources WHERE base_table = ?
+    ''', (table,)).fetchone()
+    existing = conn.execute(f'''
+    SELECT name, dims, measures FROM {DERIVED_SCHEMA}.rollups WHERE base_table = ?
+    ''', (table,)).fetchall()
+
+    if state and existing and state[0] == table_sql:
+        measures = json.loads(existing[0][2])
+        old_totals = json.loads(state[3])
+        if _table_totals(conn, table, measures, state[2]) == old_totals:
+            if max_rowid == state[2]:
+                return 'unchanged'
+            for name, dims, _ in existing:
+                _merge_append(conn, table, name, json.loads(dims), measures, state[2])
+            return _record_state(conn, table, table_sql, max_rowid, measures, existing, 'appended')
+
+    for name, _, _ in existing:
+        conn.execute(f"DROP TABLE IF EXISTS {DERIVED_SCHEMA}.{_quote(name)}")
+    conn.execute(f"DELETE FROM {DERIVED_SCHEMA}.rollups WHERE base_table = ?", (table,))
+    conn.execute(f"DELETE FROM {DERIVED_SCHEMA}.rollup_sources WHERE base_table = ?", (table,))
+
+    row_count, dims, measures = profile_table(conn, table)
+    if row_count < ROLLUP_MIN_ROWS or not dims:
+        conn.commit()
+        return 'skipped'
+    built = {}
+    # Finer rollups first, so coarser ones can be aggregated from them
+    for dim_set in sorted(choose_rollups(table, row_count, dims, logged_sql), key=len, reverse=True):
+        name = _rollup_name(table, dim_set)
+        try:
+            conn.execute(f"CREATE TABLE {DERIVED_SCHEMA}.{_quote(name)} AS "
+                         f"{_build_table(table, dim_set, measures, built)}")
+        except sqlite3.Error as e:
+            print(f"Error building rollup {name}: {e}")
+            continue
+        rows = conn.execute(f"SELECT COUNT(*) FROM {DERIVED_SCHEMA}.{_quote(name)}").fetchone()[0]
+        built[name] = (dim_set, rows)
+    existing = [(name, json.dumps(list(dims)), json.dumps(measures)) for name, (dims, _) in built.items()]
+    return _record_state(conn, table, table_sql, max_rowid, measures, existing, 'built')
+
+def _record_state(conn, table, table_sql, max_rowid, measures, rollups, outcome):
+    totals = _table_totals(conn, table, measures)
+    conn.execute(f'''
+    INSERT OR REPLACE INTO {DERIVED_SCHEMA}.rollup_sources
+    (base_table, table_sql, row_count, max_rowid, totals, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', (table, table_sql, totals[0], max_rowid, json.dumps(totals), datetime.now().isoformat()))
+    for name, dims, measures_json in rollups:
+        rows = conn.execute(f"SELECT COUNT(*) FROM {DERIVED_SCHEMA}.{_quote(name)}").fetchone()[0]
+        conn.execute(f'''
+        INSERT OR REPLACE INTO {DERIVED_SCHEMA}.rollups (name, base_table, dims, measures, row_count)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (name, table, dims, measures_json, rows))
+    conn.commit()
+    return outcome
+
+def ensure_rollups(db_path, schema=None):
+    """
+    Build or update the rollups of every table of an uploaded database,
+    favouring groupings from cached queries against the same schema.
+    Returns {table: 'built' | 'appended' | 'unchanged' | 'skipped'}.
+    """
+    from database_cache import get_logged_sql_queries
+    schema_hash = hashlib.sha256(schema.encode()).hexdigest() if schema else None
+    try:
+        logged_sql = get_logged_sql_queries(schema_hash)
+    except sqlite3.Error:
+        logged_sql = []
+    conn = derived.connect(db_path)
+    try:
+        _ensure_meta(conn)
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )]
+        outcome = {table: refresh_table(conn, table, logged_sql) for table in tables}
+        # Forget rollups of tables that no longer exist
+        for (table,) in conn.execute(f"SELECT base_table FROM {DERIVED_SCHEMA}.rollup_sources").fetchall():
+            if table not in tables:
+                for (name,) in conn.execute(f"SELECT name FROM {DERIVED_SCHEMA}.rollups WHERE base_table = ?", (table,)).fetchall():
+                    conn.execute(f"DROP TABLE IF EXISTS {DERIVED_SCHEMA}.{_quote(name)}")
+                conn.execute(f"DELETE FROM {DERIVED_SCHEMA}.rollups WHERE base_table = ?", (table,))
+                conn.execute(f"DELETE FROM {DERIVED_SCHEMA}.rollup_sources WHERE base_table = ?", (table,))
+        conn.commit()
+        return outcome
+    finally:
+        conn.close()
+
+def _rewrite_aggregate(function, column, measures):
+    """Expression over rollup columns equal to an aggregate over base rows, or None."""
+    if column is None:
+        return "COALESCE(SUM(_rows), 0)" if function == 'COUNT' else None
+    if column.lower() not in measures:
+        return None
+    m = measures[column.lower()]
+    return {
+        'SUM': f"SUM({_quote(m + '__sum')})",
+        'TOTAL': f"TOTAL({_quote(m + '__sum')})",
+        'COUNT': f"COALESCE(SUM({_quote(m + '__cnt')}), 0)",
+        'AVG': f"(SUM({_quote(m + '__sum')}) * 1.0 / SUM({_quote(m + '__cnt')}))",
+        'MIN': f"MIN({_quote(m + '__min')})",
+        'MAX': f"MAX({_quote(m + '__max')})"
+    }[function]
+
+def rewrite_query(sql, conn):
+    """
+    Rewrite an aggregate query to read from the smallest up-to-date rollup
+    that has every column it filters or groups by.
+
+    `conn` must have the derived database attached. Returns the rewritten
+    SQL, or the original SQL when no rollup can answer the query.
+    """
+    parsed = parse_aggregate_query(sql)
+    if not parsed:
+        return sql
+    try:
+        state = conn.execute(f'''
+        SELECT row_count, max_rowid FROM {DERIVED_SCHEMA}.rollup_sources WHERE base_table = ? COLLATE NOCASE
+        ''', (parsed['table'],)).fetchone()
+        if not state:
+            return sql
+        table = conn.execute(f'''
+        SELECT base_table FROM {DERIVED_SCHEMA}.rollup_sources WHERE base_table = ? COLLATE NOCASE
+        ''', (parsed['table'],)).fetchone()[0]
+        current = conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM main.{_quote(table)}").fetchone()
+        if tuple(current) != (state[0], state[1]):
+            return sql
+        columns = {row[1].lower() for row in conn.execute(f"PRAGMA main.table_info({_quote(table)})")}
+        candidates = conn.execute(f'''
+        SELECT name, dims, measures FROM {DERIVED_SCHEMA}.rollups WHERE base_table = ? ORDER BY row_count
+        ''', (table,)).fetchall()
+    except sqlite3.Error:
+        return sql
+
+    # Every table has a rowid, the rollup's included, so the check below
+    # would not catch one that means the base table's rows
+    if parsed['identifiers'] & (ROWID_ALIASES - columns):
+        return sql
+    needed = parsed['identifiers'] & columns
+    for name, dims, measures in candidates:
+        dims = {d.lower(): d for d in json.loads(dims)}
+        measures = {m.lower(): m for m in json.loads(measures)}
+        if not needed <= set(dims):
+            continue
+        replacements = []
+        for function, column, span_ in parsed['aggregates']:
+            if function in ('MIN', 'MAX') and column and column.lower() in dims:
+                continue
+            expression = _rewrite_aggregate(function, column, measures)
+            if expression is None:
+                break
+            replacements.append((span_, expression))
+        else:
+            rewritten = splice_query(parsed, replacements, f"{DERIVED_SCHEMA}.{_quote(name)}")
+            try:
+                # The rollup only has the grouped and aggregated columns, so any
+                # other use of the base table fails here and the query runs as written
+                conn.execute("EXPLAIN " + rewritten)
+            except sqlite3.Error:
+                continue
+            return rewritten
+    return sql
+
+def select_items(parsed):
+    """For each item of the select list, whether it contains an aggregate."""
+    return [
+        any(start <= s and e <= end for _, _, (s, e) in parsed['aggregates'])
+        for start, end in _split_top_level(parsed['masked'], *parsed['select_span'])
+    ]
+
+def splice_query(parsed, replacements, table_source):
+    """
+    Replace aggregate calls (by span) and the table reference of a parsed
+    query, keeping result column names unchanged.
+    """
+    sql, masked = parsed['sql'], parsed['masked']
+    select_start, select_end = parsed['select_span']
+    edits = list(replacements) + [(parsed['table_span'], table_source)]
+    # Unaliased aggregate columns are named after their text; keep that name
+    for start, end in _split_top_level(masked, select_start, select_end):
+        touched = any(start <= s and e <= end for (s, e), _ in replacements)
+        if touched and not _has_alias(masked[start:end]):
+            alias = sql[start:end].strip()
+            edits.append(((end, end), f" AS {_quote(alias)}"))
+    for (start, end), text in sorted(edits, key=lambda edit: edit[0], reverse=True):
+        sql = sql[:start] + text + sql[end:]
+    return sql
@@ -0,0 +1,329 @@
+import os
+import re
+import math
+import sqlite3
+import threading
+from datetime import datetime
+import derived
+from derived import DERIVED_SCHEMA
+from rollups import ROWID_ALIASES, parse_aggregate_query, splice_query, select_items, profile_table
+
+# Tables at least this large get a sample at upload time
+APPROX_MIN_ROWS = int(os.getenv("APPROX_MIN_ROWS", "1000000"))
+# Default fraction of rows kept; can be changed per database
+DEFAULT_SAMPLE_RATE = float(os.getenv("APPROX_SAMPLE_RATE", "0.01"))
+# Every stratum keeps at least this many rows (or all of them)
+MIN_PER_STRATUM = 100
+# Strata come from the lowest-cardinality dimension, if it has at most this many values
+MAX_STRATA = 200
+# Random groups used to estimate the variance of each answer
+REPLICATES = 20
+Z_95 = 1.96
+
+HASH_MULTIPLIER = 2654435761
+HASH_RANGE = 2 ** 32
+ESTIMABLE = ('SUM', 'TOTAL', 'COUNT', 'AVG')
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def _sample_name(table):
+    return "sample_" + re.sub(r'[^A-Za-z0-9_]', '_', table)
+
+def _ensure_meta(conn):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {DERIVED_SCHEMA}.sample_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {DERIVED_SCHEMA}.sample_sources (
+        base_table TEXT PRIMARY KEY,
+        sample_table TEXT,
+        rate REAL,
+        stratum_column TEXT,
+        row_count INTEGER,
+        max_rowid INTEGER,
+        sample_rows INTEGER,
+        built_at TIMESTAMP
+    )
+    ''')
+
+def get_sample_rate(db_path):
+    """Sample rate configured for a database, or the default."""
+    if not derived.has_derived(db_path):
+        return DEFAULT_SAMPLE_RATE
+    conn = derived.connect(db_path)
+    try:
+        _ensure_meta(conn)
+        row = conn.execute(f"SELECT value FROM {DERIVED_SCHEMA}.sample_settings WHERE key = 'rate'").fetchone()
+        return float(row[0]) if row else DEFAULT_SAMPLE_RATE
+    finally:
+        conn.close()
+
+def set_sample_rate(db_path, rate):
+    """Store the sample rate of a database; samples are rebuilt by the next ensure_samples."""
+    conn = derived.connect(db_path)
+    try:
+        _ensure_meta(conn)
+        conn.execute(f'''
+        INSERT OR REPLACE INTO {DERIVED_SCHEMA}.sample_settings (key, value) VALUES ('rate', ?)
+        ''', (str(rate),))
+        conn.commit()
+    finally:
+        conn.close()
+
+def build_sample(conn, table, rate):
+    """
+    Build a stratified sample of a table in the derived database.
+
+    Rows are picked by a multiplicative hash of their rowid, so the same rows
+    are chosen every time. Each stratum keeps `rate` of its rows but at least
+    MIN_PER_STRATUM, and every row carries the weight N_h / n_h of its
+    stratum. The sampled rows of each stratum are dealt into REPLICATES equal
+    groups; _group_weight (N_h / rows of the group) and _fpc (the square root
+    of the stratum's finite population correction) give the replicate
+    weights used for confidence intervals.
+    """
+    _, dims, _ = profile_table(conn, table)
+    strata = {d: n for d, n in dims.items() if n <= MAX_STRATA}
+    stratum = min(strata, key=strata.get) if strata else None
+    name = _sample_name(table)
+    source = f"main.{_quote(table)}"
+    hashed = f"((t.rowid * {HASH_MULTIPLIER}) % {HASH_RANGE})"
+
+    conn.execute("DROP TABLE IF EXISTS temp._strata")
+    conn.execute("CREATE TEMP TABLE _strata (value, total INTEGER, threshold INTEGER)")
+    if stratum:
+        conn.execute("CREATE INDEX temp._strata_value ON _strata (value)")
+        counts = conn.execute(f"SELECT {_quote(stratum)}, COUNT(*) FROM {source} GROUP BY 1").fetchall()
+    else:
+        counts = [(None, conn.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0])]
+    conn.executemany("INSERT INTO temp._strata VALUES (?, ?, ?)", [
+        (value, total, int(min(1.0, max(rate, MIN_PER_STRATUM / total)) * HASH_RANGE))
+        for value, total in counts
+    ])
+    join = f"ON s.value IS t.{_quote(stratum)}" if stratum else "ON 1"
+
+    conn.execute(f"DROP TABLE IF EXISTS {DERIVED_SCHEMA}.{_quote(name)}")
+    conn.execute(f'''
+    CREATE TABLE {DERIVED_SCHEMA}.{_quote(name)} AS
+    SELECT t.*, 0.0 AS _weight, 0.0 AS _group_weight, 0.0 AS _fpc,
+           (ROW_NUMBER() OVER (PARTITION BY s.value ORDER BY {hashed}) - 1) % {REPLICATES} AS _replicate
+    FROM {source} AS t JOIN temp._strata AS s {join}
+    WHERE {hashed} < s.threshold
+    ''')
+    conn.execute("DROP TABLE temp._strata")
+
+    # Turn stratum sizes into weights now that the sampled counts are known
+    stratum_expr = _quote(stratum) if stratum else "NULL"
+    groups = conn.execute(f'''
+    SELECT {stratum_expr}, _replicate, COUNT(*) FROM {DERIVED_SCHEMA}.{_quote(name)} GROUP BY 1, 2
+    ''').fetchall()
+    totals = dict(counts)
+    sampled = {}
+    for value, _, rows in groups:
+        sampled[value] = sampled.get(value, 0) + rows
+    conn.execute("DROP TABLE IF EXISTS temp._weights")
+    conn.execute("CREATE TEMP TABLE _weights (value, replicate INTEGER, weight REAL, group_weight REAL, fpc REAL)")
+    conn.executemany("INSERT INTO temp._weights VALUES (?, ?, ?, ?, ?)", [
+        (value, replicate, totals[value] / sampled[value], totals[value] / rows,
+         math.sqrt(max(0.0, 1 - sampled[value] / totals[value])))
+        for value, replicate, rows in groups
+    ])
+    conn.execute(f'''
+    UPDATE {DERIVED_SCHEMA}.{_quote(name)} AS x
+    SET _weight = w.weight, _group_weight = w.group_weight, _fpc = w.fpc
+    FROM temp._weights AS w
+    WHERE w.value IS {"x." + stratum_expr if stratum else "NULL"} AND w.replicate = x._replicate
+    ''')
+    conn.execute("DROP TABLE temp._weights")
+    sample_rows = conn.execute(f"SELECT COUNT(*) FROM {DERIVED_SCHEMA}.{_quote(name)}").fetchone()[0]
+    return name, stratum, sample_rows
+
+def _has_replicate_weights(conn, sample):
+    """Whether a sample was built with replicate weights (older samples are rebuilt)."""
+    columns = conn.execute(f"PRAGMA {DERIVED_SCHEMA}.table_info({_quote(sample)})").fetchall()
+    return any(column[1] == '_group_weight' for column in columns)
+
+def ensure_samples(db_path):
+    """
+    Build or refresh the samples of the database's large tables at the
+    configured rate. Returns {table: 'built' | 'unchanged' | 'skipped'}.
+    """
+    rate = get_sample_rate(db_path)
+    conn = derived.connect(db_path)
+    try:
+        _ensure_meta(conn)
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )]
+        outcome = {}
+        for table in tables:
+            try:
+                row_count, max_rowid = conn.execute(
+                    f"SELECT COUNT(*), MAX(rowid) FROM main.{_quote(table)}"
+                ).fetchone()
+            except sqlite3.OperationalError:
+                outcome[table] = 'skipped'
+                continue
+            state = conn.execute(f'''
+            SELECT rate, row_count, max_rowid, sample_table FROM {DERIVED_SCHEMA}.sample_sources
+            WHERE base_table = ?
+            ''', (table,)).fetchone()
+            if row_count < APPROX_MIN_ROWS:
+                outcome[table] = 'skipped'
+                continue
+            if state and tuple(state[:3]) == (rate, row_count, max_rowid) and \
+                    _has_replicate_weights(conn, state[3]):
+                outcome[table] = 'unchanged'
+                continue
+            name, stratum, sample_rows = build_sample(conn, table, rate)
+            conn.execute(f'''
+            INSERT OR REPLACE INTO {DERIVED_SCHEMA}.sample_sources
+            (base_table, sample_table, rate, stratum_column, row_count, max_rowid, sample_rows, built_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (table, name, rate, stratum, row_count, max_rowid, sample_rows, datetime.now().isoformat()))
+            conn.commit()
+            outcome[table] = 'built'
+        return outcome
+    finally:
+        conn.close()
+
+def _estimator(function, column):
+    """Weighted estimate over sample rows (weights in _w) of an aggregate over all rows."""
+    if column is None:
+        return "ROUND(SUM(_w))"
+    c = _quote(column)
+    return {
+        'SUM': f"SUM({c} * _w)",
+        'TOTAL': f"TOTAL({c} * _w)",
+        'COUNT': f"ROUND(SUM(CASE WHEN {c} IS NOT NULL THEN _w END))",
+        'AVG': f"(SUM({c} * _w) / SUM(CASE WHEN {c} IS NOT NULL THEN _w END))"
+    }[function]
+
+def approximate_query(sql, db_path, conn=None):
+    """
+    Answer an aggregate query from the table's sample.
+
+    Returns (Arrow table, info) where info has the sample rate and size and,
+    per aggregate column, the half-width of a 95% confidence interval for each
+    row (None where it cannot be estimated). Returns None when the query
+    cannot be answered from a sample (no sample, stale sample, MIN/MAX,
+    non-aggregate queries).
+    """
+    parsed = parse_aggregate_query(sql)
+    if not parsed or any(function not in ESTIMABLE for function, _, _ in parsed['aggregates']):
+        return None
+    if not derived.has_derived(db_path):
+        return None
+    own_conn = conn is None
+    if own_conn:
+        conn = derived.connect(db_path)
+    try:
+        state = conn.execute(f'''
+        SELECT base_table, sample_table, rate, row_count, max_rowid, sample_rows
+        FROM {DERIVED_SCHEMA}.sample_sources WHERE base_table = ? COLLATE NOCASE
+        ''', (parsed['table'],)).fetchone()
+        if not state:
+            return None
+        table, sample, rate, row_count, max_rowid, sample_rows = state
+        current = conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM main.{_quote(table)}").fetchone()
+        if tuple(current) != (row_count, max_rowid):
+            return None
+        # The sample's rows are numbered afresh
+        columns = {row[1].lower() for row in conn.execute(f"PRAGMA main.table_info({_quote(table)})")}
+        if parsed['identifiers'] & (ROWID_ALIASES - columns):
+            return None
+
+        replacements = [(span_, _estimator(function, column)) for function, column, span_ in parsed['aggregates']]
+
+        def query_for(weight):
+            source = f"(SELECT *, {weight} AS _w FROM {DERIVED_SCHEMA}.{_quote(sample)}) AS {_quote(table)}"
+            return splice_query(parsed, replacements, source)
+
+        from columnar import execute_to_arrow
+        result = execute_to_arrow(query_for("_weight"), db_path, conn=conn)
+
+        # Random groups formed within each stratum: the answer is re-estimated
+        # with each group standing in for its stratum, moved towards the full
+        # estimate by the stratum's finite population correction, so strata
+        # sampled in full add no variance and their row counts stay exact
+        aggregated = select_items(parsed)
+        intervals = {}
+        if len(aggregated) == result.num_columns:
+            key_columns = [name for name, agg in zip(result.column_names, aggregated) if not agg]
+            value_columns = [name for name, agg in zip(result.column_names, aggregated) if agg]
+            unlimited = re.sub(r"\s+LIMIT\s+\d+(\s*(OFFSET|,)\s*\d+)?\s*$", "", query_for(
+                "_weight * (1 - _fpc) + CASE WHEN _replicate = {k} THEN _group_weight * _fpc ELSE 0 END"
+            ), flags=re.IGNORECASE)
+            estimates = {}
+            for k in range(REPLICATES):
+                replicate = conn.execute(unlimited.replace("{k}", str(k)))
+                names = [d[0] for d in replicate.description]
+                for row in replicate.fetchall():
+                    values = dict(zip(names, row))
+                    key = tuple(values.get(c) for c in key_columns)
+                    for c in value_columns:
+                        if isinstance(values.get(c), (int, float)):
+                            estimates.setdefault((key, c), []).append(values[c])
+            rows = result.select(key_columns).to_pylist() if key_columns else [{}] * result.num_rows
+            for c in value_columns:
+                intervals[c] = []
+                for row in rows:
+                    values = estimates.get((tuple(row.get(k) for k in key_columns), c), [])
+                    if len(values) < 5:
+                        intervals[c].append(None)
+                        continue
+                    mean = sum(values) / len(values)
+                    variance = sum((v - mean) ** 2 for v in values) / (len(values) * (len(values) - 1))
+                    intervals[c].append(Z_95 * math.sqrt(variance))
+            # Groups too thin in the sample to estimate: not worth showing first
+            widths = [w for column in intervals.values() for w in column]
+            if widths and sum(w is None for w in widths) > len(widths) / 2:
+                return None
+        return result, {
+            'sample_rate': rate,
+            'sample_rows': sample_rows,
+            'table_rows': row_count,
+            'intervals': intervals
+        }
+    except sqlite3.Error as e:
+        print(f"Error answering from sample: {e}")
+        return None
+    finally:
+        if own_conn:
+            conn.close()
+
+# Exact queries behind approximate answers, keyed by chat message id
+_lock = threading.Lock()
+_jobs = {}
+
+def track_exact(message_id, username, question, job):
+    """Remember the pool job (from pipeline.submit_exact) computing the exact answer behind a message."""
+    with _lock:
+        _jobs[message_id] = (username, question, job)
+    return job
+
+def pending_exact(username):
+    """Number of the user's approximate answers still waiting for their exact result."""
+    with _lock:
+        return sum(1 for user, _, _ in _jobs.values() if user == username)
+
+def finished_exact(username):
+    """Pop the user's finished exact jobs as (message_id, question, response)."""
+    finished = []
+    with _lock:
+        for message_id, (user, question, future) in list(_jobs.items()):
+            if user == username and future.done():
+                del _jobs[message_id]
+                finished.append((message_id, question, future))
+    results = []
+    for message_id, question, future in finished:
+        try:
+            results.append((message_id, question, future.result()))
+        except Exception as e:
+            print(f"Error computing exact answer: {e}")
+            results.append((message_id, question, None))
+    return results
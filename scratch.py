@@ -0,0 +1,177 @@
+import os
+import re
+import sqlite3
+import hashlib
+from datetime import datetime
+from utils import get_db_path
+
+# Each conversation gets its own scratch database, attached to the user's
+# database as "scratch" so follow-up SQL can read earlier answers
+SCRATCH_DIR = get_db_path(os.getenv("SCRATCH_DIR", "scratch"))
+SCRATCH_SCHEMA = "scratch"
+# SQL naming the scratch schema reads one conversation's earlier answers
+SCRATCH_REFERENCE = re.compile(rf"(?<![\w.])[\"`\[]?{SCRATCH_SCHEMA}[\"`\]]?\s*\.", re.IGNORECASE)
+
+# Disk budget per conversation, and page cache used when reading intermediates
+SCRATCH_MAX_BYTES = int(os.getenv("SCRATCH_MAX_MB", "256")) * 1024 * 1024
+SCRATCH_CACHE_KB = int(os.getenv("SCRATCH_CACHE_MB", "16")) * 1024
+# Larger answers are not materialized; they would crowd out everything else
+SCRATCH_MAX_ROWS = int(os.getenv("SCRATCH_MAX_ROWS", "1000000"))
+
+# How many recent intermediates are described to generate_sql
+PROMPT_INTERMEDIATES = 3
+
+def conversation_id(username, db_path):
+    """Stable id of one user's conversation with one database."""
+    return hashlib.sha256(f"{username}|{os.path.abspath(db_path)}".encode()).hexdigest()[:16]
+
+def reads_scratch(sql_query):
+    """Whether SQL reads scratch tables, so its answer only holds in its own conversation."""
+    return bool(sql_query and SCRATCH_REFERENCE.search(sql_query))
+
+def scratch_path(conversation):
+    return os.path.join(SCRATCH_DIR, f"{conversation}.db")
+
+def connect(db_path, conversation):
+    """Open the user's database with the conversation's scratch database attached."""
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    path = scratch_path(conversation)
+    is_new = not os.path.exists(path)
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"ATTACH DATABASE ? AS {SCRATCH_SCHEMA}", (path,))
+    if is_new:
+        # Must be set before the first table so dropped intermediates can be
+        # returned to the file system
+        conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.auto_vacuum = INCREMENTAL")
+    conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.cache_size = -{SCRATCH_CACHE_KB}")
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {SCRATCH_SCHEMA}.intermediates (
+        name TEXT PRIMARY KEY,
+        question TEXT,
+        sql_query TEXT,
+        row_count INTEGER,
+        bytes INTEGER,
+        created_at TIMESTAMP,
+        last_used TIMESTAMP
+    )
+    ''')
+    return conn
+
+def _scratch_bytes(conn):
+    page_count = conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.page_count").fetchone()[0]
+    page_size = conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.page_size").fetchone()[0]
+    return page_count * page_size
+
+def _sqlite_type(arrow_type):
+    import pyarrow as pa
+    if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+        return "INTEGER"
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return "REAL"
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return "BLOB"
+    return "TEXT"
+
+def _next_name(conn):
+    names = [row[0] for row in conn.execute(f"SELECT name FROM {SCRATCH_SCHEMA}.intermediates")]
+    numbers = [int(m.group(1)) for m in (re.match(r"result_(\d+)$", n) for n in names) if m]
+    return f"result_{max(numbers, default=0) + 1}"
+
+def materialize_result(db_path, conversation, question, sql_query, table):
+    """
+    Store an answer's Arrow result as a table in the conversation's scratch
+    database, then evict least recently used intermediates over budget.
+
+    Returns the qualified table name, or None if the result was not stored.
+    """
+    if table is None or table.num_rows == 0 or table.num_rows > SCRATCH_MAX_ROWS:
+        return None
+    try:
+        conn = connect(db_path, conversation)
+    except sqlite3.Error as e:
+        print(f"Error opening scratch database: {e}")
+        return None
+    try:
+        name = _next_name(conn)
+        before = _scratch_bytes(conn)
+        column_defs = ", ".join(f'"{f.name}" {_sqlite_type(f.type)}' for f in table.schema)
+        conn.execute(f'CREATE TABLE {SCRATCH_SCHEMA}."{name}" ({column_defs})')
+        placeholders = ", ".join("?" for _ in table.column_names)
+        for batch in table.to_batches(max_chunksize=10000):
+            columns = [column.to_pylist() for column in batch.columns]
+            conn.executemany(f'INSERT INTO {SCRATCH_SCHEMA}."{name}" VALUES ({placeholders})', zip(*columns))
+        now = datetime.now().isoformat()
+        page_size = conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.page_size").fetchone()[0]
+        conn.execute(f'''
+        INSERT INTO {SCRATCH_SCHEMA}.intermediates
+        (name, question, sql_query, row_count, bytes, created_at, last_used)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (name, question, sql_query, table.num_rows,
+              max(_scratch_bytes(conn) - before, page_size), now, now))
+        conn.commit()
+        evict(conn, keep=name)
+        return f"{SCRATCH_SCHEMA}.{name}"
+    except sqlite3.Error as e:
+        # Follow-ups just fall back to the base tables
+        print(f"Error materializing result: {e}")
+        return None
+    finally:
+        conn.close()
+
+def evict(conn, keep=None, max_bytes=None):
+    """Drop least recently used intermediates until the scratch database fits its budget."""
+    max_bytes = SCRATCH_MAX_BYTES if max_bytes is None else max_bytes
+    evicted = []
+    rows = conn.execute(f'''
+    SELECT name, bytes FROM {SCRATCH_SCHEMA}.intermediates ORDER BY last_used ASC
+    ''').fetchall()
+    total = sum(size for _, size in rows)
+    for name, size in rows:
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        conn.execute(f'DROP TABLE IF EXISTS {SCRATCH_SCHEMA}."{name}"')
+        conn.execute(f"DELETE FROM {SCRATCH_SCHEMA}.intermediates WHERE name = ?", (name,))
+        total -= size
+        evicted.append(name)
+    if evicted:
+        conn.commit()
+        conn.execute(f"PRAGMA {SCRATCH_SCHEMA}.incremental_vacuum")
+    return evicted
+
+def touch_intermediates(db_path, conversation, sql_query):
+    """Mark intermediates referenced by a query as recently used."""
+    if not conversation or f"{SCRATCH_SCHEMA}." not in sql_query.lower():
+        return
+    conn = connect(db_path, conversation)
+    try:
+        names = [row[0] for row in conn.execute(f"SELECT name FROM {SCRATCH_SCHEMA}.intermediates")]
+        used = [n for n in names if re.search(rf"\b{SCRATCH_SCHEMA}\.\"?{n}\b", sql_query, re.IGNORECASE)]
+        now = datetime.now().isoformat()
+        conn.executemany(
+            f"UPDATE {SCRATCH_SCHEMA}.intermediates SET last_used = ? WHERE name = ?",
+            [(now, n) for n in used]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def describe_intermediates(db_path, conversation, limit=PROMPT_INTERMEDIATES):
+    """Schema text for the conversation's most recent intermediates, for the SQL prompt."""
+    if not conversation or not os.path.exists(scratch_path(conversation)):
+        return ""
+    conn = connect(db_path, conversation)
+    try:
+        rows = conn.execute(f'''
+        SELECT name, question, row_count FROM {SCRATCH_SCHEMA}.intermediates
+        ORDER BY created_at DESC LIMIT ?
+        ''', (limit,)).fetchall()
+        text = ""
+        for name, question, row_count in rows:
+            text += f'Table: {SCRATCH_SCHEMA}.{name} ({row_count} rows, answer to "{question}")\n'
+            for column in conn.execute(f'PRAGMA {SCRATCH_SCHEMA}.table_info("{name}")'):
+                text += f"  - {column[1]} ({column[2]})\n"
+        return text
+    finally:
+        conn.close()
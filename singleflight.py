@@ -0,0 +1,70 @@
+import os
+import time
+import uuid
+import threading
+from database_cache import try_lock_query, unlock_query, is_query_locked
+
+# A question being answered holds its lock for at most this long, so a crashed
+# answer does not block the same question for good
+SINGLEFLIGHT_TTL = int(os.getenv("SINGLEFLIGHT_TTL", "300"))
+# How often waiters in other processes look at the lock
+POLL_INTERVAL = 0.2
+
+_lock = threading.Lock()
+_inflight = {}  # cache key -> (token, Event set when the answer in this process is done)
+
+def acquire(cache_key):
+    """
+    Try to become the one answering `cache_key`. Returns a token to pass to
+    release() once the answer is cached, or None if the same question is
+    already being answered in this or another process.
+    """
+    token = f"{os.getpid()}-{uuid.uuid4().hex}"
+    with _lock:
+        if cache_key in _inflight:
+            return None
+        _inflight[cache_key] = (token, threading.Event())
+    try:
+        if try_lock_query(cache_key, token, SINGLEFLIGHT_TTL):
+            return token
+    except Exception as e:
+        # Without the shared lock, answer anyway rather than fail the question
+        print(f"Error taking query lock: {e}")
+        return token
+    with _lock:
+        _inflight.pop(cache_key)[1].set()
+    return None
+
+def release(cache_key, token):
+    """Give up the lock taken by acquire() and wake up anyone waiting on it."""
+    if token is None:
+        return
+    try:
+        unlock_query(cache_key, token)
+    except Exception as e:
+        print(f"Error releasing query lock: {e}")
+    with _lock:
+        entry = _inflight.get(cache_key)
+        if entry is None or entry[0] != token:
+            return
+        del _inflight[cache_key]
+    entry[1].set()
+
+def wait(cache_key, timeout):
+    """Wait up to `timeout` seconds for the answer to `cache_key` to finish. Returns True if it did."""
+    with _lock:
+        entry = _inflight.get(cache_key)
+    if entry:
+        return entry[1].wait(timeout)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if not is_query_locked(cache_key):
+                return True
+        except Exception as e:
+            print(f"Error checking query lock: {e}")
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(POLL_INTERVAL, remaining))
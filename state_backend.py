@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import secrets
+import importlib
+import threading
+from abc import ABC, abstractmethod
+from utils import get_db_path, connect_initialized
+
+# State that must outlive a Streamlit session and be visible to every worker
+# process on the host: logins, each user's active database and conversation
+# context. "sqlite" (the default) keeps it in STATE_DB next to the other
+# databases; any other value names a StateBackend subclass as "module:Class".
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB = os.getenv("STATE_DB", "state.db")
+SESSION_TTL = int(os.getenv("SESSION_TTL_HOURS", "168")) * 3600
+# Tokens in page URLs end up in browser history and proxy logs, so they are
+# short-lived and replaced each time they are used
+URL_SESSION_TTL = int(os.getenv("URL_SESSION_TTL_MINUTES", "60")) * 60
+
+class StateBackend(ABC):
+    """
+    Interface of a shared key-value store. Values are JSON-serializable; keys
+    live in namespaces and may expire after `ttl` seconds. Implementations must
+    be safe to use from several threads and processes at once.
+    """
+
+    @abstractmethod
+    def get(self, namespace, key):
+        """The value stored under the key, or None if missing or expired."""
+
+    @abstractmethod
+    def set(self, namespace, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def delete(self, namespace, key):
+        pass
+
+class SQLiteStateBackend(StateBackend):
+    """State in one SQLite database in WAL mode, shared by the processes on a host."""
+
+    def __init__(self, path=None):
+        self.path = path or get_db_path(STATE_DB)
+
+    def _init(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT,
+                key TEXT,
+                value TEXT,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return connect_initialized(self.path, self._init, timeout=10)
+
+    def get(self, namespace, key):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?",
+                               (namespace, key)).fetchone()
+        finally:
+            conn.close()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                         (namespace, key, json.dumps(value), time.time() + ttl if ttl else None))
+            # Expired entries are cleared as new ones come in
+            conn.execute("DELETE FROM state WHERE expires_at < ?", (time.time(),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, namespace, key):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.commit()
+        finally:
+            conn.close()
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """The configured backend, created on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if STATE_BACKEND == "sqlite":
+                _backend = SQLiteStateBackend()
+            else:
+                module_name, _, class_name = STATE_BACKEND.partition(":")
+                _backend = getattr(importlib.import_module(module_name), class_name)()
+        return _backend
+
+def create_session(username, ttl=SESSION_TTL):
+    """Start a login session and return its token."""
+    token = secrets.token_urlsafe(24)
+    get_backend().set('sessions', token, {'username': username, 'created_at': time.time()}, ttl=ttl)
+    return token
+
+def rotate_session(token, ttl=URL_SESSION_TTL):
+    """
+    Exchange a live session token for a new one, ending the old one.
+    Returns (username, new token), or (None, None) if the token is not live.
+    """
+    username = get_session_user(token)
+    if not username:
+        return None, None
+    end_session(token)
+    return username, create_session(username, ttl)
+
+def get_session_user(token):
+    """Username of a live session, or None."""
+    if not token:
+        return None
+    session = get_backend().get('sessions', token)
+    return session['username'] if session else None
+
+def end_session(token):
+    if token:
+        get_backend().delete('sessions', token)
+
+def set_active_database(username, db_path, schema, file_id=None):
+    """Remember the database a user is working with, for any worker to pick up."""
+    get_backend().set('databases', username, {'db_path': db_path, 'schema': schema, 'file_id': file_id})
+
+def get_active_database(username):
+    """The user's active database as {'db_path', 'schema', 'file_id'}, if its file still exists."""
+    active = get_backend().get('databases', username) if username else None
+    if active and os.path.exists(active['db_path']):
+        return active
+    return None
+
+def clear_active_database(username):
+    get_backend().delete('databases', username)
+
+def set_context(username, name, value):
+    """Store a piece of a user's conversation context, such as the suggested questions."""
+    get_backend().set('context', f"{username}:{name}", value)
+
+def get_context(username, name, default=None):
+    value = get_backend().get('context', f"{username}:{name}")
+    return default if value is None else value
@@ -0,0 +1,438 @@
+import os
+import sys
+import time
+import glob
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+import derived
+import scratch
+from utils import get_db_path, connect_initialized
+
+# Uploaded databases are stored once per distinct content, as blobs named by
+# their SHA-256, and each user sees them under their own file names. Disk use
+# is capped per user and overall; idle databases are evicted least recently
+# used first, together with their sidecar, scratch databases and cached answers.
+STORAGE_DIR = get_db_path(os.getenv("STORAGE_DIR", "uploads"))
+STORAGE_DB = get_db_path(os.getenv("STORAGE_DB", "storage.db"))
+STORAGE_USER_QUOTA = int(os.getenv("STORAGE_USER_QUOTA_MB", "500")) * 1024 * 1024
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_MB", "5000")) * 1024 * 1024
+# Databases unused this long are removed by the janitor
+STORAGE_IDLE_DAYS = float(os.getenv("STORAGE_IDLE_DAYS", "30"))
+# Databases used more recently than this are never evicted; someone is on them
+STORAGE_MIN_IDLE_SECONDS = int(os.getenv("STORAGE_MIN_IDLE_MINUTES", "10")) * 60
+JANITOR_INTERVAL = int(os.getenv("STORAGE_JANITOR_MINUTES", "15")) * 60
+
+# Temporary files (uploads being written, CSV conversions) older than this are
+# leftovers of a crash
+STALE_TEMP_SECONDS = 3600
+CHUNK_SIZE = 1024 * 1024
+
+class QuotaExceeded(Exception):
+    """The upload does not fit in the user's quota even after evicting their idle databases."""
+
+def init_storage_db():
+    conn = sqlite3.connect(STORAGE_DB)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER,
+            schema_hash TEXT,
+            created_at TIMESTAMP
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            username TEXT,
+            name TEXT,
+            sha256 TEXT,
+            uploaded_at TIMESTAMP,
+            last_used REAL,
+            PRIMARY KEY (username, name)
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        conn.commit()
+    finally:
+        conn.close()
+
+def _connect():
+    return connect_initialized(STORAGE_DB, init_storage_db, timeout=30, isolation_level=None)
+
+def _blob_dir():
+    path = os.path.join(STORAGE_DIR, "blobs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _tmp_dir():
+    path = os.path.join(STORAGE_DIR, "tmp")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def blob_path(sha256):
+    return os.path.join(_blob_dir(), f"{sha256}.db")
+
+def data_version(db_path):
+    """
+    Identifies the data in a database: the content SHA-256 of a stored
+    upload, else the file's size and modification time.
+    """
+    name, ext = os.path.splitext(os.path.basename(db_path))
+    if ext == ".db" and os.path.dirname(os.path.abspath(db_path)) == os.path.abspath(_blob_dir()):
+        return name
+    stat = os.stat(db_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def new_temp_path(suffix=".db"):
+    """A temporary file in the storage area, e.g. for a CSV conversion, to pass to store_file."""
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=_tmp_dir())
+    os.close(fd)
+    return path
+
+def _sibling_files(path):
+    """A database file with its journals and derived sidecar."""
+    base = [path, derived.derived_path(path)]
+    return [p for b in base for p in (b, f"{b}-wal", f"{b}-shm", f"{b}-journal")]
+
+def disk_usage(path):
+    """Bytes a stored database takes with its journals and sidecar."""
+    return sum(os.path.getsize(p) for p in _sibling_files(path) if os.path.exists(p))
+
+def _remove_files(paths):
+    freed = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing {path}: {e}")
+    return freed
+
+def _schema_hash(path):
+    from database import get_database_schema
+    schema = get_database_schema(path)
+    return hashlib.sha256(schema.encode()).hexdigest() if schema is not None else None
+
+def store_file(username, name, temp_path):
+    """
+    Take ownership of a database file written to new_temp_path() and store it
+    as `name` for the user. Returns the path to open it at.
+    """
+    digest = hashlib.sha256()
+    with open(temp_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    size = os.path.getsize(temp_path)
+    try:
+        return _add_file(username, name, sha256, size, temp_path)
+    finally:
+        _remove_files([temp_path])
+
+def store_upload(username, name, data):
+    """Store uploaded database bytes (or a buffer) as `name` for the user. Returns the path to open it at."""
+    temp_path = new_temp_path()
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    return store_file(username, name, temp_path)
+
+def _add_file(username, name, sha256, size, temp_path):
+    path = blob_path(sha256)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        previous = conn.execute("SELECT sha256 FROM files WHERE username = ? AND name = ?",
+                                (username, name)).fetchone()
+        used = _user_usage(conn, username, exclude=(name,))
+        if used + size > STORAGE_USER_QUOTA:
+            _evict_user_files(conn, username, used + size - STORAGE_USER_QUOTA, keep=name)
+            used = _user_usage(conn, username, exclude=(name,))
+            if used + size > STORAGE_USER_QUOTA:
+                conn.execute("ROLLBACK")
+                raise QuotaExceeded(
+                    f"This upload needs {size / 2**20:.1f} MB but only "
+                    f"{max(0, STORAGE_USER_QUOTA - used) / 2**20:.1f} MB of your "
+                    f"{STORAGE_USER_QUOTA / 2**20:.0f} MB quota is free. Remove some databases first."
+                )
+        if not conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone() or not os.path.exists(path):
+            # Identical content uploaded before is reused, with its indexes
+            os.replace(temp_path, path)
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                         (sha256, size, _schema_hash(path), datetime.now().isoformat()))
+        conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                     (username, name, sha256, datetime.now().isoformat(), time.time()))
+        if previous and previous[0] != sha256:
+            _release_blob(conn, previous[0], username)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    enforce_total_limit()
+    return path
+
+def _user_usage(conn, username, exclude=()):
+    rows = conn.execute('''
+    SELECT f.name, b.size FROM files f JOIN blobs b ON b.sha256 = f.sha256 WHERE f.username = ?
+    ''', (username,)).fetchall()
+    return sum(size for name, size in rows if name not in exclude)
+
+def _release_blob(conn, sha256, username):
+    """
+    Drop what a user kept for a blob they no longer reference: their scratch
+    database for it and, once nobody references it, the blob with its sidecar
+    and cached answers. Caller holds a write transaction. Returns bytes freed.
+    """
+    path = blob_path(sha256)
+    freed = _remove_files([scratch.scratch_path(scratch.conversation_id(username, path))])
+    if conn.execute("SELECT 1 FROM files WHERE sha256 = ?", (sha256,)).fetchone():
+        return freed
+    row = conn.execute("SELECT schema_hash FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+    freed += _remove_files(_sibling_files(path))
+    from database_cache import delete_cached_for_schema, delete_cached_for_version
+    # Answers on this data go with it; answers on other data of the schema
+    # stay while another database has it, to be re-run on that one
+    delete_cached_for_version(sha256)
+    schema_hash = row[0] if row else None
+    if schema_hash and not conn.execute("SELECT 1 FROM blobs WHERE schema_hash = ?", (schema_hash,)).fetchone():
+        delete_cached_for_schema(schema_hash)
+    return freed
+
+def _evict_user_files(conn, username, needed, keep=None):
+    """
+    Remove the user's least recently used idle files until `needed` bytes are
+    released from their quota. Files are removed from disk right away, so
+    nothing is removed unless enough can be released. Returns bytes released.
+    """
+    rows = conn.execute('''
+    SELECT f.name, f.sha256, b.size, f.last_used FROM files f JOIN blobs b ON b.sha256 = f.sha256
+    WHERE f.username = ? ORDER BY f.last_used
+    ''', (username,)).fetchall()
+    evicted = []
+    released = 0
+    cutoff = time.time() - STORAGE_MIN_IDLE_SECONDS
+    for name, sha256, size, last_used in rows:
+        if released >= needed:
+            break
+        if name == keep or last_used > cutoff:
+            continue
+        evicted.append((name, sha256))
+        released += size
+    if released < needed:
+        return 0
+    for name, sha256 in evicted:
+        conn.execute("DELETE FROM files WHERE username = ? AND name = ?", (username, name))
+        _release_blob(conn, sha256, username)
+        print(f"Evicted {username}/{name} to make room in their quota")
+    return released
+
+def resolve(username, name):
+    """Path of the user's stored database `name`, or None."""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT sha256 FROM files WHERE username = ? AND name = ?", (username, name)).fetchone()
+    finally:
+        conn.close()
+    if row and os.path.exists(blob_path(row[0])):
+        return blob_path(row[0])
+    return None
+
+def list_files(username):
+    """The user's stored databases as dicts, most recently used first."""
+    conn = _connect()
+    try:
+        rows = conn.execute('''
+        SELECT f.name, f.sha256, b.size, f.uploaded_at, f.last_used
+        FROM files f JOIN blobs b ON b.sha256 = f.sha256 WHERE f.username = ? ORDER BY f.last_used DESC
+        ''', (username,)).fetchall()
+    finally:
+        conn.close()
+    return [{'name': name, 'path': blob_path(sha256), 'size': size, 'uploaded_at': uploaded_at,
+             'last_used': last_used} for name, sha256, size, uploaded_at, last_used in rows]
+
+def remove_file(username, name):
+    """Delete one of the user's databases. Returns bytes freed on disk."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT sha256 FROM files WHERE username = ? AND name = ?", (username, name)).fetchone()
+        freed = 0
+        if row:
+            conn.execute("DELETE FROM files WHERE username = ? AND name = ?", (username, name))
+            freed = _release_blob(conn, row[0], username)
+        conn.execute("COMMIT")
+        return freed
+    finally:
+        conn.close()
+
+def touch(db_path):
+    """Mark a stored database as just used, for LRU eviction. Paths outside storage are ignored."""
+    if os.path.dirname(os.path.abspath(db_path)) != os.path.abspath(os.path.join(STORAGE_DIR, "blobs")):
+        return
+    sha256 = os.path.basename(db_path)[:-len(".db")]
+    try:
+        conn = _connect()
+        try:
+            conn.execute("UPDATE files SET last_used = ? WHERE sha256 = ?", (time.time(), sha256))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Error updating storage use: {e}")
+
+def _blob_usage(conn):
+    """(sha256, disk bytes, last used by anyone) of every stored blob, least recently used first."""
+    rows = conn.execute('''
+    SELECT b.sha256, MAX(f.last_used) FROM blobs b LEFT JOIN files f ON f.sha256 = b.sha256
+    GROUP BY b.sha256 ORDER BY MAX(f.last_used)
+    ''').fetchall()
+    return [(sha256, disk_usage(blob_path(sha256)), last_used or 0) for sha256, last_used in rows]
+
+def _evict_blob(conn, sha256):
+    """Remove a blob for every user that has it. Caller holds a write transaction."""
+    users = [row[0] for row in conn.execute("SELECT username FROM files WHERE sha256 = ?", (sha256,))]
+    conn.execute("DELETE FROM files WHERE sha256 = ?", (sha256,))
+    freed = 0
+    for username in users or [None]:
+        freed += _release_blob(conn, sha256, username)
+    return freed
+
+def enforce_total_limit():
+    """Evict least recently used idle databases until storage is under STORAGE_MAX_MB. Returns bytes freed."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        usage = _blob_usage(conn)
+        total = sum(size for _, size, _ in usage)
+        freed = 0
+        cutoff = time.time() - STORAGE_MIN_IDLE_SECONDS
+        for sha256, size, last_used in usage:
+            if total - freed <= STORAGE_MAX_BYTES:
+                break
+            if last_used > cutoff:
+                continue
+            freed += _evict_blob(conn, sha256)
+        conn.execute("COMMIT")
+        return freed
+    finally:
+        conn.close()
+
+def _orphans(conn):
+    """Files in the storage area that nothing refers to any more."""
+    known = {row[0] for row in conn.execute("SELECT sha256 FROM blobs")}
+    orphans = []
+    for path in glob.glob(os.path.join(_blob_dir(), "*")):
+        sha256 = os.path.basename(path).split(".db")[0]
+        if sha256 not in known:
+            orphans.append(path)
+    stale = time.time() - STALE_TEMP_SECONDS
+    orphans += [p for p in glob.glob(os.path.join(_tmp_dir(), "*")) if os.path.getmtime(p) < stale]
+    # Scratch databases of conversations whose database is gone
+    live = {scratch.conversation_id(username, blob_path(sha256))
+            for username, sha256 in conn.execute("SELECT username, sha256 FROM files")}
+    for path in glob.glob(os.path.join(scratch.SCRATCH_DIR, "*.db")):
+        if os.path.basename(path)[:-len(".db")] not in live and os.path.getmtime(path) < stale:
+            orphans.append(path)
+    return orphans
+
+def reclaim_report():
+    """
+    Where storage goes and what a janitor pass would reclaim: totals per user,
+    databases idle past STORAGE_IDLE_DAYS, and orphaned files.
+    """
+    conn = _connect()
+    try:
+        usage = _blob_usage(conn)
+        users = conn.execute('''
+        SELECT f.username, COUNT(*), SUM(b.size) FROM files f JOIN blobs b ON b.sha256 = f.sha256
+        GROUP BY f.username ORDER BY SUM(b.size) DESC
+        ''').fetchall()
+        logical = conn.execute("SELECT COALESCE(SUM(b.size), 0) FROM files f JOIN blobs b ON b.sha256 = f.sha256"
+                               ).fetchone()[0]
+        orphans = _orphans(conn)
+    finally:
+        conn.close()
+    idle_cutoff = time.time() - STORAGE_IDLE_DAYS * 86400
+    idle = [(sha256, size) for sha256, size, last_used in usage if last_used < idle_cutoff]
+    orphan_bytes = sum(os.path.getsize(p) for p in orphans if os.path.exists(p))
+    return {
+        'total_bytes': sum(size for _, size, _ in usage),
+        'limit_bytes': STORAGE_MAX_BYTES,
+        'databases': len(usage),
+        # Bytes users would take without deduplication
+        'deduplicated_bytes': max(0, logical - sum(size for _, size, _ in usage)),
+        'users': [{'username': u, 'files': n, 'bytes': b, 'quota_bytes': STORAGE_USER_QUOTA} for u, n, b in users],
+        'idle_databases': len(idle),
+        'idle_bytes': sum(size for _, size in idle),
+        'orphan_files': len(orphans),
+        'orphan_bytes': orphan_bytes,
+        'reclaimable_bytes': sum(size for _, size in idle) + orphan_bytes
+    }
+
+def janitor_pass():
+    """Remove idle databases and orphaned files, then enforce the total limit. Returns bytes freed per reason."""
+    freed = {'idle': 0, 'orphans': 0, 'over_limit': 0}
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        idle_cutoff = time.time() - STORAGE_IDLE_DAYS * 86400
+        for sha256, _, last_used in _blob_usage(conn):
+            if last_used < idle_cutoff:
+                freed['idle'] += _evict_blob(conn, sha256)
+        freed['orphans'] = _remove_files(_orphans(conn))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    freed['over_limit'] = enforce_total_limit()
+    return freed
+
+_janitor = None
+_janitor_lock = threading.Lock()
+
+def _janitor_loop(interval):
+    while True:
+        try:
+            freed = janitor_pass()
+            if any(freed.values()):
+                print(f"Storage janitor reclaimed {sum(freed.values()) / 2**20:.1f} MB: {freed}")
+        except Exception as e:
+            print(f"Error in storage janitor: {e}")
+        time.sleep(interval)
+
+def start_janitor(interval=JANITOR_INTERVAL):
+    """Run janitor passes in a background thread, once per process."""
+    global _janitor
+    with _janitor_lock:
+        if _janitor is None:
+            _janitor = threading.Thread(target=_janitor_loop, args=(interval,), name="storage-janitor", daemon=True)
+            _janitor.start()
+
+def _format_report(report):
+    mb = lambda n: f"{n / 2**20:,.1f} MB"
+    lines = [
+        f"Stored: {mb(report['total_bytes'])} of {mb(report['limit_bytes'])} in {report['databases']} databases "
+        f"({mb(report['deduplicated_bytes'])} saved by deduplication)",
+        f"Idle over {STORAGE_IDLE_DAYS:g} days: {report['idle_databases']} databases, {mb(report['idle_bytes'])}",
+        f"Orphaned files: {report['orphan_files']}, {mb(report['orphan_bytes'])}",
+        f"Reclaimable: {mb(report['reclaimable_bytes'])}",
+    ]
+    for user in report['users']:
+        lines.append(f"  {user['username']:<20} {user['files']:>4} files {mb(user['bytes']):>12} "
+                     f"of {mb(user['quota_bytes'])}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    # python storage.py            -> reclaim report
+    # python storage.py --reclaim  -> run a janitor pass, then report
+    if "--reclaim" in sys.argv[1:]:
+        print(f"Reclaimed: {janitor_pass()}")
+    print(_format_report(reclaim_report()))
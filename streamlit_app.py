@@ -1,14 +1,27 @@
 import streamlit as st
 import os
-from auth import authenticate_user, register_user, logout_user, is_user_logged_in
-from database import handle_database_upload, get_database_schema
-from nl2sql import process_query
+from auth import authenticate_user, register_user, logout_user, is_user_logged_in, login_user
+from database import handle_database_upload
 from visualization import generate_visualization
 from utils import load_env
-from cache import get_cached_response, cache_response
 from follow_up import generate_follow_up_questions
+from metrics import span
+from metrics_dashboard import is_admin, show_metrics_dashboard
+from downsample import reduce_for_chart, COUNT_COL
+from prefetch import prefetch_follow_ups, cancel_prefetch, wait_for_prefetch
 import altair as alt
 import pandas as pd
+import pyarrow as pa
+import chat_history
+import scratch
+import sampling
+import pipeline
+import state_backend
+import storage
+import export
+import paging
+import query_pool
+import threading
 from datetime import datetime
 
 load_env()
@@ -17,57 +30,128 @@ st.set_page_config(page_title="NL2SQL Chatbot", page_icon="🤖")
 
 def initialize_session_state():
     """Initialize session state variables"""
-    if 'user_chat_histories' not in st.session_state:
-        st.session_state['user_chat_histories'] = {}
-    
-    # Initialize current user's chat history
-    current_user = st.session_state.get('current_user')
-    if current_user and current_user not in st.session_state['user_chat_histories']:
-        st.session_state['user_chat_histories'][current_user] = []
+    # Chat history lives in the chat history database; the session only keeps
+    # how many of the most recent messages to show
+    if 'history_limit' not in st.session_state:
+        st.session_state['history_limit'] = chat_history.PAGE_SIZE
 
-def get_current_chat_history():
-    """Get chat history for current user"""
-    current_user = st.session_state.get('current_user')
-    return st.session_state['user_chat_histories'].get(current_user, [])
+def load_older_messages():
+    """Button callback: show another page of older messages."""
+    st.session_state['history_limit'] = st.session_state.get('history_limit', chat_history.PAGE_SIZE) + chat_history.PAGE_SIZE
 
 def display_chat_history():
-    """Display chat history with static visualizations."""
-    chat_history = get_current_chat_history()
-    for message in chat_history:
+    """Display the most recent chat messages with static visualizations."""
+    current_user = st.session_state.get('current_user')
+    if not current_user:
+        return
+    limit = st.session_state.get('history_limit', chat_history.PAGE_SIZE)
+    if chat_history.count_messages(current_user) > limit:
+        st.button("Load older messages", on_click=load_older_messages)
+
+    for message in chat_history.get_recent_messages(current_user, limit):
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
-            if message.get("visualization"):
-                viz_chart = create_static_visualization(message["visualization"])
-                if viz_chart:
-                    st.altair_chart(viz_chart, use_container_width=True)
-
-def add_message_to_history(role, content, visualization=None):
-    """Add message to chat history with visualization data and settings."""
+            if message["has_visualization"]:
+                with span('render'):
+                    spec = get_chart_spec(message["id"])
+                    if spec:
+                        st.vega_lite_chart(spec, use_container_width=True)
+            if message["role"] == "assistant":
+                show_result_table(message["id"], message["sql_query"])
+
+def show_result_table(message_id, sql_query):
+    """
+    Browse the full result of an answer a page at a time. Pages are read
+    from the server as they are shown, so only the current one is held.
+    """
+    if not sql_query or not sql_query.upper().startswith("SELECT"):
+        return
+    if not st.toggle("Browse rows", key=f"browse_{message_id}"):
+        return
+    db_path = st.session_state['db_path']
+    conversation = scratch.conversation_id(st.session_state.get('current_user'), db_path)
+    try:
+        with st.spinner("Loading rows..."):
+            _, row_count = paging.open_result(db_path, conversation, sql_query)
+            columns = paging.result_columns(db_path, conversation, sql_query)
+        if not row_count:
+            st.caption("The query returned no rows.")
+            return
+        col1, col2, col3 = st.columns([2, 1, 1])
+        sort = col1.selectbox("Sort by", ["(query order)"] + columns, key=f"sort_{message_id}")
+        descending = col2.toggle("Descending", key=f"desc_{message_id}")
+        pages = paging.page_count(row_count)
+        page = col3.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1,
+                                 key=f"page_{message_id}")
+        with st.spinner("Loading rows..."):
+            rows = paging.get_page(db_path, conversation, sql_query, page - 1,
+                                   sort=None if sort == "(query order)" else sort, descending=descending)
+        st.dataframe(pd.DataFrame(rows, columns=columns), hide_index=True, use_container_width=True)
+        st.caption(f"Rows {(page - 1) * paging.PAGE_SIZE + 1:,}–{(page - 1) * paging.PAGE_SIZE + len(rows):,} "
+                   f"of {row_count:,}")
+    except Exception as e:
+        st.caption(f"Rows are not available for this answer: {e}")
+
+def chart_to_spec(chart):
+    """
+    Convert an Altair chart into a Vega-Lite spec with its datasets already
+    encoded as Arrow bytes, so Streamlit can send it without re-serializing.
+    """
+    # Charts are already reduced to their point budget, so Altair's row guard
+    # would only get in the way here
+    with alt.data_transformers.disable_max_rows():
+        spec = chart.to_dict()
+    datasets = {}
+    for name, records in spec.get('datasets', {}).items():
+        table = pa.Table.from_pandas(pd.DataFrame(records))
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        datasets[name] = sink.getvalue().to_pybytes()
+    spec['datasets'] = datasets
+    return spec
+
+def build_chart_spec(viz_settings):
+    """Build the Vega-Lite spec for stored visualization settings."""
+    chart = create_static_visualization(viz_settings)
+    return chart_to_spec(chart) if chart else None
+
+def get_chart_spec(message_id):
+    """Return the memoized Vega-Lite spec of a chat message, building it once if missing."""
+    spec = chat_history.get_chart_spec(message_id)
+    if spec is None:
+        viz_settings = chat_history.get_visualization(message_id)
+        spec = build_chart_spec(viz_settings)
+        if spec:
+            chat_history.save_chart_spec(message_id, spec)
+    return spec
+
+def get_viz_settings(visualization):
+    """Visualization data together with the current chart settings, as stored in history."""
+    if not visualization:
+        return None
+    return {
+        'chart_type': st.session_state.get('current_chart_type', 'bar'),
+        'x_col': st.session_state.get('current_x_col'),
+        'y_col': st.session_state.get('current_y_col'),
+        'data': visualization  # Store the complete visualization data
+    }
+
+def add_message_to_history(role, content, visualization=None, sql_query=None):
+    """Add message to chat history with visualization data and settings. Returns the message id."""
     current_user = st.session_state.get('current_user')
     if current_user:
-        # If visualization exists, store the current chart settings
-        if visualization:
-            viz_settings = {
-                'chart_type': st.session_state.get('current_chart_type', 'bar'),
-                'x_col': st.session_state.get('current_x_col'),
-                'y_col': st.session_state.get('current_y_col'),
-                'data': visualization  # Store the complete visualization data
-            }
-        else:
-            viz_settings = None
-
-        message = {
-            "role": role,
-            "content": content,
-            "visualization": viz_settings,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        # Initialize list if it doesn't exist
-        if current_user not in st.session_state['user_chat_histories']:
-            st.session_state['user_chat_histories'][current_user] = []
-            
-        st.session_state['user_chat_histories'][current_user].append(message)
+        viz_settings = get_viz_settings(visualization)
+        # Build the chart spec once now; reruns reuse the stored spec
+        chart_spec = build_chart_spec(viz_settings) if viz_settings else None
+        return chat_history.add_message(current_user, role, content, viz_settings, chart_spec, sql_query)
+    return None
+
+def replace_message_in_history(message_id, content, visualization=None):
+    """Replace a stored message, e.g. an approximate answer with the exact one."""
+    viz_settings = get_viz_settings(visualization)
+    chart_spec = build_chart_spec(viz_settings) if viz_settings else None
+    chat_history.update_message(message_id, content, viz_settings, chart_spec)
 
 def create_static_visualization(viz_settings):
     """Create a visualization without interactive elements."""
@@ -109,6 +193,10 @@ def create_visualization(data, chart_type, x_col, y_col):
         # Convert data to DataFrame
         df = pd.DataFrame(data) if isinstance(data, list) else pd.DataFrame(data)
 
+        # Reduce large results before Altair serializes every row to the browser
+        df = reduce_for_chart(df, chart_type, x_col, y_col)
+        binned = COUNT_COL in df.columns
+
         # Color scheme
         color_scheme = 'tableau10'  # Professional color palette
         
@@ -175,8 +263,9 @@ def create_visualization(data, chart_type, x_col, y_col):
                 x=alt.X(x_col, scale=alt.Scale(zero=False)),
                 y=alt.Y(y_col, scale=alt.Scale(zero=False)),
                 color=alt.Color(y_col, scale=alt.Scale(scheme=color_scheme)),
-                size=alt.value(100),
-                tooltip=tooltip_config
+                # Binned scatter plots size each cell by the points it stands for
+                size=alt.Size(COUNT_COL, legend=alt.Legend(title='Points')) if binned else alt.value(100),
+                tooltip=tooltip_config + ([alt.Tooltip(COUNT_COL, title='Points')] if binned else [])
             ).properties(
                 title=alt.TitleParams(
                     f"{y_col.replace('_', ' ').title()} vs {x_col.replace('_', ' ').title()}",
@@ -189,13 +278,13 @@ def create_visualization(data, chart_type, x_col, y_col):
             chart = alt.Chart(df, **base_config).mark_rect().encode(
                 x=alt.X(x_col, axis=alt.Axis(labelAngle=-45)),
                 y=alt.Y(y_col),
-                color=alt.Color('count()',
+                color=alt.Color(f'sum({COUNT_COL})' if binned else 'count()',
                               scale=alt.Scale(scheme='viridis'),
                               legend=alt.Legend(title='Count')),
                 tooltip=[
                     alt.Tooltip(x_col),
                     alt.Tooltip(y_col),
-                    alt.Tooltip('count()', title='Count')
+                    alt.Tooltip(f'sum({COUNT_COL})' if binned else 'count()', title='Count')
                 ]
             ).properties(
                 title=alt.TitleParams(
@@ -234,31 +323,23 @@ def show_visualization_options(response, key_prefix):
     viz_data = response['visualization']
     
     try:
-        df = pd.DataFrame(viz_data['data'])
-        
-        # Ensure numeric and categorical columns are properly identified
-        numeric_types = ['int64', 'float64']
-        object_types = ['object', 'string']
-        
-        numeric_cols = df.select_dtypes(numeric_types).columns.tolist()
-        categorical_cols = df.select_dtypes(object_types).columns.tolist()
-        
-        # Update visualization data
-        viz_data.update({
-            'numeric_columns': numeric_cols,
-            'categorical_columns': categorical_cols
-        })
+        # Column types were taken from the result's Arrow schema when the
+        # answer was produced, so the chart data is not re-inferred here
+        numeric_cols = viz_data.get('numeric_columns', [])
+        settings = viz_data.get('default_settings', {})
+        x_col, y_col = settings.get('x_col'), settings.get('y_col')
         
         # Create visualization
-        if numeric_cols and (categorical_cols or numeric_cols):
-            chart = create_visualization(
-                viz_data['data'],
-                st.session_state.get('current_chart_type', 'bar'),
-                categorical_cols[0] if categorical_cols else numeric_cols[0],
-                numeric_cols[0]
-            )
-            if chart:
-                st.altair_chart(chart, use_container_width=True)
+        if numeric_cols and x_col and y_col:
+            with span('render', rows=len(viz_data['data'])):
+                chart = create_visualization(
+                    viz_data['data'],
+                    st.session_state.get('current_chart_type', 'bar'),
+                    x_col,
+                    y_col
+                )
+                if chart:
+                    st.altair_chart(chart, use_container_width=True)
         else:
             st.warning("No Visualization Needed")
             
@@ -269,22 +350,7 @@ def handle_cached_response(cached_response):
     """Handle cached response with proper visualization."""
     if cached_response and 'visualization' in cached_response:
         try:
-            # Convert cached data back to proper format
-            df = pd.DataFrame(cached_response['visualization']['data'])
-            
-            # Update visualization data with proper column types
-            numeric_types = ['int64', 'float64']
-            object_types = ['object', 'string']
-            
-            numeric_cols = df.select_dtypes(['int64', 'float64']).columns.tolist()
-            categorical_cols = df.select_dtypes(['object', 'string']).columns.tolist()
-            
-            cached_response['visualization'].update({
-                'numeric_columns': numeric_cols,
-                'categorical_columns': categorical_cols
-            })
-            
-            # Add to chat history and display
+            # Cached visualization data already carries its column types
             handle_response(cached_response)
             return True
         except Exception as e:
@@ -292,60 +358,208 @@ def handle_cached_response(cached_response):
             return False
     return False
 
+def approximate_label(approximate):
+    """Label shown with answers computed from a sample."""
+    return (f"≈ Approximate answer from a {approximate['sample_rate']:.1%} sample "
+            f"({approximate['sample_rows']:,} of {approximate['table_rows']:,} rows); "
+            "it will be replaced by the exact answer when that is ready.")
+
+def format_response_content(response):
+    """Chat history text of an answer."""
+    sql_query = response.get('sql_query')
+    content = ""
+    if response.get('approximate'):
+        content += approximate_label(response['approximate']) + "\n\n"
+    if sql_query:
+        content += f"SQL Query: {sql_query}\n\n"
+    content += f"Summary: {response.get('summary', 'No summary available.')}"
+    return content
+
+def show_confidence_intervals(response):
+    """Table of approximate values with their 95% confidence intervals."""
+    intervals = response['approximate'].get('intervals')
+    results = response.get('results')
+    if not intervals or not isinstance(results, pa.Table):
+        return
+    df = results.slice(0, 20).to_pandas()
+    for column, widths in intervals.items():
+        df[f"{column} ±95%"] = widths[:len(df)]
+    st.dataframe(df, use_container_width=True)
+
 def handle_response(response):
-    """Handle the response and visualization creation."""
+    """Handle the response and visualization creation. Returns the history message id."""
     sql_query = response.get('sql_query')
     summary = response.get('summary', 'No summary available.')
     visualization = response.get('visualization')
     follow_up_questions = response.get('follow_up_questions')
     
-    # Format the content based on what's available
-    content = ""
-    if sql_query:
-        content += f"SQL Query: {sql_query}\n\n"
-    content += f"Summary: {summary}"
-    
     # Add to chat history with visualization
-    add_message_to_history("assistant", content, visualization)
+    message_id = add_message_to_history("assistant", format_response_content(response), visualization, sql_query)
     
     with st.chat_message("assistant"):
         if sql_query and sql_query.startswith("PRAGMA"):
             st.markdown(summary)
         else:
+            if response.get('approximate'):
+                st.caption(approximate_label(response['approximate']))
             st.markdown(summary)
+            if response.get('approximate'):
+                show_confidence_intervals(response)
             if visualization:
                 show_visualization_options(response, f"viz_{datetime.now().isoformat()}")
-        if follow_up_questions:
-            st.markdown("Follow-up questions:")
-            for question in follow_up_questions:
-                st.markdown(f"- {question}")
+            if message_id:
+                show_result_table(message_id, sql_query)
+
+    # Suggestions are rendered as buttons by show_suggested_questions and
+    # answered in the background so that clicking one hits the cache
+    st.session_state['suggested_questions'] = follow_up_questions or []
+    state_backend.set_context(st.session_state.get('current_user'), 'suggested_questions',
+                              st.session_state['suggested_questions'])
+    if follow_up_questions and not (sql_query and sql_query.startswith("PRAGMA")):
+        prefetch_follow_ups(st.session_state.get('current_user'), follow_up_questions,
+                            st.session_state.get('db_path'), st.session_state.get('schema'))
+    return message_id
+
+@st.fragment(run_every=2)
+def show_exact_progress():
+    """Swap in exact answers for approximate ones as their background queries finish."""
+    current_user = st.session_state.get('current_user')
+    finished = sampling.finished_exact(current_user)
+    for message_id, question, response in finished:
+        if response and 'sql_query' in response:
+            replace_message_in_history(message_id, format_response_content(response),
+                                       response.get('visualization'))
+    if finished:
+        st.rerun()
+    pending = sampling.pending_exact(current_user)
+    if pending:
+        st.caption(f"Computing exact results for {pending} approximate answer(s)...")
+
+def remember_answer(question, response, conversation):
+    """Keep the latest answer's SQL so its full result can be exported."""
+    sql_query = response.get('sql_query') or ''
+    if sql_query.upper().startswith('SELECT'):
+        st.session_state['last_answer'] = {'question': question, 'sql_query': sql_query,
+                                           'conversation': conversation}
+
+def start_export(fmt):
+    """Button callback: export the latest answer's full result on the query pool."""
+    cancel_export()
+    answer = st.session_state['last_answer']
+    progress = {'rows': 0}
+    cancelled = threading.Event()
+    # Long-running, so it takes a background slot on the pool
+    job = query_pool.submit(st.session_state.get('current_user'), export.export_to_file,
+                            answer['sql_query'], st.session_state['db_path'], fmt, answer['conversation'],
+                            lambda rows: progress.update(rows=rows), cancelled,
+                            priority=query_pool.BACKGROUND)
+    st.session_state['export'] = {'job': job, 'cancelled': cancelled, 'progress': progress,
+                                  'format': fmt, 'question': answer['question']}
+
+def cancel_export():
+    """Button callback: stop a running export and forget the last one."""
+    current = st.session_state.pop('export', None)
+    if current and not current['job'].done():
+        current['cancelled'].set()
+        current['job'].cancel()
+
+@st.fragment(run_every=1)
+def show_export_progress(current):
+    """Rows exported so far, until the export finishes."""
+    job = current['job']
+    if job.done():
+        st.rerun()
+    position = job.position()
+    if position:
+        st.caption(f"Export queued — position {position}")
+    else:
+        st.caption(f"Exported {current['progress']['rows']:,} rows...")
+    st.button("Cancel export", on_click=cancel_export)
 
-def handle_csv_or_excel_upload(uploaded_file):
-    import tempfile
+def show_export():
+    """Sidebar controls to export the latest answer's full result, without its LIMIT."""
+    answer = st.session_state.get('last_answer')
+    if not answer:
+        return
+    st.subheader("Export full result")
+    st.caption(answer['question'])
+    current = st.session_state.get('export')
+    if current and current['question'] == answer['question']:
+        job = current['job']
+        if not job.done():
+            show_export_progress(current)
+            return
+        try:
+            path = job.result()
+            with open(path, "rb") as f:
+                st.download_button(
+                    f"Download {current['format'].upper()} ({current['progress']['rows']:,} rows)", f,
+                    file_name=export.download_name(answer['question'], current['format']),
+                    mime=export.FORMATS[current['format']][0]
+                )
+        except Exception as e:
+            st.error(f"Export failed: {e}")
+    fmt = st.radio("Format", list(export.FORMATS), horizontal=True, key='export_format')
+    st.button("Export", on_click=start_export, args=(fmt,))
+
+def ask_suggested_question(question):
+    """Button callback: queue a suggested follow-up as the next question."""
+    st.session_state['pending_query'] = question
+
+def show_suggested_questions():
+    """Show the latest follow-up suggestions as clickable buttons."""
+    questions = st.session_state.get('suggested_questions')
+    if not questions:
+        return
+    st.markdown("Follow-up questions:")
+    for i, question in enumerate(questions):
+        st.button(question, key=f"suggestion_{i}_{question}",
+                  on_click=ask_suggested_question, args=(question,))
+
+def handle_csv_or_excel_upload(uploaded_file, username):
     import sqlite3
     import pandas as pd
-    
-    # Create a temporary database file
-    temp_db = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
-    temp_db_path = temp_db.name
-    temp_db.close()
-
-    # Read CSV or Excel into a DataFrame
-    if uploaded_file.name.endswith(".csv"):
-        df = pd.read_csv(uploaded_file)
-    else:
-        df = pd.read_excel(uploaded_file)
 
-    # Write DataFrame to temporary SQLite DB
-    conn = sqlite3.connect(temp_db_path)
-    df.to_sql("uploaded_data", conn, if_exists="replace", index=False)
-    conn.close()
+    # Convert into a temporary database in the storage area, which then takes it over
+    temp_db_path = storage.new_temp_path()
 
-    return temp_db_path
+    try:
+        # Read CSV or Excel into a DataFrame
+        if uploaded_file.name.endswith(".csv"):
+            df = pd.read_csv(uploaded_file)
+        else:
+            df = pd.read_excel(uploaded_file)
+
+        # Write DataFrame to temporary SQLite DB
+        conn = sqlite3.connect(temp_db_path)
+        df.to_sql("uploaded_data", conn, if_exists="replace", index=False)
+        conn.close()
+
+        return storage.store_file(username, f"{os.path.splitext(uploaded_file.name)[0]}.db", temp_db_path)
+    finally:
+        if os.path.exists(temp_db_path):
+            os.remove(temp_db_path)
+
+def restore_session():
+    """
+    Log the browser back in from the session token in its URL, on whichever
+    worker serves it. The token is used up: the URL gets a new one.
+    """
+    if is_user_logged_in():
+        return
+    username, token = state_backend.rotate_session(st.query_params.get('session'))
+    if username:
+        login_user(username)
+        st.session_state['current_user'] = username
+        st.session_state['session_token'] = token
+        st.query_params['session'] = token
+        initialize_session_state()
+        st.session_state['suggested_questions'] = state_backend.get_context(username, 'suggested_questions', [])
 
 def main():
     st.title("NL2SQL Chatbot")
 
+    restore_session()
     if not is_user_logged_in():
         auth_tab, register_tab = st.tabs(["Login", "Register"])
         
@@ -358,6 +572,10 @@ def main():
                 if submit_button:
                     if authenticate_user(username, password):
                         st.session_state['current_user'] = username
+                        # The token in the URL lets any worker restore this login
+                        token = state_backend.create_session(username, ttl=state_backend.URL_SESSION_TTL)
+                        st.session_state['session_token'] = token
+                        st.query_params['session'] = token
                         initialize_session_state()
                         st.success("Logged in successfully!")
                         st.rerun()
@@ -378,61 +596,180 @@ def main():
         return
 
     if st.button("Logout"):
+        state_backend.end_session(st.session_state.pop('session_token', None))
+        st.query_params.pop('session', None)
         st.session_state['current_user'] = None
         logout_user()
         st.rerun()
 
+    if is_admin(st.session_state.get('username')):
+        page = st.sidebar.radio("Page", ["Chat", "Metrics"])
+        if page == "Metrics":
+            show_metrics_dashboard()
+            return
+
     st.sidebar.header("Database Management")
     uploaded_file = st.sidebar.file_uploader("Upload Database or CSV/Excel", type=["db", "csv", "xlsx"])
 
+    current_user = st.session_state.get('current_user')
+    # Idle uploads are cleaned up in the background, once per process
+    storage.start_janitor()
+    used = sum(f['size'] for f in storage.list_files(current_user))
+    st.sidebar.caption(f"Storage used: {used / 2**20:.1f} of {storage.STORAGE_USER_QUOTA / 2**20:.0f} MB")
     if uploaded_file:
-        if uploaded_file.name.endswith(".csv") or uploaded_file.name.endswith(".xlsx"):
-            db_path = handle_csv_or_excel_upload(uploaded_file)
-        else:
-            db_path = handle_database_upload(uploaded_file)
-        if db_path:
-            schema = get_database_schema(db_path)
-            st.sidebar.subheader("Database Schema")
-            st.sidebar.code(schema, language="sql")
-            st.session_state['db_path'] = db_path
-            st.session_state['schema'] = schema
+        # Only write the file when a new one is uploaded; reruns keep using it
+        # (and the indexes built on it)
+        if st.session_state.get('uploaded_file_id') == uploaded_file.file_id and st.session_state.get('db_path'):
+            db_path = st.session_state['db_path']
         else:
+            try:
+                if uploaded_file.name.endswith(".csv") or uploaded_file.name.endswith(".xlsx"):
+                    db_path = handle_csv_or_excel_upload(uploaded_file, current_user)
+                else:
+                    db_path = handle_database_upload(uploaded_file, current_user)
+            except storage.QuotaExceeded as e:
+                st.error(str(e))
+                return
+        st.session_state['uploaded_file_id'] = uploaded_file.file_id if db_path else None
+        if not db_path:
             st.error("Error processing the database file.")
             return
+        file_id = uploaded_file.file_id
     else:
-        st.info("Please upload a SQLite database to start.")
-        return
+        # The database uploaded earlier, possibly through another worker or
+        # before a restart
+        active = state_backend.get_active_database(current_user)
+        if not active:
+            st.info("Please upload a SQLite database to start.")
+            return
+        db_path, file_id = active['db_path'], active['file_id']
+
+    schema = pipeline.load_schema(db_path)
+    st.sidebar.subheader("Database Schema")
+    st.sidebar.code(schema, language="sql")
+    st.session_state['db_path'] = db_path
+    st.session_state['schema'] = schema
+    if uploaded_file and st.session_state.get('active_database') != (file_id, db_path):
+        state_backend.set_active_database(current_user, db_path, schema, file_id)
+        st.session_state['active_database'] = (file_id, db_path)
+    # Rollups and samples are only checked once per uploaded file and
+    # sample rate, not on every rerun
+    sample_rate = sampling.get_sample_rate(db_path)
+    if st.session_state.get('rollups_for') != (file_id, db_path, sample_rate):
+        with st.spinner("Preparing summary tables..."):
+            pipeline.prepare_database(db_path, schema, current_user)
+        st.session_state['rollups_for'] = (file_id, db_path, sample_rate)
+
+    st.sidebar.toggle("Approximate answers for huge tables", key='approximate_mode',
+                      help="Answer from a sample first; the exact answer replaces it when ready.")
+    if st.session_state.get('approximate_mode'):
+        new_rate = st.sidebar.number_input(
+            "Sample rate for this database", min_value=0.001, max_value=0.5,
+            value=sample_rate, step=0.005, format="%.3f"
+        )
+        if new_rate != sample_rate:
+            sampling.set_sample_rate(db_path, new_rate)
+            st.rerun()
 
     display_chat_history()
 
     user_query = st.chat_input("Ask me anything about your database")
+    if not user_query:
+        user_query = st.session_state.pop('pending_query', None)
     if user_query:
-        add_message_to_history("user", user_query)
-        with st.chat_message("user"):
-            st.markdown(user_query)
-
-        cached_response = get_cached_response(user_query, st.session_state['schema'])
-        if cached_response:
-            if handle_cached_response(cached_response):
-                return
+        answer_query(user_query)
+
+    show_suggested_questions()
+    if sampling.pending_exact(st.session_state.get('current_user')):
+        show_exact_progress()
+    with st.sidebar:
+        show_export()
+
+def wait_for_job(job):
+    """
+    Wait for a query pool job, showing its queue position meanwhile. The job
+    is cancelled if the script stops first, as it does when the user sends
+    another question or leaves the page.
+    """
+    status = st.empty()
+    try:
+        while not job.wait(timeout=0.5):
+            position = job.position()
+            if position:
+                status.caption(f"Queued — position {position}")
+            else:
+                status.caption("Running your query...")
+        status.empty()
+        return job.result()
+    finally:
+        if not job.done():
+            job.cancel()
+
+def wait_for_same_question(user_query):
+    """
+    Wait while the same question is being answered for someone else. Returns
+    (cached answer, None) once their answer is cached, or (None, token) when
+    this session should answer it itself.
+    """
+    status = st.empty()
+    while True:
+        outcome, value = pipeline.claim_question(user_query, st.session_state['schema'], timeout=0.5,
+                                                db_path=st.session_state.get('db_path'))
+        if outcome != 'waiting':
+            status.empty()
+            return (value, None) if outcome == 'cached' else (None, value)
+        status.caption("The same question is being answered for someone else — waiting for it...")
+
+def answer_query(user_query):
+    """Answer a question from the cache or by running the full pipeline."""
+    current_user = st.session_state.get('current_user')
+    st.session_state['suggested_questions'] = []
+    add_message_to_history("user", user_query)
+    with st.chat_message("user"):
+        st.markdown(user_query)
+
+    # Stop speculative work for other suggestions; if this question is one of
+    # them, let its prefetch finish so the answer comes from the cache
+    cancel_prefetch(current_user, keep=user_query)
+    wait_for_prefetch(current_user, user_query)
+
+    conversation = scratch.conversation_id(current_user, st.session_state['db_path'])
+    # Identical questions asked meanwhile wait for this answer to be cached
+    cached_response, token = wait_for_same_question(user_query)
+    if cached_response:
+        if handle_cached_response(cached_response):
+            remember_answer(user_query, cached_response, conversation)
+            # Keep the answer available to follow-ups as if it had just run
+            if isinstance(cached_response.get('results'), pa.Table):
+                scratch.materialize_result(st.session_state['db_path'], conversation, user_query,
+                                           cached_response.get('sql_query'), cached_response['results'])
+            return
 
-        with st.spinner("Processing your query..."):
-            try:
-                response = process_query(user_query, st.session_state['db_path'], st.session_state['schema'])
-                if response and 'sql_query' in response:
-                    handle_response(response)
-                    cache_response(user_query, st.session_state['schema'], response['sql_query'], 
-                                 response['summary'], response['visualization'], 
-                                 response['follow_up_questions'], response.get('results', []), 
-                                 response.get('columns', []))
-                else:
-                    add_message_to_history("assistant", "I'm sorry, I couldn't understand your query.")
-                    with st.chat_message("assistant"):
-                        st.markdown("I'm sorry, I couldn't understand your query.")
-            except Exception as e:
-                add_message_to_history("assistant", f"An error occurred: {e}")
+    with st.spinner("Processing your query..."):
+        try:
+            job = pipeline.submit_question(current_user, user_query, st.session_state['db_path'],
+                                           st.session_state['schema'], token, conversation=conversation,
+                                           approximate=st.session_state.get('approximate_mode', False))
+            response = wait_for_job(job)
+            if response and 'sql_query' in response:
+                remember_answer(user_query, response, conversation)
+            if response and response.get('approximate'):
+                # Not cached: the exact answer replaces this message and is
+                # cached when it arrives
+                message_id = handle_response(response)
+                job = pipeline.submit_exact(current_user, user_query, st.session_state['db_path'],
+                                            st.session_state['schema'], response, conversation)
+                sampling.track_exact(message_id, current_user, user_query, job)
+            elif response and 'sql_query' in response:
+                handle_response(response)
+            else:
+                add_message_to_history("assistant", "I'm sorry, I couldn't understand your query.")
                 with st.chat_message("assistant"):
-                    st.error(f"An error occurred: {e}")
+                    st.markdown("I'm sorry, I couldn't understand your query.")
+        except Exception as e:
+            add_message_to_history("assistant", f"An error occurred: {e}")
+            with st.chat_message("assistant"):
+                st.error(f"An error occurred: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+import sqlite3
+
+import pytest
+
+import cache
+import database_cache
+import metrics
+import nl2sql
+import pipeline
+import refresh
+import scratch
+import storage
+
+QUESTION = "Units per store"
+SUM_SQL = "SELECT Store, SUM(Units) AS units FROM sales GROUP BY Store ORDER BY Store"
+STORES_SQL = "SELECT DISTINCT Store FROM sales ORDER BY Store"
+
+@pytest.fixture(autouse=True)
+def fresh_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_cache, "CACHE_DB", str(tmp_path / "query_cache.db"))
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    monkeypatch.setattr(storage, "STORAGE_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(storage, "STORAGE_DB", str(tmp_path / "storage.db"))
+    monkeypatch.setattr(scratch, "SCRATCH_DIR", str(tmp_path / "scratch"))
+
+@pytest.fixture
+def summaries(monkeypatch):
+    """Summaries written, one per call, instead of asking a model."""
+    calls = []
+
+    def summarize(sql_query, results, columns):
+        calls.append(sql_query)
+        return f"Summary {len(calls)}"
+    monkeypatch.setattr(nl2sql, "summarize_results", summarize)
+    return calls
+
+def upload(username, rows):
+    path = storage.new_temp_path()
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sales (Store TEXT, Units INTEGER)")
+    conn.executemany("INSERT INTO sales VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return storage.store_file(username, "sales.db", path)
+
+def answer(db_path, question, sql_query):
+    """Cache an answer as the pipeline would, without generating SQL."""
+    schema = pipeline.load_schema(db_path)
+    results, columns = nl2sql.execute_sql(sql_query, db_path, columnar=True)
+    response = nl2sql.build_answer(question, schema, sql_query, results, columns, ["Next?"])
+    pipeline.cache_answer(question, schema, response, db_path)
+    return schema
+
+def lookup(question, schema, db_path):
+    return cache.get_cached_response(question, schema, storage.data_version(db_path))
+
+def hit_counts():
+    conn = sqlite3.connect(database_cache.CACHE_DB)
+    try:
+        return sorted(row[0] for row in conn.execute("SELECT hit_count FROM query_cache"))
+    finally:
+        conn.close()
+
+def test_answers_are_kept_per_data_version(summaries):
+    first = upload("alice", [("North", 1), ("South", 2)])
+    second = upload("bob", [("North", 10), ("South", 2)])
+    schema = answer(first, QUESTION, SUM_SQL)
+
+    assert lookup(QUESTION, schema, second) is None
+    # A miss does not count as a hit
+    assert hit_counts() == [0]
+    assert lookup(QUESTION, schema, first)['summary'] == "Summary 1"
+    assert hit_counts() == [1]
+
+    # Answering on the second database leaves the first one's answer alone
+    answer(second, QUESTION, SUM_SQL)
+    assert lookup(QUESTION, schema, first)['results'].column("units").to_pylist() == [1, 2]
+    assert lookup(QUESTION, schema, second)['results'].column("units").to_pylist() == [10, 2]
+
+def test_unchanged_results_keep_their_summary(summaries):
+    first = upload("alice", [("North", 1), ("South", 2)])
+    second = upload("bob", [("North", 1), ("South", 2), ("North", 3)])
+    schema = answer(first, QUESTION, STORES_SQL)
+
+    assert refresh.refresh_answers(second, schema) == {'unchanged': 1, 'changed': 0, 'skipped': 0, 'failed': 0}
+    assert summaries == [STORES_SQL]
+    assert lookup(QUESTION, schema, second)['summary'] == "Summary 1"
+
+def test_changed_results_get_a_new_summary(summaries):
+    first = upload("alice", [("North", 1), ("South", 2)])
+    second = upload("bob", [("North", 1), ("South", 2), ("North", 3)])
+    schema = answer(first, QUESTION, SUM_SQL)
+
+    assert refresh.refresh_answers(second, schema)['changed'] == 1
+    refreshed = lookup(QUESTION, schema, second)
+    assert refreshed['summary'] == "Summary 2"
+    assert refreshed['results'].column("units").to_pylist() == [4, 2]
+    assert refreshed['follow_up_questions'] == ["Next?"]
+    assert lookup(QUESTION, schema, first)['summary'] == "Summary 1"
+    # Nothing is left to refresh for the second database
+    assert refresh.refresh_answers(second, schema) == {'unchanged': 0, 'changed': 0, 'skipped': 0, 'failed': 0}
+
+def test_stale_question_is_replayed_without_generating_sql(summaries, monkeypatch):
+    first = upload("alice", [("North", 1), ("South", 2)])
+    second = upload("bob", [("North", 5), ("South", 2)])
+    schema = answer(first, QUESTION, SUM_SQL)
+
+    def no_pipeline(*args, **kwargs):
+        raise AssertionError("the full pipeline ran")
+    monkeypatch.setattr(pipeline, "process_query", no_pipeline)
+    events = []
+    response = pipeline._answer_and_cache(QUESTION, second, schema, None, False,
+                                          lambda event, data: events.append(event))
+    assert events == ['sql', 'results']
+    assert response['results'].column("units").to_pylist() == [5, 2]
+    assert lookup(QUESTION, schema, second)['summary'] == "Summary 2"
+
+def test_answers_reading_scratch_tables_are_not_replayed(summaries):
+    first = upload("alice", [("North", 1)])
+    second = upload("bob", [("North", 2)])
+    schema = pipeline.load_schema(first)
+    cache.cache_response(QUESTION, schema, "SELECT * FROM scratch.result_1", "s", {'data': []}, [], [], [],
+                         storage.data_version(first))
+    assert refresh.stale_answer(QUESTION, schema, second) is None
+    assert refresh.refresh_answers(second, schema) == {'unchanged': 0, 'changed': 0, 'skipped': 1, 'failed': 0}
+
+def test_exact_answer_behind_an_approximate_one_is_cached(summaries):
+    path = upload("alice", [("North", 1), ("South", 2)])
+    schema = pipeline.load_schema(path)
+    approximate = {'sql_query': SUM_SQL, 'follow_up_questions': ["Next?"], 'approximate': {'sample_rows': 1}}
+    assert pipeline.cache_answer(QUESTION, schema, approximate, path) is None
+    assert lookup(QUESTION, schema, path) is None
+
+    exact = pipeline.submit_exact("alice", QUESTION, path, schema, approximate).result(timeout=30)
+    assert 'approximate' not in exact
+    cached = lookup(QUESTION, schema, path)
+    assert cached['results'].column("units").to_pylist() == [1, 2]
+    assert cached['follow_up_questions'] == ["Next?"]
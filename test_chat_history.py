@@ -0,0 +1,60 @@
+import time
+import sqlite3
+import multiprocessing
+
+import pytest
+
+import chat_history
+
+@pytest.fixture(autouse=True)
+def chat_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat_history, "CHAT_DB", str(tmp_path / "chat_history.db"))
+
+def spec(title):
+    return {'title': title, 'datasets': {'data': b'arrow bytes'}}
+
+def test_chart_spec_round_trip():
+    message_id = chat_history.add_message("alice", "assistant", "Answer", {'data': []}, spec("first"))
+    assert chat_history.get_chart_spec(message_id) == spec("first")
+    assert chat_history.get_chart_spec("missing") is None
+
+def test_spec_changed_by_another_process_is_read_again():
+    message_id = chat_history.add_message("alice", "assistant", "Answer", {'data': []}, spec("first"))
+    assert chat_history.get_chart_spec(message_id)['title'] == "first"
+    # Another worker replaces the answer; nothing clears this process's memo
+    conn = sqlite3.connect(chat_history.CHAT_DB)
+    conn.execute("UPDATE message_payloads SET chart_spec = ?, updated_at = ? WHERE message_id = ?",
+                 (chat_history._encode_spec(spec("exact")), "2099-01-01T00:00:00", message_id))
+    conn.commit()
+    conn.close()
+    assert chat_history.get_chart_spec(message_id)['title'] == "exact"
+
+def test_spec_built_later_replaces_a_missing_one():
+    message_id = chat_history.add_message("alice", "assistant", "Answer", {'data': []})
+    assert chat_history.get_chart_spec(message_id) is None
+    chat_history.save_chart_spec(message_id, spec("built"))
+    assert chat_history.get_chart_spec(message_id)['title'] == "built"
+    chat_history.update_message(message_id, "Exact answer", {'data': []}, spec("exact"))
+    assert chat_history.get_chart_spec(message_id)['title'] == "exact"
+
+def init_at(path, start_at):
+    chat_history.CHAT_DB = path
+    time.sleep(max(0, start_at - time.time()))
+    chat_history.init_chat_db()
+
+def test_workers_starting_together_migrate_once():
+    # A database from before the sql_query and updated_at columns
+    conn = sqlite3.connect(chat_history.CHAT_DB)
+    conn.execute("CREATE TABLE messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, "
+                 "username TEXT NOT NULL, role TEXT NOT NULL, content TEXT, has_visualization INTEGER DEFAULT 0, "
+                 "created_at TIMESTAMP)")
+    conn.execute("CREATE TABLE message_payloads (message_id TEXT PRIMARY KEY, visualization TEXT, chart_spec TEXT)")
+    conn.commit()
+    conn.close()
+    start_at = time.time() + 2
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        pool.starmap(init_at, [(chat_history.CHAT_DB, start_at)] * 4)
+    conn = sqlite3.connect(chat_history.CHAT_DB)
+    assert 'sql_query' in [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+    assert 'updated_at' in [row[1] for row in conn.execute("PRAGMA table_info(message_payloads)")]
+    conn.close()
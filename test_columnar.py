@@ -0,0 +1,65 @@
+import sqlite3
+
+import pyarrow as pa
+import pytest
+
+from columnar import execute_to_arrow, _to_array
+
+@pytest.fixture
+def strains_db(tmp_path):
+    path = str(tmp_path / "strains.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE s (Strain TEXT, Rating INTEGER)")
+    conn.executemany("INSERT INTO s VALUES (?, ?)",
+                     [("Indica", 1), ("Indica", 2), ("Sativa", 4), ("Sativa", 5), ("Sativa", 5)])
+    conn.commit()
+    conn.close()
+    return path
+
+def test_aggregate_aliased_to_an_integer_column_keeps_its_fraction(strains_db):
+    sql = "SELECT Strain, AVG(Rating) AS Rating FROM s GROUP BY Strain ORDER BY Strain"
+    conn = sqlite3.connect(strains_db)
+    expected = conn.execute(sql).fetchall()
+    conn.close()
+    table = execute_to_arrow(sql, strains_db)
+    assert table.column("Rating").to_pylist() == [value for _, value in expected]
+    assert table.column("Rating").to_pylist() == pytest.approx([1.5, 4.6667], rel=1e-4)
+
+def test_declared_integer_column_stays_integer(strains_db):
+    table = execute_to_arrow("SELECT Rating FROM s", strains_db)
+    assert table.schema.field("Rating").type == pa.int64()
+
+def test_text_column_of_digits_stays_text(tmp_path):
+    path = str(tmp_path / "places.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE places (zip TEXT, code)")
+    conn.executemany("INSERT INTO places VALUES (?, ?)", [("02134", "7"), ("10001", "12")])
+    conn.commit()
+    conn.close()
+    table = execute_to_arrow("SELECT zip, code FROM places ORDER BY zip", path)
+    assert table.column("zip").to_pylist() == ["02134", "10001"]
+    # An untyped column of numbers is still read as numbers
+    assert table.column("code").to_pylist() == [7, 12]
+
+def test_floats_are_not_truncated_to_a_declared_integer_type():
+    assert _to_array([3.5, 1.0], pa.int64()).to_pylist() == [3.5, 1.0]
+    assert _to_array([3.0, None], pa.int64()).type == pa.int64()
+
+def test_answer_with_duplicate_column_names(tmp_path, monkeypatch):
+    import metrics
+    import nl2sql
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    monkeypatch.setattr(nl2sql, "summarize_results", lambda *args: "Summary")
+    path = str(tmp_path / "shop.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE a (id INTEGER, name TEXT)")
+    conn.execute("CREATE TABLE b (id INTEGER, a_id INTEGER)")
+    conn.executemany("INSERT INTO a VALUES (?, ?)", [(1, "x"), (2, "y")])
+    conn.executemany("INSERT INTO b VALUES (?, ?)", [(10, 1), (20, 2)])
+    conn.commit()
+    conn.close()
+    sql = "SELECT a.id, b.id, a.name FROM a JOIN b ON b.a_id = a.id ORDER BY a.id"
+    results, columns = nl2sql.execute_sql(sql, path, columnar=True)
+    answer = nl2sql.build_answer("Ids", "", sql, results, columns, [])
+    assert answer['visualization']['data'] == [{"name": "x", "id": 1}, {"name": "y", "id": 2}]
+    assert answer['results'].num_columns == 3
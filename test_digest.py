@@ -0,0 +1,48 @@
+import pyarrow as pa
+
+from digest import build_digest
+
+def lines(digest):
+    return digest.split("\n")
+
+def test_nulls_are_not_a_distinct_value():
+    table = pa.table({'Store': ["North", "North", "South", None]})
+    digest = build_digest(table)
+    assert "Store: 2 distinct values, 1 null" in lines(digest)
+    assert "top Store by share of rows: North 2 (67%); South 1 (33%)" in lines(digest)
+
+def test_null_categories_are_left_out_of_measure_shares():
+    table = pa.table({'Store': ["North", None, "South"], 'Units': [30, 50, 10]})
+    assert "top Store by share of Units: North 30 (75%); South 10 (25%)" in lines(build_digest(table))
+
+def test_bools_are_not_shown_as_numbers():
+    table = pa.table({'name': ["a", "b"], 'active': [True, False], 'units': [1, 0]})
+    rows = [line for line in lines(build_digest(table)) if line.startswith("example row")]
+    assert rows == ["example row: name=a, active=true, units=1", "example row: name=b, active=false, units=0"]
+
+def test_empty_result_is_reported_as_empty():
+    table = pa.table({'Store': pa.array([], pa.string()), 'Units': pa.array([], pa.int64())})
+    digest = build_digest(table)
+    assert lines(digest) == ["0 rows x 2 columns: Store, Units", "The query returned no rows."]
+    assert "null" not in digest
+
+def test_all_null_column_is_reported():
+    table = pa.table({'Store': ["North", "South"], 'Units': pa.array([None, None], pa.int64())})
+    assert "Units: all null" in lines(build_digest(table))
+
+def test_facts_past_the_budget_are_dropped_least_important_first():
+    table = pa.table({f"c{i}": list(range(100)) for i in range(6)} | {'Store': [f"S{i % 7}" for i in range(100)]})
+    full = lines(build_digest(table, max_tokens=10000))
+    assert any(line.startswith("example row") for line in full)
+    assert not full[-1].endswith("omitted for length)")
+
+    short = build_digest(table, max_tokens=150)
+    kept = lines(short)
+    assert len(short) <= 150 * 4 + len(kept[-1]) + 1
+    assert kept[0] == full[0]
+    assert kept[-1].endswith("further facts omitted for length)")
+    assert [line for line in full if line in kept] == kept[:-1]
+    # Every column's statistics are kept before any top categories; shorter
+    # facts of later tiers may still fill what is left
+    assert all(line in kept for line in full[1:8])
+    assert not any(line.startswith("top Store") for line in kept)
@@ -0,0 +1,44 @@
+import io
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import export
+import metrics
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    path = str(tmp_path / "ratings.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE r (Strain TEXT, Rating INTEGER)")
+    conn.executemany("INSERT INTO r VALUES (?, ?)", [("Indica", 1), ("Indica", 2), ("Sativa", 4)])
+    conn.commit()
+    conn.close()
+    return path
+
+def test_parquet_keeps_declared_integer_type(db):
+    out = io.BytesIO()
+    assert export.write_parquet("SELECT * FROM r", db, out) == 3
+    table = pq.read_table(io.BytesIO(out.getvalue()))
+    assert table.schema.field("Rating").type == pa.int64()
+    assert table.column("Rating").to_pylist() == [1, 2, 4]
+
+def test_floats_in_an_integer_column_are_refused_not_truncated(db):
+    conn = sqlite3.connect(db)
+    conn.execute("INSERT INTO r VALUES ('Hybrid', 3.5)")
+    conn.commit()
+    conn.close()
+    with pytest.raises(ValueError, match="changes type"):
+        export.write_parquet("SELECT * FROM r", db, io.BytesIO())
+    out = io.BytesIO()
+    assert export.write_csv("SELECT * FROM r", db, out) == 4
+    assert "Hybrid,3.5" in out.getvalue().decode()
+
+def test_batch_arrays_refuse_fractions_for_integer_types():
+    with pytest.raises(ValueError, match="changes type"):
+        export._batch_arrays(["Rating"], [(1,), (3.5,)], [pa.int64()])
+    types = [pa.int64()]
+    assert export._batch_arrays(["Rating"], [(1.0,), (3.0,)], types)[0].to_pylist() == [1, 3]
@@ -0,0 +1,92 @@
+import hashlib
+import sqlite3
+
+import pytest
+
+import derived
+import fts_index
+from fts_index import ensure_fts_indexes, rewrite_like
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(fts_index, "FTS_MIN_ROWS", 10)
+    path = str(tmp_path / "shop.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, customer_id INTEGER)")
+    conn.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT)")
+    names = [f"Item {i}" for i in range(100)] + ["Ärger Box", "ärger box", "Widget", None]
+    conn.executemany("INSERT INTO products (name, customer_id) VALUES (?, ?)",
+                     [(name, i % 50) for i, name in enumerate(names)])
+    conn.executemany("INSERT INTO customers (id, name) VALUES (?, ?)",
+                     [(i, f"Customer {i}") for i in range(49)] + [(49, "Widget Ltd")])
+    conn.commit()
+    conn.close()
+    ensure_fts_indexes(path)
+    conn = derived.connect(path)
+    yield path, conn
+    conn.close()
+
+def run(db, sql):
+    """The rewritten query, checked to return the same rows as the original."""
+    path, conn = db
+    rewritten = rewrite_like(sql, conn, path)
+    assert sorted(conn.execute(rewritten).fetchall()) == sorted(conn.execute(sql).fetchall())
+    return rewritten
+
+def fts_table(table):
+    return fts_index._fts_name(table, "name")
+
+def test_like_folds_ascii_case_only(db):
+    rewritten = run(db, "SELECT id FROM products WHERE name LIKE '%ärger%'")
+    assert fts_table("products") in rewritten
+    rewritten = run(db, "SELECT id FROM products WHERE name LIKE '%widget%'")
+    assert fts_table("products") in rewritten
+
+def test_alias_qualifier_resolves_to_its_table(db):
+    rewritten = run(db, "SELECT p.id FROM products AS p JOIN customers c ON c.id = p.customer_id "
+                        "WHERE c.name LIKE '%Widget%'")
+    assert fts_table("customers") in rewritten and fts_table("products") not in rewritten
+    rewritten = run(db, "SELECT p.id FROM products p JOIN customers c ON c.id = p.customer_id "
+                        "WHERE p.name LIKE '%Widget%'")
+    assert fts_table("products") in rewritten and fts_table("customers") not in rewritten
+
+def test_alias_named_like_another_table(db):
+    rewritten = run(db, "SELECT customers.id FROM products customers WHERE customers.name LIKE '%Widget%'")
+    assert fts_table("products") in rewritten and fts_table("customers") not in rewritten
+
+def test_qualifier_is_the_table_itself(db):
+    rewritten = run(db, "SELECT products.id FROM products, customers "
+                        "WHERE customers.id = products.customer_id AND products.name LIKE '%Widget%'")
+    assert fts_table("products") in rewritten
+
+def test_select_list_commas_are_not_joins(db):
+    rewritten = run(db, "SELECT id, name FROM products WHERE name LIKE '%Widget%' ORDER BY id")
+    assert fts_table("products") in rewritten
+
+def test_ambiguous_predicates_are_left_alone(db):
+    for sql in [
+        "SELECT p.id FROM products p JOIN customers c ON c.id = p.customer_id WHERE name LIKE '%Widget%'",
+        "SELECT products.id FROM products, customers WHERE name LIKE '%Widget%'",
+        "SELECT id FROM (SELECT id, name FROM products) WHERE name LIKE '%Widget%'",
+        "SELECT x.id FROM products p WHERE x.name LIKE '%Widget%'",
+    ]:
+        path, conn = db
+        assert rewrite_like(sql, conn, path) == sql
+
+def test_negated_predicates_keep_null_rows_out(db):
+    rewritten = run(db, "SELECT id FROM products WHERE NOT (name LIKE '%Widget%')")
+    assert fts_table("products") in rewritten
+    run(db, "SELECT id, name LIKE '%Widget%' FROM products")
+
+def test_uploaded_file_is_not_written(tmp_path):
+    path = str(tmp_path / "shared.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE products (name TEXT)")
+    conn.executemany("INSERT INTO products VALUES (?)", [(f"Item {i % 30}",) for i in range(fts_index.FTS_MIN_ROWS)])
+    conn.commit()
+    conn.close()
+    with open(path, "rb") as f:
+        before = hashlib.sha256(f.read()).hexdigest()
+    assert ensure_fts_indexes(path) == {'products': ['name']}
+    with open(path, "rb") as f:
+        assert hashlib.sha256(f.read()).hexdigest() == before
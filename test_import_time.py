@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from bench_import import (
+    BUDGETS_MS, budget_ms, measure_import, loaded_heavy_modules, files_created_by_import
+)
+
+# Wall-clock budgets depend on the machine and its load, so they are only
+# checked when asked for, e.g. on a quiet benchmark host
+@pytest.mark.skipif(os.getenv("IMPORT_TIME_BUDGETS") != "1", reason="set IMPORT_TIME_BUDGETS=1 to check import times")
+@pytest.mark.parametrize("module", sorted(BUDGETS_MS))
+def test_import_within_budget(module, tmp_path):
+    median, _ = measure_import(module, str(tmp_path), repeat=3)
+    assert median <= budget_ms(module), f"import {module} took {median:.1f} ms"
+
+@pytest.mark.parametrize("module", sorted(BUDGETS_MS))
+def test_import_skips_heavy_libraries(module, tmp_path):
+    assert loaded_heavy_modules(module, str(tmp_path)) == []
+
+@pytest.mark.parametrize("module", sorted(BUDGETS_MS))
+def test_import_has_no_side_effects(module, tmp_path):
+    assert files_created_by_import(module, str(tmp_path)) == []
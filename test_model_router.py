@@ -0,0 +1,121 @@
+import json
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import metrics
+import model_router
+import nl2sql
+import follow_up
+
+class FakeModels(BaseHTTPRequestHandler):
+    """An OpenAI-compatible chat completions endpoint answering from a table of canned replies per model."""
+    replies = {}
+    calls = []
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        model = request['model']
+        FakeModels.calls.append(model)
+        reply = FakeModels.replies.get(model)
+        if reply is None:
+            self.send_response(500)
+            body = {'error': {'message': f"{model} is down", 'type': 'server_error'}}
+        else:
+            self.send_response(200)
+            body = {
+                'id': 'chatcmpl-test', 'object': 'chat.completion', 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+            }
+        payload = json.dumps(body).encode()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def endpoint():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeModels)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/v1"
+    server.shutdown()
+
+@pytest.fixture(autouse=True)
+def fresh_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    monkeypatch.setattr(model_router, "_stats", {'loaded_at': 0, 'routes': {}})
+    FakeModels.replies, FakeModels.calls = {}, []
+
+def use_models(monkeypatch, stage, endpoint, *models):
+    monkeypatch.setenv(f"MODEL_POLICY_{stage.upper()}", ",".join(f"{m}@{endpoint}" for m in models))
+
+@pytest.fixture
+def sales_db(tmp_path):
+    path = str(tmp_path / "sales.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sales (Product TEXT, Units_Sold INTEGER)")
+    conn.commit()
+    conn.close()
+    return path
+
+def test_simple_stage_uses_the_fast_model(monkeypatch, endpoint):
+    use_models(monkeypatch, 'follow_up', endpoint, 'fast', 'strong')
+    FakeModels.replies = {'fast': "Which product sells most?\nWhere?", 'strong': "unused"}
+    assert follow_up.generate_follow_up_questions("Top products", "Table: sales") == [
+        "Which product sells most?", "Where?"]
+    assert FakeModels.calls == ['fast']
+
+def test_invalid_sql_escalates(monkeypatch, endpoint, sales_db):
+    use_models(monkeypatch, 'generate', endpoint, 'fast', 'strong')
+    FakeModels.replies = {
+        'fast': "SELECT Prodct FROM sales",
+        'strong': "SELECT Product, SUM(Units_Sold) FROM sales GROUP BY Product"
+    }
+    sql = nl2sql.generate_sql("Units per product", "Table: sales", db_path=sales_db)
+    assert sql == FakeModels.replies['strong']
+    assert FakeModels.calls == ['fast', 'strong']
+
+def test_failing_endpoint_escalates(monkeypatch, endpoint):
+    use_models(monkeypatch, 'summarize', endpoint, 'down', 'strong')
+    FakeModels.replies = {'strong': "Product 1 sells most."}
+    assert model_router.complete('summarize', [{"role": "user", "content": "Summarize"}]) == "Product 1 sells most."
+    assert FakeModels.calls == ['down', 'strong']
+
+def test_no_usable_answer_raises(monkeypatch, endpoint, sales_db):
+    use_models(monkeypatch, 'generate', endpoint, 'fast')
+    FakeModels.replies = {'fast': "DROP TABLE sales"}
+    with pytest.raises(model_router.Rejected):
+        model_router.complete('generate', [], check=lambda sql: nl2sql.sql_error(sql, sales_db))
+    assert nl2sql.generate_sql("Drop it", "Table: sales", db_path=sales_db) is None
+
+def test_route_statistics(monkeypatch, endpoint, sales_db):
+    use_models(monkeypatch, 'generate', endpoint, 'fast', 'strong')
+    FakeModels.replies = {'fast': "SELECT nope FROM sales", 'strong': "SELECT Product FROM sales"}
+    for _ in range(3):
+        nl2sql.generate_sql("Products", "Table: sales", db_path=sales_db)
+    stats = {(r['stage'], r['model']): r for r in metrics.get_route_stats()}
+    fast, strong = stats[('generate', f"fast@{endpoint}")], stats[('generate', f"strong@{endpoint}")]
+    assert (fast['count'], fast['failures'], strong['count'], strong['failures']) == (3, 3, 3, 0)
+    assert fast['mean_tokens'] == 15 and fast['p50_ms'] > 0
+
+def test_policy_skips_a_model_that_keeps_failing(monkeypatch, endpoint, sales_db):
+    monkeypatch.setattr(model_router, "ROUTER_MIN_CALLS", 4)
+    use_models(monkeypatch, 'generate', endpoint, 'fast', 'strong')
+    FakeModels.replies = {'fast': "SELECT nope FROM sales", 'strong': "SELECT Product FROM sales"}
+    for _ in range(4):
+        nl2sql.generate_sql("Products", "Table: sales", db_path=sales_db)
+    assert model_router.ladder('generate') == [f"fast@{endpoint}", f"strong@{endpoint}"]
+
+    # Statistics are re-read once they are stale
+    monkeypatch.setattr(model_router, "_stats", {'loaded_at': 0, 'routes': {}})
+    assert model_router.ladder('generate') == [f"strong@{endpoint}"]
+    FakeModels.calls = []
+    nl2sql.generate_sql("Products", "Table: sales", db_path=sales_db)
+    assert FakeModels.calls == ['strong']
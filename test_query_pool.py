@@ -0,0 +1,72 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import metrics
+import nl2sql
+import query_pool
+
+# Runs for minutes unless interrupted
+ENDLESS_SQL = ("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000000000) "
+               "SELECT SUM(i) FROM n")
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    path = str(tmp_path / "empty.db")
+    sqlite3.connect(path).close()
+    return path
+
+def test_cancel_interrupts_a_running_query(db):
+    job = query_pool.submit("alice", nl2sql.answer_exactly, "Sum", db, "", ENDLESS_SQL)
+    while job.state != query_pool.RUNNING:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    started = time.perf_counter()
+    job.cancel()
+    assert job.wait(timeout=10)
+    assert time.perf_counter() - started < 5
+    assert job.state == query_pool.CANCELLED
+
+def test_cancelled_job_stops_between_stages(db, monkeypatch):
+    generating = threading.Event()
+    release = threading.Event()
+    executed = []
+
+    def generate_sql(*args, **kwargs):
+        generating.set()
+        release.wait(10)
+        return "SELECT 1"
+    monkeypatch.setattr(nl2sql, "classify_query", lambda question, schema: (True, "QUERY"))
+    monkeypatch.setattr(nl2sql, "refine_query", lambda question, schema: question)
+    monkeypatch.setattr(nl2sql, "generate_sql", generate_sql)
+    monkeypatch.setattr(nl2sql, "execute_sql", lambda *args, **kwargs: executed.append(args) or (None, None))
+
+    job = query_pool.submit("bob", nl2sql.process_query, "How many?", db, "")
+    assert generating.wait(10)
+    job.cancel()
+    release.set()
+    assert job.wait(timeout=10)
+    assert job.state == query_pool.CANCELLED
+    assert executed == []
+
+def test_checks_are_no_ops_outside_the_pool(db):
+    assert query_pool.cancel_event() is None
+    query_pool.check_cancelled()
+    assert nl2sql.execute_sql("SELECT 1 AS one", db)[0] == [(1,)]
+
+def test_prefetches_do_not_hold_up_the_users_question(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    release = threading.Event()
+    prefetches = [query_pool.submit("carol", release.wait, 10, priority=query_pool.BACKGROUND) for _ in range(2)]
+    try:
+        while any(job.state != query_pool.RUNNING for job in prefetches):
+            time.sleep(0.01)
+        question = query_pool.submit("carol", lambda: "answer")
+        assert question.result(timeout=5) == "answer"
+    finally:
+        release.set()
+    for job in prefetches:
+        assert job.wait(timeout=10)
@@ -0,0 +1,101 @@
+import math
+import random
+import sqlite3
+
+import pytest
+
+import database_cache
+import derived
+import rollups
+from rollups import ensure_rollups, rewrite_query
+
+ROWS = 5000
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("rollups") / "sales.db")
+    rnd = random.Random(0)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sales (id INTEGER PRIMARY KEY, Region TEXT, Product TEXT, "
+                 "Sale_Year INTEGER, Units INTEGER, Price REAL)")
+    conn.executemany(
+        "INSERT INTO sales (Region, Product, Sale_Year, Units, Price) VALUES (?, ?, ?, ?, ?)",
+        [(rnd.choice(["North", "South", "East", "West"]), f"Product {rnd.randint(1, 40)}",
+          rnd.randint(2020, 2024), rnd.choice([None, rnd.randint(1, 50)]) if i % 7 == 0 else rnd.randint(1, 50),
+          round(rnd.uniform(1, 100), 2)) for i in range(ROWS)]
+    )
+    conn.commit()
+    conn.close()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(database_cache, "CACHE_DB", str(tmp_path_factory.mktemp("cache") / "query_cache.db"))
+        mp.setattr(rollups, "ROLLUP_MIN_ROWS", 1000)
+        assert ensure_rollups(path)['sales'] == 'built'
+    return path
+
+@pytest.fixture
+def conn(db):
+    conn = derived.connect(db)
+    yield conn
+    conn.close()
+
+def same_rows(a, b):
+    if len(a) != len(b):
+        return False
+    for row_a, row_b in zip(sorted(a, key=repr), sorted(b, key=repr)):
+        for x, y in zip(row_a, row_b):
+            if isinstance(x, float) or isinstance(y, float):
+                if x is None or y is None or not math.isclose(x, y, rel_tol=1e-9):
+                    return False
+            elif x != y:
+                return False
+    return True
+
+@pytest.mark.parametrize("sql", [
+    "SELECT Region, SUM(Units) FROM sales GROUP BY Region",
+    "SELECT Region, COUNT(*), COUNT(Units) FROM sales GROUP BY Region",
+    "SELECT Region, AVG(Units), AVG(Price) FROM sales GROUP BY Region",
+    "SELECT Product, MIN(Price), MAX(Units) FROM sales GROUP BY Product",
+    "SELECT Region, Sale_Year, SUM(Units) AS units, AVG(Price) FROM sales GROUP BY Region, Sale_Year",
+    "SELECT Sale_Year, COUNT(*) FROM sales WHERE Region = 'North' GROUP BY Sale_Year",
+    "SELECT Product, SUM(Units) FROM sales WHERE Region IN ('East', 'West') GROUP BY Product "
+    "ORDER BY SUM(Units) DESC, Product LIMIT 5",
+    "SELECT SUM(Units), COUNT(*), MIN(Price), MAX(Price) FROM sales",
+    "SELECT MIN(Sale_Year), MAX(Sale_Year) FROM sales WHERE Region = 'South'",
+    "SELECT SUM(Units), COUNT(*), AVG(Price) FROM sales WHERE Region = 'Nowhere'",
+])
+def test_rewritten_queries_return_the_same_rows(conn, sql):
+    rewritten = rewrite_query(sql, conn)
+    assert rewritten != sql
+    assert "derived." in rewritten
+    assert same_rows(conn.execute(rewritten).fetchall(), conn.execute(sql).fetchall())
+
+@pytest.mark.parametrize("sql", [
+    "SELECT Region, SUM(Units) FROM sales WHERE Units > 10 GROUP BY Region",
+    "SELECT Region, SUM(Units * Price) FROM sales GROUP BY Region",
+    "SELECT Region, COUNT(DISTINCT Product) FROM sales GROUP BY Region",
+    "SELECT Region, GROUP_CONCAT(Product) FROM sales GROUP BY Region",
+    "SELECT DISTINCT Region FROM sales",
+    "SELECT s.Region, SUM(s.Units) FROM sales s JOIN sales t ON t.id = s.id GROUP BY s.Region",
+    "SELECT Region, Units FROM sales",
+    "SELECT Region, SUM(Units) FROM sales GROUP BY Region HAVING MAX(id) > 10",
+    "SELECT Region, SUM(Units) FROM sales WHERE rowid < 100 GROUP BY Region",
+    "SELECT Region, COUNT(*) FROM sales WHERE _rowid_ % 2 = 0 GROUP BY Region",
+])
+def test_queries_a_rollup_cannot_answer_are_left_alone(conn, sql):
+    assert rewrite_query(sql, conn) == sql
+
+def test_stale_rollups_are_not_used(db, tmp_path):
+    import shutil
+    copy = str(tmp_path / "sales.db")
+    shutil.copy(db, copy)
+    shutil.copy(derived.derived_path(db), derived.derived_path(copy))
+    conn = derived.connect(copy)
+    try:
+        sql = "SELECT Region, SUM(Units) FROM sales GROUP BY Region"
+        assert rewrite_query(sql, conn) != sql
+        conn.execute("INSERT INTO sales (Region, Product, Sale_Year, Units, Price) "
+                     "VALUES ('North', 'Product 1', 2024, 5, 1.0)")
+        conn.commit()
+        assert rewrite_query(sql, conn) == sql
+    finally:
+        conn.close()
@@ -0,0 +1,65 @@
+import random
+import sqlite3
+
+import pytest
+
+import sampling
+
+# Rows per region; the last one is small enough to be sampled in full
+REGIONS = {"North": 30000, "South": 15000, "East": 4940, "Isle": 60}
+ISLE_UNITS = 24500
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("sampling") / "sales.db")
+    rnd = random.Random(0)
+    rows = [(region, f"Product {rnd.randint(1, 8)}", ISLE_UNITS if region == "Isle" else rnd.randint(1, 100))
+            for region, count in REGIONS.items() for _ in range(count)]
+    rnd.shuffle(rows)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sales (Region TEXT, Product TEXT, Units INTEGER)")
+    conn.executemany("INSERT INTO sales VALUES (?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(sampling, "APPROX_MIN_ROWS", 1000)
+        mp.setattr(sampling, "DEFAULT_SAMPLE_RATE", 0.02)
+        assert sampling.ensure_samples(path) == {'sales': 'built'}
+    return path
+
+def estimates(sql, db):
+    """Rows of (exact values, estimates, interval half-widths) for each aggregate of each group."""
+    table, info = sampling.approximate_query(sql, db)
+    conn = sqlite3.connect(db)
+    exact = {row[0]: row[1:] for row in conn.execute(sql)}
+    conn.close()
+    rows = table.to_pylist()
+    aggregates = table.column_names[1:]
+    return [(exact[row[table.column_names[0]]][j], row[name], info['intervals'][name][i])
+            for i, row in enumerate(rows) for j, name in enumerate(aggregates)]
+
+def test_counts_of_whole_strata_are_exact(db):
+    for exact, estimate, width in estimates("SELECT Region, COUNT(*) FROM sales GROUP BY Region", db):
+        assert estimate == exact
+        assert width == pytest.approx(0, abs=1e-6)
+
+def test_strata_sampled_in_full_have_no_uncertainty(db):
+    table, info = sampling.approximate_query(
+        "SELECT Region, SUM(Units) AS units FROM sales GROUP BY Region ORDER BY Region", db)
+    isle = table.column("Region").to_pylist().index("Isle")
+    assert table.column("units")[isle].as_py() == pytest.approx(REGIONS["Isle"] * ISLE_UNITS)
+    assert info['intervals']['units'][isle] == pytest.approx(0, abs=1e-6)
+    assert all(width > 0 for i, width in enumerate(info['intervals']['units']) if i != isle)
+
+def test_intervals_cover_the_exact_answers(db):
+    results = estimates("SELECT Product, SUM(Units), COUNT(*), AVG(Units) FROM sales GROUP BY Product", db)
+    results += estimates("SELECT Product, SUM(Units), COUNT(*) FROM sales WHERE Region = 'North' GROUP BY Product",
+                         db)
+    covered = sum(abs(estimate - exact) <= width for exact, estimate, width in results)
+    assert covered >= 0.8 * len(results)
+    # Intervals are not so wide as to say nothing
+    assert all(width < 0.5 * abs(exact) for exact, _, width in results)
+
+def test_queries_on_rowids_are_not_approximated(db):
+    assert sampling.approximate_query("SELECT Region, SUM(Units) FROM sales WHERE rowid < 100 GROUP BY Region",
+                                      db) is None
@@ -0,0 +1,104 @@
+import os
+import time
+import threading
+import multiprocessing
+
+import pytest
+
+import database_cache
+import singleflight
+
+WORKERS = 4
+# Time the one answering a question takes, long enough for the others to arrive
+ANSWER_SECONDS = 0.5
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    # Worker processes inherit the environment, so they all share this directory
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(database_cache, "CACHE_DB", str(tmp_path / "query_cache.db"))
+    return tmp_path
+
+def answer_once(cache_key, data_dir, start_at=None):
+    """
+    Answer a question the way the pipeline does: the one holding the lock
+    computes and caches the answer, everyone else waits for it. Returns
+    how this caller got the answer.
+    """
+    answer = os.path.join(data_dir, f"{cache_key}.answer")
+    if start_at:
+        time.sleep(max(0, start_at - time.time()))
+    while True:
+        if os.path.exists(answer):
+            return 'cached'
+        token = singleflight.acquire(cache_key)
+        if token:
+            try:
+                if os.path.exists(answer):
+                    return 'cached'
+                with open(os.path.join(data_dir, f"{cache_key}.computed"), "a") as f:
+                    f.write(f"{os.getpid()}\n")
+                time.sleep(ANSWER_SECONDS)
+                open(answer, "w").close()
+                return 'computed'
+            finally:
+                singleflight.release(cache_key, token)
+        singleflight.wait(cache_key, 10)
+
+def computations(data_dir, cache_key):
+    with open(os.path.join(data_dir, f"{cache_key}.computed")) as f:
+        return f.read().split()
+
+def hold_lock(cache_key, locked, exit_now):
+    token = singleflight.acquire(cache_key)
+    locked.set()
+    exit_now.wait(30)
+    # Exits without releasing, like a crashed worker
+    return token
+
+def test_identical_questions_in_one_process_are_answered_once(data_dir):
+    outcomes = []
+    threads = [threading.Thread(target=lambda: outcomes.append(answer_once("threads", str(data_dir))))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(outcomes) == ['cached'] * 7 + ['computed']
+    assert len(computations(data_dir, "threads")) == 1
+
+def test_identical_questions_across_processes_are_answered_once(data_dir):
+    start_at = time.time() + 2
+    with multiprocessing.get_context("spawn").Pool(WORKERS) as pool:
+        outcomes = pool.starmap(answer_once, [("processes", str(data_dir), start_at)] * WORKERS)
+    assert sorted(outcomes) == ['cached'] * (WORKERS - 1) + ['computed']
+    assert len(computations(data_dir, "processes")) == 1
+
+def test_expired_lock_is_taken_over():
+    assert database_cache.try_lock_query("expiring", "first", ttl=0.05)
+    assert not database_cache.try_lock_query("expiring", "second", ttl=10)
+    time.sleep(0.1)
+    assert not database_cache.is_query_locked("expiring")
+    assert database_cache.try_lock_query("expiring", "second", ttl=10)
+    # The first owner can no longer release the lock it lost
+    database_cache.unlock_query("expiring", "first")
+    assert database_cache.is_query_locked("expiring")
+    database_cache.unlock_query("expiring", "second")
+    assert not database_cache.is_query_locked("expiring")
+
+def test_lock_of_an_exited_process_is_taken_over():
+    context = multiprocessing.get_context("spawn")
+    locked, exit_now = context.Event(), context.Event()
+    holder = context.Process(target=hold_lock, args=("crashed", locked, exit_now))
+    holder.start()
+    try:
+        assert locked.wait(30)
+        assert singleflight.acquire("crashed") is None
+        assert not singleflight.wait("crashed", 0.3)
+    finally:
+        exit_now.set()
+        holder.join(30)
+    assert not database_cache.is_query_locked("crashed")
+    token = singleflight.acquire("crashed")
+    assert token is not None
+    singleflight.release("crashed", token)
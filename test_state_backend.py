@@ -0,0 +1,114 @@
+import os
+import time
+import multiprocessing
+
+import pytest
+
+import state_backend
+
+WORKERS = 4
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    # Worker processes inherit the environment, so they all share this directory
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(state_backend, "_backend", None)
+    return tmp_path
+
+def run_in_workers(fn, args_list):
+    """Run fn over args_list in separate worker processes, like app workers on one host."""
+    with multiprocessing.get_context("spawn").Pool(WORKERS) as pool:
+        return pool.starmap(fn, args_list)
+
+def resolve_session(token):
+    return state_backend.get_session_user(token)
+
+def write_context(worker, count):
+    for i in range(count):
+        state_backend.set_context(f"user{worker}", f"item{i}", {'worker': worker, 'i': i})
+    return os.getpid()
+
+def upload_database(username, db_path):
+    with open(db_path, "wb") as f:
+        f.write(b"SQLite format 3\x00")
+    state_backend.set_active_database(username, db_path, "Table: sales\n", file_id="f1")
+    state_backend.set_context(username, "suggested_questions", ["Top products?"])
+    return os.getpid()
+
+def read_state(username):
+    return state_backend.get_active_database(username), state_backend.get_context(username, "suggested_questions")
+
+def test_session_from_one_worker_is_seen_by_all():
+    token = state_backend.create_session("alice")
+    assert run_in_workers(resolve_session, [(token,)] * WORKERS) == ["alice"] * WORKERS
+    state_backend.end_session(token)
+    assert run_in_workers(resolve_session, [(token,)]) == [None]
+
+def test_concurrent_writes_from_workers():
+    pids = run_in_workers(write_context, [(worker, 50) for worker in range(WORKERS)])
+    assert len(set(pids)) > 1
+    for worker in range(WORKERS):
+        for i in range(50):
+            assert state_backend.get_context(f"user{worker}", f"item{i}") == {'worker': worker, 'i': i}
+
+def test_upload_state_survives_the_worker(data_dir):
+    db_path = str(data_dir / "sales.db")
+    writer_pid = run_in_workers(upload_database, [("bob", db_path)])[0]
+    active, suggestions = run_in_workers(read_state, [("bob",)])[0]
+    assert writer_pid != os.getpid()
+    assert active == {'db_path': db_path, 'schema': "Table: sales\n", 'file_id': "f1"}
+    assert suggestions == ["Top products?"]
+    os.remove(db_path)
+    assert state_backend.get_active_database("bob") is None
+
+def test_entries_expire():
+    backend = state_backend.get_backend()
+    backend.set("sessions", "short", {'username': "carol"}, ttl=0.05)
+    assert state_backend.get_session_user("short") == "carol"
+    time.sleep(0.1)
+    assert state_backend.get_session_user("short") is None
+
+class MemoryBackend(state_backend.StateBackend):
+    """A single-process backend, to check that backends are pluggable."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, namespace, key):
+        return self.values.get((namespace, key))
+
+    def set(self, namespace, key, value, ttl=None):
+        self.values[(namespace, key)] = value
+
+    def delete(self, namespace, key):
+        self.values.pop((namespace, key), None)
+
+def test_backend_is_pluggable(monkeypatch, data_dir):
+    monkeypatch.setattr(state_backend, "STATE_BACKEND", "test_state_backend:MemoryBackend")
+    backend = state_backend.get_backend()
+    assert isinstance(backend, MemoryBackend)
+    token = state_backend.create_session("dave")
+    assert state_backend.get_session_user(token) == "dave"
+    assert not (data_dir / state_backend.STATE_DB).exists()
+
+def test_restoring_a_session_rotates_its_token():
+    token = state_backend.create_session("erin", ttl=state_backend.URL_SESSION_TTL)
+    username, rotated = state_backend.rotate_session(token)
+    assert username == "erin" and rotated != token
+    assert state_backend.get_session_user(token) is None
+    assert run_in_workers(resolve_session, [(rotated,)]) == ["erin"]
+    assert state_backend.rotate_session(token) == (None, None)
+    assert state_backend.rotate_session(None) == (None, None)
+
+def test_url_tokens_are_short_lived():
+    token = state_backend.create_session("frank", ttl=0.05)
+    time.sleep(0.1)
+    assert state_backend.rotate_session(token) == (None, None)
+
+def test_backends_must_implement_the_interface():
+    class Incomplete(state_backend.StateBackend):
+        def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+import cache
+import database_cache
+import metrics
+import scratch
+import storage
+from database import get_database_schema
+
+@pytest.fixture(autouse=True)
+def fresh_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(storage, "STORAGE_DB", str(tmp_path / "storage.db"))
+    monkeypatch.setattr(storage, "STORAGE_MIN_IDLE_SECONDS", 600)
+    monkeypatch.setattr(database_cache, "CACHE_DB", str(tmp_path / "query_cache.db"))
+    monkeypatch.setattr(metrics, "METRICS_DB", str(tmp_path / "metrics.db"))
+    monkeypatch.setattr(scratch, "SCRATCH_DIR", str(tmp_path / "scratch"))
+
+def make_db(rows, table="sales"):
+    """A database written where store_file expects uploads. Returns its temp path and size."""
+    path = storage.new_temp_path()
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE {table} (Store TEXT, Units INTEGER)")
+    conn.executemany(f"INSERT INTO {table} VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return path, os.path.getsize(path)
+
+def upload(username, name, rows):
+    path, _ = make_db(rows)
+    return storage.store_file(username, name, path)
+
+def set_last_used(username, name, seconds_ago):
+    conn = sqlite3.connect(storage.STORAGE_DB)
+    conn.execute("UPDATE files SET last_used = ? WHERE username = ? AND name = ?",
+                 (time.time() - seconds_ago, username, name))
+    conn.commit()
+    conn.close()
+
+def names(username):
+    return sorted(f['name'] for f in storage.list_files(username))
+
+def cache_answer(db_path, question="Units per store"):
+    schema = get_database_schema(db_path)
+    cache.cache_response(question, schema, "SELECT Store, SUM(Units) FROM sales GROUP BY Store", "Summary",
+                         {'data': []}, [], [], [], storage.data_version(db_path))
+    return schema
+
+def cached_rows():
+    conn = sqlite3.connect(database_cache.CACHE_DB)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_upload_over_quota_is_refused(monkeypatch):
+    path, size = make_db([("North", 1)])
+    monkeypatch.setattr(storage, "STORAGE_USER_QUOTA", int(size * 1.5))
+    storage.store_file("alice", "first.db", path)
+
+    second, _ = make_db([("South", 2)])
+    with pytest.raises(storage.QuotaExceeded):
+        storage.store_file("alice", "second.db", second)
+    assert names("alice") == ["first.db"]
+    # The refused upload leaves nothing behind
+    assert not os.path.exists(second)
+    assert len(os.listdir(os.path.join(storage.STORAGE_DIR, "blobs"))) == 1
+
+def test_eviction_skips_databases_in_use(monkeypatch):
+    _, size = make_db([("North", 1)])
+    monkeypatch.setattr(storage, "STORAGE_USER_QUOTA", int(size * 2.5))
+    upload("alice", "old.db", [("North", 1)])
+    upload("alice", "recent.db", [("South", 2)])
+    set_last_used("alice", "old.db", 3600)
+    set_last_used("alice", "recent.db", 60)
+
+    upload("alice", "new.db", [("East", 3)])
+    assert names("alice") == ["new.db", "recent.db"]
+
+    # Nothing idle is left to evict
+    path, _ = make_db([("West", 4)])
+    with pytest.raises(storage.QuotaExceeded):
+        storage.store_file("alice", "newest.db", path)
+
+def test_nothing_is_evicted_when_eviction_cannot_make_room(monkeypatch):
+    _, small = make_db([("North", 1)])
+    big, size = make_db([(f"Store {i}", i) for i in range(2000)])
+    # Evicting the idle database would free less than the upload needs
+    monkeypatch.setattr(storage, "STORAGE_USER_QUOTA", size + small // 2)
+    old = upload("alice", "old.db", [("North", 1)])
+    upload("alice", "recent.db", [("South", 2)])
+    set_last_used("alice", "old.db", 3600)
+    set_last_used("alice", "recent.db", 60)
+    schema = cache_answer(old)
+
+    with pytest.raises(storage.QuotaExceeded):
+        storage.store_file("alice", "big.db", big)
+    assert names("alice") == ["old.db", "recent.db"]
+    assert storage.resolve("alice", "old.db") == old
+    assert cache.get_cached_response("Units per store", schema, storage.data_version(old))['summary'] == "Summary"
+
+def test_shared_blob_stays_while_referenced():
+    alice = upload("alice", "sales.db", [("North", 1)])
+    bob = upload("bob", "copy.db", [("North", 1)])
+    assert alice == bob
+    cache_answer(alice)
+
+    storage.remove_file("alice", "sales.db")
+    assert os.path.exists(bob)
+    assert storage.resolve("bob", "copy.db") == bob
+    assert cached_rows() == 1
+
+    storage.remove_file("bob", "copy.db")
+    assert not os.path.exists(bob)
+    assert storage.resolve("bob", "copy.db") is None
+    assert cached_rows() == 0
+
+def test_cached_answers_go_with_their_data():
+    first = upload("alice", "first.db", [("North", 1)])
+    second = upload("bob", "second.db", [("North", 2)])
+    schema = cache_answer(first)
+    cache_answer(second)
+    other_schema = cache_answer(upload("carol", "other.db", [("North", 1), ("South", 2)]), "Other question")
+    assert schema == other_schema and cached_rows() == 3
+
+    # Answers on the removed data go; the schema's other answers stay for the
+    # database that still has it
+    storage.remove_file("alice", "first.db")
+    assert cache.get_cached_response("Units per store", schema, storage.data_version(first)) is None
+    assert cache.get_cached_response("Units per store", schema, storage.data_version(second))['summary'] == "Summary"
+    assert cached_rows() == 2
+
+    storage.remove_file("bob", "second.db")
+    storage.remove_file("carol", "other.db")
+    assert cached_rows() == 0
+
+def test_cached_answers_of_a_schema_nobody_has_are_removed():
+    path = upload("alice", "sales.db", [("North", 1)])
+    schema = get_database_schema(path)
+    # An answer from before answers were kept per data version
+    cache.cache_response("Legacy", schema, "SELECT 1", "Summary", {'data': []}, [], [], [])
+    cache_answer(path)
+    storage.remove_file("alice", "sales.db")
+    assert cached_rows() == 0
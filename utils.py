@@ -1,8 +1,44 @@
 import os
+import sqlite3
+import threading
 from dotenv import load_dotenv
 
 def load_env():
     load_dotenv()
 
+_initialized = set()
+_init_lock = threading.Lock()
+
+def connect_initialized(path, init, **kwargs):
+    """
+    sqlite3 connection to `path`, calling init() first the first time this
+    process opens it. Modules create their tables here rather than at import.
+    """
+    key = (os.path.abspath(path), init)
+    if key not in _initialized:
+        with _init_lock:
+            if key not in _initialized:
+                init()
+                _initialized.add(key)
+    return sqlite3.connect(path, **kwargs)
+
+_openai = None
+
+def get_openai():
+    """
+    The openai module with the API key set. It is imported on first use,
+    since importing it takes a noticeable part of a second.
+    """
+    global _openai
+    if _openai is None:
+        import openai
+        load_env()
+        api_key = os.getenv("OPENAI_API_KEY") or ""
+        print(f"API Key loaded starts with: {api_key[:10]}...")
+        openai.api_key = api_key
+        _openai = openai
+    return _openai
+
 def get_db_path(filename):
-    return os.path.join(os.getcwd(), filename)
+    # Workers sharing DATA_DIR see the same uploads and databases whatever their cwd
+    return os.path.join(os.getenv("DATA_DIR") or os.getcwd(), filename)
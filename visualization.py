@@ -1,6 +1,5 @@
 import altair as alt
 import pandas as pd
-import streamlit as st
 import re
 
 def generate_visualization(sql_query, results, columns, chart_type, x_col, y_col):
@@ -43,7 +42,7 @@ def generate_visualization(sql_query, results, columns, chart_type, x_col, y_col
                 ).properties(title=f"Scatter Plot of {y_col} vs {x_col}")
                 return chart
             else:
-                st.error("Scatter plots require both X and Y axes.")
+                print("Scatter plots require both X and Y axes.")
                 return None
         elif chart_type == "histogram":
             chart = alt.Chart(df).mark_bar().encode(
@@ -54,5 +53,5 @@ def generate_visualization(sql_query, results, columns, chart_type, x_col, y_col
         else:
             return None
     except Exception as e:
-        st.error(f"Error generating visualization: {e}")
+        print(f"Error generating visualization: {e}")
         return None